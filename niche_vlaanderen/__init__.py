@@ -1,19 +1,24 @@
-from .niche import Niche, NicheDelta, conductivity2minerality  # noqa
+from .niche import Niche, NicheDelta, NicheScenarioSet, conductivity2minerality  # noqa
 from .validation import NicheValidation  # noqa
 from .acidity import Acidity  # noqa
 from .nutrient_level import NutrientLevel  # noqa
 from .vegetation import Vegetation  # noqa
 from .version import __version__  # noqa
 from .flooding import Flooding  # noqa
+from .codetables import code_table_cache  # noqa
+from .rastercache import input_raster_cache  # noqa
 
 
 __all__ = [
     "Acidity",
     "Niche",
     "NicheDelta",
+    "NicheScenarioSet",
     "NicheValidation",
     "conductivity2minerality",
     "NutrientLevel",
     "Vegetation",
     "Flooding",
+    "code_table_cache",
+    "input_raster_cache",
 ]
@@ -1,8 +1,13 @@
 import numpy as np
 import pandas as pd
 
-from niche_vlaanderen.codetables import package_resource
+from niche_vlaanderen.codetables import package_resource, code_table_cache
 from niche_vlaanderen.codetables import validate_tables_acidity, check_codes_used
+from niche_vlaanderen.codetables import code_index, breakpoint_intervals
+
+# columns of lnk_acidity which together determine the acidity
+_acidity_keys = [
+    "rainwater", "mineral_richness", "inundation", "seepage", "soil_mlw_class"]
 
 
 class Acidity(object):
@@ -55,6 +60,23 @@ class Acidity(object):
             ct_seepage = package_resource(
                 ["system_tables"], "seepage.csv")
 
+        code_table_cache.load(self, self._read_code_tables, dict(
+            ct_acidity=ct_acidity,
+            ct_soil_mlw_class=ct_soil_mlw_class,
+            ct_soil_code=ct_soil_code,
+            lnk_acidity=lnk_acidity,
+            ct_seepage=ct_seepage,
+        ))
+
+    def _read_code_tables(
+        self,
+        ct_acidity,
+        ct_soil_mlw_class,
+        ct_soil_code,
+        lnk_acidity,
+        ct_seepage,
+    ):
+        """Read, validate and compile the code tables"""
         self._ct_acidity = pd.read_csv(ct_acidity)
         self._ct_soil_mlw = pd.read_csv(ct_soil_mlw_class)
         self._ct_soil_codes = pd.read_csv(ct_soil_code)
@@ -74,6 +96,45 @@ class Acidity(object):
 
         self._ct_soil_codes = self._ct_soil_codes.set_index("soil_code")
 
+        # lnk_acidity is compiled into a dense array with an axis per key
+        # column. Every axis is indexed by the position of the code in the
+        # sorted codes of that column; the extra last position is used for
+        # codes which are not in the table and contains nodata.
+        self._acidity_codes = [
+            np.unique(self._lnk_acidity[k]) for k in _acidity_keys]
+        table = np.full([len(c) + 1 for c in self._acidity_codes],
+                        self.nodata, dtype=self.dtype)
+        lnk_acidity = self._lnk_acidity.drop_duplicates(_acidity_keys)
+        index = tuple(
+            code_index(lnk_acidity[k].values, codes)
+            for k, codes in zip(_acidity_keys, self._acidity_codes))
+        table[index] = lnk_acidity["acidity"].values
+        table.flags.writeable = False
+        self._acidity_table = table
+
+        # The soil_mlw class is compiled into an array per soil code and
+        # interval between the mlw_max breakpoints of all soil groups, so a
+        # grid is classified using a single search and a gather.
+        self._soil_codes = np.unique(self._ct_soil_codes.index)
+        self._mlw_breaks, inside = breakpoint_intervals(
+            self._ct_soil_mlw["mlw_max"], right=False)
+        table = np.full((len(self._soil_codes) + 1, len(self._mlw_breaks) + 1),
+                        self.nodata, dtype=self.dtype)
+        groups = dict(list(self._ct_soil_mlw.groupby("soil_group")))
+        for i, code in enumerate(self._soil_codes):
+            group = groups.get(self._ct_soil_codes.soil_group[code])
+            if group is not None:
+                classes = np.append(group["soil_mlw_class"].values, self.nodata)
+                table[i] = classes[
+                    np.digitize(inside, group["mlw_max"].values, right=False)]
+        table.flags.writeable = False
+        self._soil_mlw_table = table
+
+        # seepage classes, with nodata for values outside the table
+        self._seepage_breaks = self._ct_seepage["seepage_max"].values
+        self._seepage_classes = np.append(
+            self._ct_seepage["seepage"].values, self.nodata).astype(self.dtype)
+
     def _calculate_soil_mlw(self, soil_code, mlw):
         """Calculate the soil mlw classes
 
@@ -94,23 +155,9 @@ class Acidity(object):
 
         nodata = (soil_code == 255) | np.isnan(mlw)
 
-        # determine soil_group for soil_code
-        orig_shape = mlw.shape
-        soil_code = soil_code.flatten()
-        mlw = mlw.flatten()
-
-        self._ct_soil_codes.loc[self.nodata, "soil_group"] = self.nodata
-        soil_group = self._ct_soil_codes.soil_group[soil_code].values.astype("uint8")
-
-        result = np.ones(soil_code.shape, dtype=self.dtype) * self.nodata
-        for sel_group, subtable in self._ct_soil_mlw.groupby("soil_group"):
-            subtable = subtable.copy().reset_index(drop=True)
-            index = np.digitize(mlw, subtable.mlw_max, right=False)
-            index[nodata.flatten()] = self.nodata
-            selection = soil_group == sel_group
-            subtable.loc[self.nodata, "soil_mlw_class"] = self.nodata
-            result[selection] = subtable.soil_mlw_class.reindex(index).iloc[selection].values
-        result = result.reshape(orig_shape).astype(self.dtype)
+        interval = np.searchsorted(self._mlw_breaks, mlw, side="right")
+        result = self._soil_mlw_table[
+            code_index(soil_code, self._soil_codes), interval]
         result[nodata] = self.nodata  # Apply the nodata mask
         return result
 
@@ -136,8 +183,6 @@ class Acidity(object):
         numpy.ndarray, numpy.uint8
             Array containing the acidity values.
         """
-        orig_shape = inundation.shape
-
         check_codes_used("rainwater", rainwater, {0, 1})
         check_codes_used(
             "minerality", minerality, self._lnk_acidity["mineral_richness"]
@@ -149,37 +194,14 @@ class Acidity(object):
                   (inundation == 255) | (soil_mlw_class == 255) |
                   (seepage_class == 255))
 
-        rainwater = rainwater.flatten()
-        minerality = minerality.flatten()
-        inundation = inundation.flatten()
-        seepage = seepage_class.flatten()
-        soil_mlw_class = soil_mlw_class.flatten()
-
-        result = np.ones(soil_mlw_class.shape, dtype=self.dtype) * self.nodata
-
-
-        for labels, subtable in self._lnk_acidity.groupby(
-            ["rainwater", "mineral_richness", "inundation", "seepage", "soil_mlw_class"]
-        ):
-            (
-                sel_rainwater,
-                sel_mr,
-                sel_inundation,
-                sel_seepage,
-                sel_soil_mlw_class,
-            ) = labels
-            subtable = subtable.copy().reset_index(drop=True)
-
-            selection = (
-                (rainwater == sel_rainwater)
-                & (minerality == sel_mr)
-                & (inundation == sel_inundation)
-                & (seepage == sel_seepage)
-                & (soil_mlw_class == sel_soil_mlw_class)
-            )
-            result[selection] = subtable.acidity[0]
-
-        result = result.reshape(orig_shape).astype(self.dtype)
+        # a single gather in the dense acidity table, combinations which are
+        # not in lnk_acidity result in nodata
+        index = tuple(
+            code_index(values, codes)
+            for values, codes in zip(
+                [rainwater, minerality, inundation, seepage_class, soil_mlw_class],
+                self._acidity_codes))
+        result = self._acidity_table[index]
         result[nodata] = self.nodata
         return result
 
@@ -198,14 +220,8 @@ class Acidity(object):
         """
         nodata = np.isnan(seepage)
 
-        orig_shape = seepage.shape
-        seepage = seepage.flatten()
-
-        index = np.digitize(seepage, self._ct_seepage.seepage_max, right=True)
-        index[nodata.flatten()] = self.nodata
-        self._ct_seepage.loc[self.nodata, "seepage"] = self.nodata
-        seepage_class = self._ct_seepage["seepage"].reindex(index)
-        seepage_class = seepage_class.values.reshape(orig_shape).astype(self.dtype)
+        index = np.digitize(seepage, self._seepage_breaks, right=True)
+        seepage_class = self._seepage_classes[index]
         seepage_class[nodata] = self.nodata
         return seepage_class
 
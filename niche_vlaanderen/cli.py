@@ -8,8 +8,12 @@ from niche_vlaanderen.codetables import package_resource
 @click.pass_context
 @click.option("--example", is_flag=True, help="prints an example configuration file")
 @click.option("--version", is_flag=True, help="prints the version number")
+@click.option("--tile-size", type=click.IntRange(min=1),
+              help="run the model in blocks of tile-size x tile-size cells")
+@click.option("--workers", type=click.IntRange(min=1),
+              help="number of threads used to calculate the model")
 @click.argument("config", required=False, type=click.Path(exists=True))
-def cli(ctx, config, example, version):
+def cli(ctx, config, example, version, tile_size, workers):
     """Command line interface to the NICHE vegetation model"""
     if example:
         ex = package_resource(
@@ -19,7 +23,8 @@ def cli(ctx, config, example, version):
 
     if config is not None:
         n = niche_vlaanderen.Niche()
-        n.run_config_file(config, overwrite_ct=True)
+        n.run_config_file(config, overwrite_ct=True, tile_size=tile_size,
+                          workers=workers)
         click.echo(n)
     if config is None and not example:
         # we should really find a neater way to show --help here by default.
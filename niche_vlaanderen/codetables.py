@@ -1,7 +1,12 @@
+import hashlib
+import os
 import sys
+import threading
 import warnings
+from collections import OrderedDict
 
 import numpy as np
+import pandas as pd
 
 from niche_vlaanderen.exception import NicheException
 
@@ -31,6 +36,121 @@ class CodeTableException(Exception):
     """
 
 
+class CodeTableCache(object):
+    """Process-wide cache of parsed and validated code tables
+
+    Creating a Vegetation, Acidity or NutrientLevel object reads and validates
+    its code tables and compiles them into lookup structures. The resulting
+    attributes are kept in this cache, keyed by the class, the paths of the
+    code tables and a hash of their content. Creating the same object again
+    (eg for every run of a scenario) then only costs reading and hashing the
+    files.
+
+    Changing a code table file changes its hash, so outdated entries are never
+    used. They are removed when the cache is full (least recently used first)
+    or using invalidate.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximal number of entries in the cache. Use 0 to disable caching.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(owner, tables):
+        """Key of a set of code tables: owner, paths and content hashes"""
+        key = [owner.__module__ + "." + owner.__qualname__]
+        for name in sorted(tables):
+            path = os.path.abspath(os.fspath(tables[name]))
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            key.append((name, path, digest))
+        return tuple(key)
+
+    @staticmethod
+    def _copy(attributes):
+        # DataFrames are modified by some of the calculators, every object
+        # gets its own copy. Compiled lookup arrays are only read and shared.
+        return {
+            k: v.copy() if isinstance(v, pd.DataFrame) else v
+            for k, v in attributes.items()
+        }
+
+    def load(self, instance, read, tables):
+        """Set the code table attributes of instance
+
+        Parameters
+        ----------
+        instance : object
+            Object of which the attributes are set.
+        read : callable
+            Function which reads, validates and compiles the code tables,
+            setting the attributes of instance. It is called with the tables
+            as keyword arguments if they are not in the cache.
+        tables : dict
+            Paths of the code tables.
+
+        Warnings emitted while validating the tables are emitted again for
+        every object, also when the tables are taken from the cache.
+        """
+        key = self._key(type(instance), tables)
+        # loading is serialized: catch_warnings is not thread safe and
+        # concurrent objects with the same tables only read them once
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                try:
+                    with warnings.catch_warnings(record=True) as caught:
+                        warnings.simplefilter("always")
+                        read(**tables)
+                finally:
+                    self._warn(caught)
+                if self.maxsize > 0:
+                    self._entries[key] = (self._copy(vars(instance)), caught)
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+                return
+            self._entries.move_to_end(key)
+
+        attributes, caught = entry
+        self._warn(caught)
+        vars(instance).update(self._copy(attributes))
+
+    @staticmethod
+    def _warn(caught):
+        for w in caught:
+            warnings.warn(w.message, w.category)
+
+    def invalidate(self, path=None):
+        """Remove entries from the cache
+
+        Parameters
+        ----------
+        path : str, optional
+            Only remove the entries which use this code table file. By default
+            all entries are removed.
+        """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                return
+            path = os.path.abspath(os.fspath(path))
+            for key in list(self._entries):
+                if any(table[1] == path for table in key[1:]):
+                    del self._entries[key]
+
+
+code_table_cache = CodeTableCache()
+
+
 def check_lower_upper_boundaries(df, min_col, max_col, value):
     """Checks whether there are no overlaps between min_col and max_col
 
@@ -206,6 +326,76 @@ def validate_tables_flooding(
     # check_join(lnk_potential, potential, "potential", "code")
 
 
+def broadcast_base(values):
+    """Distinct part of a broadcast array
+
+    Constant input layers are broadcast views (np.broadcast_to) of a single
+    value. The axes which are repeated (zero stride) are reduced to length
+    one, so checks and lookups only need to process the distinct values.
+    """
+    values = np.asarray(values)
+    if values.ndim == 0:
+        return values
+    return values[tuple(
+        slice(0, 1) if stride == 0 else slice(None)
+        for stride in values.strides)]
+
+
+def code_index(values, codes):
+    """Position of every value in a sorted array of codes
+
+    Values which are not present in codes get position len(codes).
+    """
+    values = np.asarray(values)
+    base = broadcast_base(values)
+    if base.size < values.size:
+        return np.broadcast_to(code_index(base, codes), values.shape)
+    if len(codes) == 0:
+        return np.zeros(values.shape, dtype=np.intp)
+    if values.dtype == np.uint8 and codes.dtype.kind in "iu":
+        # code grids are uint8: translate using a table of all 256 values
+        table = np.full(256, len(codes), dtype=np.intp)
+        valid = (codes >= 0) & (codes < 256)
+        table[codes[valid]] = np.flatnonzero(valid)
+        return table[values]
+    index = np.minimum(np.searchsorted(codes, values), len(codes) - 1)
+    return np.where(codes[index] == values, index, len(codes))
+
+
+def breakpoint_intervals(breakpoints, right=False):
+    """Intervals between all breakpoints of a classification table
+
+    Classification tables contain a set of breakpoints per group (eg per soil
+    code), which are applied using np.digitize. All groups can be classified
+    in a single pass by first determining the interval of a value between the
+    sorted breakpoints of all groups and then looking up the class of that
+    interval for the group.
+
+    Parameters
+    ----------
+    breakpoints : array_like
+        Breakpoints of all groups.
+    right : bool
+        right argument used with np.digitize.
+
+    Returns
+    -------
+    breaks : numpy.ndarray
+        Sorted unique breakpoints. The interval of a value x is
+        np.searchsorted(breaks, x, side="left" if right else "right").
+    inside : numpy.ndarray
+        A value inside every interval. np.digitize(inside, bins, right)
+        gives the result of np.digitize for all values in the interval, for
+        the breakpoints (bins) of any group.
+    """
+    breaks = np.unique(breakpoints)
+    if right:
+        inside = np.append(breaks, breaks[-1:] + 1)
+    else:
+        inside = np.concatenate([breaks[:1] - 1, breaks])
+    return breaks, inside
+
+
 def check_codes_used(name, used, allowed):
     """Compare the incoming grid values with allowed values according
      to system tables
@@ -221,6 +411,7 @@ def check_codes_used(name, used, allowed):
      """
     if isinstance(used, str) or isinstance(used, int):
         used = np.array(used)
+    used = broadcast_base(used)
 
     if used.dtype.kind == "f":
         used_codes = set(np.unique(used[~np.isnan(used)]))
@@ -12,6 +12,7 @@ import numpy.ma as ma
 
 from niche_vlaanderen.vegetation import Vegetation
 from niche_vlaanderen.spatial_context import SpatialContext
+from niche_vlaanderen.output import output_params
 from niche_vlaanderen.codetables import (validate_tables_flooding,
                                          check_codes_used,
                                          package_resource)
@@ -83,6 +84,7 @@ class Flooding(object):
         inner = all(v is None for v in self.__init__.__code__.co_varnames[1:])
 
         validate_tables_flooding(inner=inner, **self._ct)
+        self._compile_potential()
 
         # Set to true when the model is a combined niche - flooding model
         self._combined = False
@@ -119,38 +121,86 @@ class Flooding(object):
 
         return df
 
+    def _compile_potential(self):
+        """Compiles lnk_potential into a dense lookup array
+
+        The array contains the potential for every vegetation type, period,
+        frequency, duration and depth code (0-255). By default code 4 (no
+        information/flooding) is used, depth 255 (nodata) gets nodata.
+        https://github.com/inbo/niche_vlaanderen/issues/87
+        """
+        lnk_potential = self._ct["lnk_potential"]
+        self._veg_codes = np.unique(lnk_potential["veg_code"])
+        self._periods = pd.Index(["summer", "winter"])
+        self._frequencies = pd.Index(self._ct["frequency"]["frequency"].unique())
+        self._durations = pd.Index(self._ct["duration"]["duration"].unique())
+
+        potential = np.full(
+            (len(self._veg_codes), len(self._periods), len(self._frequencies),
+             len(self._durations), 256),
+            4, dtype=self.dtype)
+        potential[..., 255] = self.nodata
+
+        rows = lnk_potential[
+            lnk_potential["period"].isin(self._periods)
+            & lnk_potential["frequency"].isin(self._frequencies)
+            & lnk_potential["duration"].isin(self._durations)
+            & lnk_potential["depth"].between(0, 254)
+        ]
+        # if a combination occurs more than once, the last row is used
+        key = ["veg_code", "period", "frequency", "duration", "depth"]
+        rows = rows.drop_duplicates(subset=key, keep="last")
+        potential[
+            np.searchsorted(self._veg_codes, rows["veg_code"]),
+            self._periods.get_indexer(rows["period"]),
+            self._frequencies.get_indexer(rows["frequency"]),
+            self._durations.get_indexer(rows["duration"]),
+            rows["depth"].to_numpy(dtype=int),
+        ] = rows["potential"]
+        self._potential = potential
+
+    def _potential_table(self, frequency, duration, period):
+        """Potential per vegetation type (rows) and depth code (columns) of
+        a scenario"""
+        check_codes_used("frequency", frequency, self._ct["frequency"]["frequency"])
+        check_codes_used("duration", duration, self._ct["duration"]["duration"])
+        check_codes_used("period", period, ["summer", "winter"])
+        return self._potential[
+            :,
+            self._periods.get_loc(period),
+            self._frequencies.get_loc(frequency),
+            self._durations.get_loc(duration),
+        ]
+
     def _calculate(self, depth, frequency, duration, period):
         """
         Low level calculation of a flooding object.
         Uses a numpy array for depth rather than a grid file (in calculate)
         """
-        orig_shape = depth.shape
-        depth = depth.flatten()
-        nodata = depth == 255   # depth is uint8
-
         check_codes_used("depth", depth, self._ct["depth"]["depth"])
-        check_codes_used("frequency", frequency, self._ct["frequency"]["frequency"])
-        check_codes_used("duration", duration, self._ct["duration"]["duration"])
-        check_codes_used("period", period, ["summer", "winter"])
-
-        for veg_code, subtable_veg in self._ct["lnk_potential"].groupby("veg_code"):
-            subtable_veg = subtable_veg.reset_index()
-            # by default we give code 4 (no information/flooding)
-            # https://github.com/inbo/niche_vlaanderen/issues/87
+        table = self._potential_table(frequency, duration, period)
 
-            vegi = np.full(depth.shape, 4, dtype=self.dtype)
-            vegi[nodata] = self.nodata
+        # a single lookup of the depth codes per vegetation type
+        for i, veg_code in enumerate(self._veg_codes):
+            self._veg[veg_code] = table[i][depth]
 
-            groupby_cols = ["period", "frequency", "duration"]
-            for index, subtable in subtable_veg.groupby(groupby_cols):
-                if (period, frequency, duration) == index:
-                    subtable.reset_index()
-                    for row in subtable.itertuples():
-                        veg = vegi
-                        veg[row.depth == depth] = row.potential
-                        vegi = np.maximum(veg, vegi)
+    def _calculate_many(self, depth, scenarios):
+        """
+        Low level calculation of several scenarios sharing a depth array.
 
-            self._veg[veg_code] = vegi.reshape(orig_shape).astype(self.dtype)
+        Returns a list with a dictionary of potential grids per vegetation type
+        for every (frequency, duration, period) in scenarios.
+        """
+        check_codes_used("depth", depth, self._ct["depth"]["depth"])
+        tables = np.concatenate(
+            [self._potential_table(*scenario) for scenario in scenarios])
+
+        # all scenarios and vegetation types are looked up at once
+        potential = tables[:, depth].reshape(
+            (len(scenarios), len(self._veg_codes)) + depth.shape)
+        return [
+            dict(zip(self._veg_codes, potential[i])) for i in range(len(scenarios))
+        ]
 
     def read_depth_to_grid(self, file_name):
         """Read depth file using rasterio to numpy array and set extent
@@ -191,6 +241,46 @@ class Flooding(object):
         self._calculate(depth, frequency, duration, period)
         self.options = {"frequency": frequency, "duration": duration, "period": period}
 
+    def calculate_many(self, scenarios):
+        """Calculate several flooding scenarios
+
+        Every depth file is read once and all scenarios using it are
+        calculated in a single lookup.
+
+        Parameters
+        ----------
+        scenarios: list of dict
+            Every scenario contains the arguments of calculate: depth_file_path,
+            frequency, period and duration.
+
+        Returns
+        -------
+        list of Flooding
+            A Flooding object with the result of every scenario, in the order
+            of scenarios.
+        """
+        groups = OrderedDict()
+        for i, scenario in enumerate(scenarios):
+            path = os.path.abspath(os.fspath(scenario["depth_file_path"]))
+            groups.setdefault(path, []).append(i)
+
+        results = [None] * len(scenarios)
+        for path, indices in groups.items():
+            depth = self.read_depth_to_grid(path)
+            options = [
+                {key: scenarios[i][key] for key in ["frequency", "duration", "period"]}
+                for i in indices
+            ]
+            vegetation = self._calculate_many(
+                depth,
+                [(o["frequency"], o["duration"], o["period"]) for o in options])
+            for i, option, veg in zip(indices, options, vegetation):
+                result = copy.copy(self)
+                result._veg = veg
+                result.options = option
+                results[i] = result
+        return results
+
     def plot(self, key, ax=None):
         try:
             import matplotlib.pyplot as plt
@@ -238,7 +328,7 @@ class Flooding(object):
 
         return ax
 
-    def write(self, folder, overwrite_files=False):
+    def write(self, folder, overwrite_files=False, output_profile=None):
         """Writes the floodplain grids to grid files.
 
         The differences are coded using the values specified in the
@@ -252,6 +342,9 @@ class Flooding(object):
            Overwrite files when saving.
            Note writing will fail if any of the files to be written already
            exists.
+        output_profile: dict | None
+           Options of the output grids (tiling, compression, Cloud Optimized
+           GeoTIFF), see niche_vlaanderen.output.output_params.
         """
         if len(self._veg) == 0:
             raise FloodingException(
@@ -260,17 +353,8 @@ class Flooding(object):
 
         Path(folder).mkdir(parents=True, exist_ok=True)
 
-        params = dict(
-            driver="GTiff",
-            height=self._context.height,
-            width=self._context.width,
-            crs=self._context.crs,
-            transform=self._context.transform,
-            count=1,
-            dtype=self.dtype,
-            nodata=self.nodata,
-            compress="DEFLATE",
-        )
+        params = output_params(self._context, self.dtype, self.nodata,
+                               output_profile)
 
         self._files_written = dict()
         name = ""
@@ -325,6 +409,7 @@ class Flooding(object):
         Returns
         -------
         combined: Flooding
+            Only contains the vegetation types present in both models.
         """
         # check niche model has been run
         if not niche_result.vegetation_calculated:
@@ -345,12 +430,16 @@ class Flooding(object):
             )
 
         new = copy.copy(self)
-        new._veg = self._veg.copy()
+        # only the vegetation types calculated by the niche model (see the
+        # vegetation_types option of Niche.run) are combined
+        new._veg = {vi: self._veg[vi] for vi in self._veg
+                    if vi in niche_result._vegetation}
         for vi in new._veg:
-            nodata = ((niche_result._vegetation[vi] == Vegetation.nodata) |
-                      (new._veg[vi] == self.nodata))
-            new._veg[vi] = niche_result._vegetation[vi] * new._veg[vi]
-            new._veg[vi][niche_result._vegetation[vi] == 0] = -1
+            # the presence grid is unpacked only once per vegetation type
+            presence = niche_result._vegetation[vi]
+            nodata = (presence == Vegetation.nodata) | (new._veg[vi] == self.nodata)
+            new._veg[vi] = presence * new._veg[vi]
+            new._veg[vi][presence == 0] = -1
             new._veg[vi][nodata] = self.nodata
 
         new._combined = True
@@ -9,18 +9,33 @@ import numbers
 import yaml
 import datetime
 import sys
+import copy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
 
 import numpy as np
 import numpy.ma as ma
 import pandas as pd
 import rasterio
+import rasterio.features
 import rasterstats
+import shapely
+import shapely.geometry
+from rasterio.enums import MergeAlg
+from rasterio.windows import Window
 from tqdm import tqdm
 
-from niche_vlaanderen.vegetation import Vegetation, VegSuitable
+from niche_vlaanderen.vegetation import Vegetation, VegSuitable, VegetationPresence
 from niche_vlaanderen.acidity import Acidity
 from niche_vlaanderen.nutrient_level import NutrientLevel
+from niche_vlaanderen.rastercache import input_raster_cache
+from niche_vlaanderen.output import (output_params, check_output_profile,
+                                     gtiff_params, convert_cog,
+                                     output_band, vegetation_bitmask,
+                                     BITMASK_NODATA, DEVIATION_NODATA,
+                                     ZarrOutput, read_zarr)
 from niche_vlaanderen.spatial_context import SpatialContext
 from niche_vlaanderen.version import __version__, __reference_table_version__, __reference_table_source__, \
     __reference_table_file__
@@ -72,6 +87,14 @@ _input_acidity = {
 
 _abiotic_keys = {"nutrient_level", "acidity"}
 
+# intermediate results of a run and the inputs they depend on. These are
+# reused by the next run as long as none of their inputs is changed.
+_stage_input = {
+    "nutrient_level": _input_nutrient_level,
+    "acidity": _input_acidity,
+    "deviation": {"soil_code", "mhw", "mlw"},
+}
+
 _code_tables = {
     "ct_acidity",
     "ct_soil_mlw_class",
@@ -122,11 +145,14 @@ class Niche(object):
         self._inputfiles = dict()
         self._inputvalues = dict()
         self._inputarray = dict()
+        self._stages = dict()
         self._abiotic = dict()
         self._code_tables = dict()
         self._vegetation = dict()
         self._vegetation_detail = dict()
         self._deviation = dict()
+        self._vegetation_counts = dict()
+        self._vegetation_detail_counts = dict()
         self._options = dict()
         self._options["name"] = ""
         self._options["strict_checks"] = True
@@ -238,6 +264,7 @@ class Niche(object):
             raise NicheException("Cannot find file %s" % key)
 
         self._code_tables[key] = value
+        self._stages = dict()
 
     def set_input(self, key, value):
         """Adds a raster or numeric value as input layer
@@ -253,6 +280,13 @@ class Niche(object):
             certain grid types (eg ArcGIS rasters).
             Can also be a number: in that case a constant value is applied
             everywhere.
+
+        Notes
+        -----
+        After a model run, the input grids and the intermediate results
+        (nutrient_level, acidity and deviation) that do not depend on key are
+        kept. The next run only reads the changed input and recalculates the
+        results depending on it.
         """
         # check type is valid value from list
         if key not in _allowed_input:
@@ -262,6 +296,13 @@ class Niche(object):
             self._log.warning("Setting new input after model run, " "clearing results")
             self._clear_result()
 
+        # forget the input grid and the intermediate results depending on it
+        self._inputarray.pop(key, None)
+        self._stages = {
+            stage: result for stage, result in self._stages.items()
+            if key not in _stage_input[stage]
+        }
+
         if isinstance(value, numbers.Number):
             # Remove any existing values to make sure last value is used
             self._inputfiles.pop(key, None)
@@ -274,6 +315,9 @@ class Niche(object):
             else:
                 if self._context != sc_new:
                     self._context.set_overlap(sc_new)
+                    # all grids read before have a different extent
+                    self._inputarray = dict()
+                    self._stages = dict()
             # Remove any existing values to make sure last value is used
             self._inputvalues.pop(key, None)
             self._inputfiles[key] = value
@@ -331,7 +375,8 @@ class Niche(object):
                 }
                 self._options["flooding"].append(scen)
 
-    def run_config_file(self, config, overwrite_ct=False):
+    def run_config_file(self, config, overwrite_ct=False, tile_size=None,
+                        workers=None):
         """Runs Niche using a configuration file
 
         This will configure the model, run and output as specified.
@@ -343,6 +388,12 @@ class Niche(object):
         overwrite_ct: boolean (False)
             overwrite codetables using the values specified in
             the configuration file.
+        tile_size: int | None
+            run the model in blocks of tile_size cells, overriding the
+            tile_size model option of the configuration file.
+        workers: int | None
+            number of threads used to run the model, overriding the workers
+            model option of the configuration file.
         """
 
         self.read_config_file(config, overwrite_ct=overwrite_ct)
@@ -357,6 +408,16 @@ class Niche(object):
             for k in inspect.getfullargspec(self.run).args
             if k in config_loaded["model_options"].keys()
         }
+        if tile_size is not None:
+            options["tile_size"] = tile_size
+        if workers is not None:
+            options["workers"] = workers
+        tiled = options.get("tile_size") is not None
+
+        if tiled and "flooding" in self._options:
+            raise NicheException(
+                "The flooding module can not be combined with a tiled run")
+
         self.run(**options)
 
         overwrite = False
@@ -385,14 +446,16 @@ class Niche(object):
                 )
                 self.fp = fp.combine(self)
                 if "output_dir" in self._options:
-                    self.fp.write(self._options["output_dir"], overwrite)
+                    self.fp.write(self._options["output_dir"], overwrite,
+                                  self._options.get("output_profile"))
                     self._files_written.update(self.fp._files_written)
 
-        if "output_dir" in self._options:
+        # a tiled run writes its output during the run
+        if "output_dir" in self._options and not tiled:
             output_dir = self._options["output_dir"]
             self.write(output_dir, overwrite)
 
-    def _check_all_lower(self, input_array, a, b):
+    def _check_all_lower(self, input_array, a, b, context=None):
         # We ignore comparison problems with np.nan (nodata)
         warnings.simplefilter(action="ignore", category=RuntimeWarning)
         higher = (
@@ -406,7 +469,9 @@ class Niche(object):
             # find out which cells have invalid values
             bad_points = np.where(higher)
             # convert these cells into the projection system
-            bad_points = self._context.transform * bad_points
+            if context is None:
+                context = self._context
+            bad_points = context.transform * bad_points
 
             print("Warning: Not all {} values are lower than {}".format(a, b))
             print("coordinates with invalid values are:")
@@ -417,7 +482,7 @@ class Niche(object):
                     "Error: not all {} values are lower than {}".format(a, b)
                 )
 
-    def read_rasterio_to_grid(self, file_name, variable_name=None):
+    def read_rasterio_to_grid(self, file_name, variable_name=None, context=None):
         """Read grid files using rasterio as Numpy arrays
 
         Parameters
@@ -426,56 +491,91 @@ class Niche(object):
             Path to the file to be read
         variable_name : string
             Name of the variable this grid file represents
+        context : SpatialContext, optional
+            Part of the model extent to read. By default the full model
+            extent is read.
+
+        Notes
+        -----
+        If niche_vlaanderen.input_raster_cache is enabled, the grids of input
+        types are taken from the cache and are read-only.
         """
+        if context is None:
+            context = self._context
         with rasterio.open(file_name, "r") as dst:
-            window = self._context.get_read_window(SpatialContext(dst))
-            band = dst.read(1, masked=True, window=window)
+            window = context.get_read_window(SpatialContext(dst))
 
-        # Custom fix for mapping of the old soil_code to the new soil_code
-        if variable_name == "soil_code" and np.all(band >= 10000):
-            band = np.round(band / 10000)
+            def read():
+                band = dst.read(1, masked=True, window=window)
 
-        # Cast inputs to predefined type
-        if variable_name in _allowed_input:
-            # Assign fill value for unsigned integers (255) and floats (np.nan)
-            if _allowed_input[variable_name] == "uint8":
-                # first fill with fill-value compatible to uint8
-                band = band.filled(fill_value=255).astype("uint8")
-            elif _allowed_input[variable_name] == "float32":
-                # convert to float and fill with Nan
-                band = band.astype("float32").filled(fill_value=np.nan)
+                # Custom fix for mapping of the old soil_code to the new soil_code
+                if variable_name == "soil_code" and np.all(band >= 10000):
+                    band = np.round(band / 10000)
 
-        return band # return numpy array instead of masked array
+                # Cast inputs to predefined type
+                if variable_name in _allowed_input:
+                    # Assign fill value for unsigned integers (255) and floats (np.nan)
+                    if _allowed_input[variable_name] == "uint8":
+                        # first fill with fill-value compatible to uint8
+                        band = band.filled(fill_value=255).astype("uint8")
+                    elif _allowed_input[variable_name] == "float32":
+                        # convert to float and fill with Nan
+                        band = band.astype("float32").filled(fill_value=np.nan)
 
-    def _check_input_files(self, full_model):
-        """Load all input files to input_array and applu basic input checks
+                return band # return numpy array instead of masked array
+
+            if variable_name not in _allowed_input:
+                return read()
+            return input_raster_cache.load(file_name, (window, variable_name), read)
+
+    def _check_input_files(self, full_model, context=None, reuse=False):
+        """Load all input files to input arrays and apply basic input checks
 
         Parameters
         ----------
         full_model : bool
             If True, the full niche model is applied
+        context : SpatialContext, optional
+            Part of the model extent to read. By default the full model
+            extent is read.
+        reuse : bool
+            Use the grids read by the previous run for the input files that
+            were not changed since, instead of reading them again.
+
+        Returns
+        -------
+        inputarray: dict
+            Input arrays per input key
         """
+        if context is None:
+            context = self._context
+
         # Load the input array from disk
         inputarray = dict()
         for variable in self._inputfiles:
-            band = self.read_rasterio_to_grid(self._inputfiles[variable], variable)
+            if reuse and self._inputarray.get(variable) is not None:
+                inputarray[variable] = self._inputarray[variable]
+                continue
+            band = self.read_rasterio_to_grid(self._inputfiles[variable], variable,
+                                              context=context)
             inputarray[variable] = band
 
-        # Load in all constant inputvalues
+        # Constant inputvalues are read-only views of a single value, which
+        # do not use memory per cell
         for f in self._inputvalues:
-            shape = (int(self._context.height), int(self._context.width))
-            inputarray[f] = np.full(shape, self._inputvalues[f],
-                                    dtype=_allowed_input[f])
+            shape = (int(context.height), int(context.width))
+            inputarray[f] = np.broadcast_to(
+                np.array(self._inputvalues[f], dtype=_allowed_input[f]), shape)
 
         # check if valid values are used in inputarrays
         # check for valid datatypes - values will be checked in the low-level
         # api (eg soil_code present in codetable)
 
-        self._check_all_lower(inputarray, "mhw", "mlw")
+        self._check_all_lower(inputarray, "mhw", "mlw", context)
 
         if "msw" in inputarray.keys():
-            self._check_all_lower(inputarray, "msw", "mlw")
-            self._check_all_lower(inputarray, "mhw", "msw")
+            self._check_all_lower(inputarray, "msw", "mlw", context)
+            self._check_all_lower(inputarray, "mhw", "msw", context)
 
         if full_model and "nutrient_level" not in inputarray.keys():
             with np.errstate(invalid="ignore"):  # ignore NaN comparison errors
@@ -489,10 +589,150 @@ class Niche(object):
                 ):
                     raise NicheException("Error: nitrogen values must be >0 and <10000")
 
-        # if all is successful:
-        self._inputarray = inputarray
+        return inputarray
+
+    def _code_table_arguments(self, cls):
+        """Code tables of the model that are accepted by the constructor of cls"""
+        keys = set(cls.__init__.__code__.co_varnames) & set(self._code_tables)
+        return {k: self._code_tables[k] for k in keys}
+
+    def _calculators(self, full_model):
+        """Create the helper classes used to run the model
+
+        The code tables are parsed and validated only once, so the
+        calculators can be reused for every block of a tiled run. They are
+        not modified while calculating and are shared by all threads.
+        """
+        calculators = dict(vegetation=Vegetation(
+            **self._code_table_arguments(Vegetation)))
+        if full_model:
+            calculators["nutrient_level"] = NutrientLevel(
+                **self._code_table_arguments(NutrientLevel))
+            calculators["acidity"] = Acidity(
+                **self._code_table_arguments(Acidity))
+        return calculators
+
+    def _calculate(self, inputarray, calculators, full_model, deviation,
+                   allow_nodata=False, stages=None):
+        """Calculate the abiotic and vegetation grids from input arrays
+
+        Parameters
+        ----------
+        inputarray: dict
+            Input arrays as returned by _check_input_files
+        calculators: dict
+            Helper classes as returned by _calculators
+        full_model, deviation: bool
+            See run
+        allow_nodata: bool
+            Return nodata grids rather than raising if no vegetation can be
+            predicted in any of the cells (eg a block outside the study area).
+        stages: dict | None
+            Intermediate results of a previous run which are still valid
+            (see _stage_input), these are not calculated again.
+
+        Returns
+        -------
+        abiotic, vegetation, occurrence, vegetation_detail, deviation: dict
+        """
+        stages = stages or dict()
+        abiotic = dict()
+        if full_model:
+            for key in _abiotic_keys & set(stages):
+                if key not in inputarray:
+                    abiotic[key] = stages[key]
+
+            if "nutrient_level" not in inputarray and "nutrient_level" not in abiotic:
+                abiotic["nutrient_level"] = calculators["nutrient_level"].calculate(
+                    soil_code=inputarray["soil_code"],
+                    msw=inputarray["msw"],
+                    nitrogen_atmospheric=inputarray["nitrogen_atmospheric"],
+                    nitrogen_animal=inputarray["nitrogen_animal"],
+                    nitrogen_fertilizer=inputarray["nitrogen_fertilizer"],
+                    management=inputarray["management"],
+                    inundation=inputarray["inundation_nutrient"],
+                )
+
+            if "acidity" not in inputarray and "acidity" not in abiotic:
+                abiotic["acidity"] = calculators["acidity"].calculate(
+                    inputarray["soil_code"],
+                    inputarray["mlw"],
+                    inputarray["inundation_acidity"],
+                    inputarray["seepage"],
+                    inputarray["minerality"],
+                    inputarray["rainwater"],
+                )
+
+        vegetation = calculators["vegetation"]
+        if "inundation_vegetation" not in inputarray:
+            inputarray["inundation_vegetation"] = None
+
+        if "management_vegetation" not in inputarray:
+            inputarray["management_vegetation"] = None
+
+        veg_arguments = dict(
+            soil_code=inputarray["soil_code"],
+            mhw=inputarray["mhw"],
+            mlw=inputarray["mlw"],
+        )
+
+        if full_model:
+            veg_arguments.update(
+                inundation=inputarray["inundation_vegetation"],
+                management=inputarray["management_vegetation"],
+            )
+
+            if "nutrient_level" in inputarray:
+                veg_arguments["nutrient_level"] = inputarray["nutrient_level"]
+            else:
+                veg_arguments["nutrient_level"] = abiotic["nutrient_level"]
+
+            if "acidity" in inputarray:
+                veg_arguments["acidity"] = inputarray["acidity"]
+            else:
+                veg_arguments["acidity"] = abiotic["acidity"]
+
+        if allow_nodata and np.all(
+                vegetation.nodata_mask(full_model=full_model, **veg_arguments)):
+            shape = inputarray["soil_code"].shape
+            veg_codes = [veg_code for _, veg_code in vegetation._select(
+                self._options.get("vegetation_types"))]
+            veg_bands = VegetationPresence.empty(
+                veg_codes, np.ones(shape, dtype=bool))
+            veg_detail = {
+                i: np.full(shape, Vegetation.nodata, dtype=Vegetation.dtype)
+                for i in veg_codes}
+            occurrence = {i: np.nan for i in veg_codes}
+        else:
+            veg_bands, occurrence, veg_detail = vegetation.calculate(
+                full_model=full_model,
+                deduplicate=self._options.get("deduplicate", False),
+                vegetation_types=self._options.get("vegetation_types"),
+                **veg_arguments)
 
-    def run(self, full_model=True, deviation=False, strict_checks=True):
+        difference = dict()
+        if deviation:
+            keys = [
+                "%s_%02d" % (name, veg_code) for _, veg_code
+                in vegetation._select(self._options.get("vegetation_types"))
+                for name in ["mhw", "mlw"]
+            ]
+            if all(key in stages.get("deviation", {}) for key in keys):
+                difference = {key: stages["deviation"][key] for key in keys}
+            else:
+                difference = vegetation.calculate_deviation(
+                    inputarray["soil_code"],
+                    inputarray["mhw"],
+                    inputarray["mlw"],
+                    vegetation_types=self._options.get("vegetation_types"),
+                )
+
+        return abiotic, veg_bands, occurrence, veg_detail, difference
+
+    def run(self, full_model=True, deviation=False, strict_checks=True,
+            tile_size=None, output_dir=None, overwrite_files=False,
+            workers=None, deduplicate=False, vegetation_types=None,
+            output_profile=None):
         """Run the niche model
 
         Runs niche Vlaanderen model. Requires that the necessary input values
@@ -512,11 +752,60 @@ class Niche(object):
                 checks models can still be run. It will still emit a warning.
                 Note that this is provided to be backwards compatibility and
                 it is recommended to fix the data rather than disabling this.
+        tile_size: int | None
+                Run the model in blocks of at most tile_size x tile_size cells.
+                Only one block of the input grids is kept in memory at a time
+                and the results are written block by block to output_dir,
+                which makes it possible to run large grids.
+                The results are not kept in memory: the table property is
+                still available, but plotting requires reading the output
+                files.
+        output_dir: string | None
+                Output folder, only used (and required) when tile_size is
+                given. The same files as with write are created.
+        overwrite_files: bool
+                Overwrite existing files in output_dir, only used when
+                tile_size is given.
+        workers: int | None
+                Number of threads used to calculate the model. The grid is
+                split in blocks of rows (or in tiles for a tiled run) which
+                are calculated in parallel. The results are identical to a
+                run with a single worker.
+        deduplicate: bool
+                Apply the vegetation rules only once for every unique
+                combination of input values. This is faster for grids where
+                large areas have the same input values (eg constant inputs
+                and a coarse soil map). The results are the same.
+        vegetation_types: list | None
+                Only calculate (and write) these vegetation types (veg_code).
+                Other vegetation types are not evaluated at all. By default all
+                vegetation types are calculated.
+        output_profile: dict | None
+                Options of the output grids (tiling, compression codec, level,
+                predictor, BIGTIFF, Cloud Optimized GeoTIFF and the layout of
+                the files), used when writing the results. See
+                niche_vlaanderen.output.output_params for the possible keys.
+                By default striped GeoTIFF files with DEFLATE compression are
+                written.
         """
 
         self._options["full_model"] = full_model
         self._options["deviation"] = deviation
         self._options["strict_checks"] = strict_checks
+        if vegetation_types is not None:
+            vegetation_types = sorted(int(v) for v in vegetation_types)
+        for option, value in [("tile_size", tile_size), ("workers", workers),
+                              ("deduplicate", deduplicate or None),
+                              ("vegetation_types", vegetation_types),
+                              ("output_profile", output_profile)]:
+            if value is not None:
+                self._options[option] = value
+            else:
+                self._options.pop(option, None)
+
+        if workers is not None and workers < 1:
+            raise NicheException("workers must be a positive number")
+        check_output_profile(output_profile)
 
         if full_model:
             required_input = set(_minimal_input)
@@ -536,101 +825,323 @@ class Niche(object):
                 print(missing_keys)
                 raise NicheException("Error, different obliged keys are missing")
 
-        self._check_input_files(full_model)
+        if tile_size is not None:
+            if output_dir is None:
+                raise NicheException("An output_dir is required for a tiled run")
+            self._run_tiled(full_model, deviation, tile_size, output_dir,
+                            overwrite_files, workers)
+            return
+
+        # input grids and intermediate results of a previous run are reused
+        # if their inputs did not change (see set_input)
+        self._inputarray = self._check_input_files(full_model, reuse=True)
+
+        if workers is None or workers == 1:
+            result = self._calculate(self._inputarray,
+                                     self._calculators(full_model),
+                                     full_model, deviation, stages=self._stages)
+        else:
+            result = self._calculate_parallel(self._inputarray, full_model,
+                                              deviation, workers,
+                                              stages=self._stages)
 
-        if full_model:
-            if "nutrient_level" not in self._inputarray:
-                ct_nl = dict()
+        (
+            self._abiotic,
+            self._vegetation,
+            self.occurrence,
+            self._vegetation_detail,
+            self._deviation,
+        ) = result
+        self._stages.update(self._abiotic)
+        if deviation:
+            self._stages["deviation"] = self._deviation
+        self._vegetation_counts = dict()
+        self._vegetation_detail_counts = dict()
 
-                keys = set(NutrientLevel.__init__.__code__.co_varnames) & set(
-                    self._code_tables
-                )
+    def _calculate_parallel(self, inputarray, full_model, deviation, workers,
+                            stages=None):
+        """Calculate the model in blocks of rows using several threads
 
-                for k in keys:
-                    ct_nl[k] = self._code_tables[k]
+        The blocks are merged into the same grids and occurrence a single
+        call of _calculate returns.
+        """
+        inputarray.setdefault("inundation_vegetation", None)
+        inputarray.setdefault("management_vegetation", None)
+        height = inputarray["soil_code"].shape[0]
+        bounds = np.linspace(0, height, min(workers, height) + 1).astype(int)
+        calculators = self._calculators(full_model)
+
+        def calculate(rows):
+            block = {
+                k: v if v is None else v[rows[0]:rows[1]]
+                for k, v in inputarray.items()
+            }
+            block_stages = {
+                k: {key: grid[rows[0]:rows[1]] for key, grid in v.items()}
+                if isinstance(v, dict) else v[rows[0]:rows[1]]
+                for k, v in (stages or dict()).items()
+            }
+            return self._calculate(block, calculators, full_model,
+                                   deviation, allow_nodata=True,
+                                   stages=block_stages)
+
+        blocks = list(_ordered_map(calculate, zip(bounds[:-1], bounds[1:]),
+                                   workers))
+
+        def merge(i):
+            return {
+                k: np.concatenate([b[i][k] for b in blocks]) for k in blocks[0][i]
+            }
+
+        abiotic, veg_detail, difference = merge(0), merge(3), merge(4)
+        veg_bands = VegetationPresence.concatenate([b[1] for b in blocks])
+
+        nodata = np.sum(veg_bands.nodata)
+        if nodata == veg_bands.nodata.size:
+            raise NicheException("Only nodata values in prediction")
+        occurrence = {
+            vi: float(veg_bands.count(vi) / (veg_bands.nodata.size - nodata))
+            for vi in veg_bands
+        }
 
-                nl = NutrientLevel(**ct_nl)
+        return abiotic, veg_bands, occurrence, veg_detail, difference
 
-                self._abiotic["nutrient_level"] = nl.calculate(
-                    soil_code=self._inputarray["soil_code"],
-                    msw=self._inputarray["msw"],
-                    nitrogen_atmospheric=self._inputarray["nitrogen_atmospheric"],
-                    nitrogen_animal=self._inputarray["nitrogen_animal"],
-                    nitrogen_fertilizer=self._inputarray["nitrogen_fertilizer"],
-                    management=self._inputarray["management"],
-                    inundation=self._inputarray["inundation_nutrient"],
-                )
+    def _run_tiled(self, full_model, deviation, tile_size, folder,
+                   overwrite_files, workers=None):
+        """Run the model block by block, streaming the results to folder
 
-            if "acidity" not in self._inputarray:
-                ct_acidity = dict()
+        The grids are calculated per block of the spatial context and written
+        to the output files immediately. Only the number of cells per value is
+        kept, which is used for the summary table and the occurrence.
+        With several workers the blocks are calculated in parallel, but they
+        are still written in order by the calling thread.
+        """
+        self._clear_result()
+        self._inputarray = dict()
+        self._stages = dict()
+        calculators = self._calculators(full_model)
 
-                keys = set(Acidity.__init__.__code__.co_varnames) & set(
-                    self._code_tables
-                )
+        def calculate(window):
+            context = self._context.subset(window)
+            inputarray = self._check_input_files(full_model, context)
+            return window, self._calculate(
+                inputarray, calculators, full_model, deviation,
+                allow_nodata=True)
 
-                for k in keys:
-                    ct_acidity[k] = self._code_tables[k]
-
-                acidity = Acidity(**ct_acidity)
-                self._abiotic["acidity"] = acidity.calculate(
-                    self._inputarray["soil_code"],
-                    self._inputarray["mlw"],
-                    self._inputarray["inundation_acidity"],
-                    self._inputarray["seepage"],
-                    self._inputarray["minerality"],
-                    self._inputarray["rainwater"],
-                )
+        folder = str(folder)
+        self._options["output_dir"] = folder
+        Path(folder).mkdir(parents=True, exist_ok=True)
+
+        output_profile = self._options.get("output_profile") or {}
+        layout = output_profile.get("layout", "files")
+        output_format = output_profile.get("format", "gtiff")
+        # COG files are created from a tiled GeoTIFF after the run
+        cog = self._output_params(tiled=True)["driver"] == "COG"
+        paths = dict()
+        cog_params = dict()
+        files = None
+
+        vegetation_counts = dict()
+        detail_counts = dict()
+
+        with ExitStack() as stack:
+            datasets = dict()
+            blocks = _ordered_map(
+                calculate, self._context.windows(tile_size), workers)
+            for window, result in blocks:
+                abiotic, veg_bands, _, veg_detail, difference = result
+
+                if files is None:
+                    files = self._output_files(
+                        folder, veg_bands, abiotic, difference, False,
+                        overwrite_files, layout, output_format)
+                    if output_format == "zarr":
+                        store = ZarrOutput(
+                            files["zarr"], self._context, veg_bands, abiotic,
+                            len(difference) > 0, False, output_profile,
+                            attributes=dict(name=self.name))
+
+                if output_format == "zarr":
+                    store.write(veg_bands, abiotic, difference, window=window)
+                    grids = []
+                else:
+                    grids = self._output_grids(
+                        files, veg_bands, abiotic, difference, {}, tiled=True)
+
+                for key, path, bands, grid_params, tags in grids:
+                    if key not in datasets:
+                        cog_params[key] = grid_params
+                        if cog:
+                            grid_params = gtiff_params(grid_params)
+                        paths[key] = path + (".tmp.tif" if cog else "")
+                        datasets[key] = stack.enter_context(rasterio.open(
+                            paths[key], "w", **_open_params(grid_params, bands)))
+                        _describe_bands(datasets[key], bands, tags)
+
+                block = Window.from_slices(*window)
+                for key, _, bands, _, _ in grids:
+                    dst = datasets[key]
+                    for i, (_, band) in enumerate(bands, start=1):
+                        dst.write(output_band(band, dst.dtypes[0], dst.nodata), i,
+                                  window=block)
+
+                for vi in veg_bands:
+                    vegetation_counts[vi] = vegetation_counts.get(vi, 0) + np.bincount(
+                        veg_bands[vi].ravel(), minlength=256)
+                    detail_counts[vi] = detail_counts.get(vi, 0) + np.bincount(
+                        veg_detail[vi].ravel(), minlength=256)
+
+        if all(c[Vegetation.nodata] == c.sum() for c in vegetation_counts.values()):
+            raise NicheException("Only nodata values in prediction")
+
+        for key in datasets:
+            if cog:
+                convert_cog(paths[key], files[key], cog_params[key])
+            self._files_written[key] = os.path.normpath(files[key])
+        if output_format == "zarr":
+            self._files_written["zarr"] = os.path.normpath(files["zarr"])
+
+        self._vegetation_counts = vegetation_counts
+        self._vegetation_detail_counts = detail_counts
+        self.occurrence = {
+            vi: (c[1] / (c.sum() - c[Vegetation.nodata])).item()
+            for vi, c in vegetation_counts.items()
+        }
 
-        ct_veg = dict()
+        self.table.to_csv(files["summary"], index=False)
+        with open(files["log"], "w") as f:
+            f.write(self.__repr__())
 
-        keys = set(Vegetation.__init__.__code__.co_varnames) & set(self._code_tables)
+    def _output_params(self, dtype="uint8", nodata=255, output_profile=None,
+                       tiled=False):
+        """Rasterio profile of the output grids
 
-        for k in keys:
-            ct_veg[k] = self._code_tables[k]
+        By default the output_profile option of the run is used.
+        """
+        if output_profile is None:
+            output_profile = self._options.get("output_profile")
+        return output_params(self._context, dtype, nodata, output_profile, tiled)
+
+    def _output_files(self, folder, vegetation, abiotic, deviation,
+                      detailed_files, overwrite_files, layout="files",
+                      output_format="gtiff"):
+        """File names of the grids written by the model
+
+        With the bands or bitmask layout the vegetation, detail and deviation
+        grids are written to a single file per group, with the zarr format all
+        grids are written to a single Zarr store. Raises if a file already
+        exists, unless overwrite_files is set.
+        """
+        prefix = ""
+        if self.name != "":
+            prefix = self.name + "_"
+
+        files = {
+            "summary": folder + "/" + prefix + "summary.csv",
+            "log": "{}/{}log.txt".format(folder, prefix),
+        }
 
-        vegetation = Vegetation(**ct_veg)
-        if "inundation_vegetation" not in self._inputarray:
-            self._inputarray["inundation_vegetation"] = None
+        if output_format == "zarr":
+            files["zarr"] = "{}/{}niche.zarr".format(folder, prefix)
+            vegetation, abiotic, deviation, detailed_files = {}, {}, {}, False
 
-        if "management_vegetation" not in self._inputarray:
-            self._inputarray["management_vegetation"] = None
+        stacked = layout != "files"
 
-        veg_arguments = dict(
-            soil_code=self._inputarray["soil_code"],
-            mhw=self._inputarray["mhw"],
-            mlw=self._inputarray["mlw"],
-        )
+        if stacked and len(vegetation) > 0:
+            files["vegetation"] = "{}/{}vegetation.tif".format(folder, prefix)
+        else:
+            for vi in vegetation:
+                path = "{}/{}V{:02d}.tif".format(folder, prefix, vi)
+                files[vi] = path
 
-        if full_model:
-            veg_arguments.update(
-                inundation=self._inputarray["inundation_vegetation"],
-                management=self._inputarray["management_vegetation"],
-            )
+        for vi in abiotic:
+            path = "{}/{}{}.tif".format(folder, prefix, vi)
+            files[vi] = path
 
-            if "nutrient_level" in self._inputarray:
-                veg_arguments["nutrient_level"] = self._inputarray["nutrient_level"]
-            else:
-                veg_arguments["nutrient_level"] = self._abiotic["nutrient_level"]
+        if stacked and len(deviation) > 0:
+            files["deviation"] = "{}/{}deviation.tif".format(folder, prefix)
+        else:
+            for i in deviation:
+                path = "{}/{}{}.tif".format(folder, prefix, i)
+                files[i] = path
+
+        if detailed_files and stacked and len(vegetation) > 0:
+            path = "{}/{}vegetation_detail.tif".format(folder, prefix)
+            files["vegetation_detail"] = path
+        elif detailed_files:
+            for vi in vegetation:
+                path = "{}/{}V{:02d}_detail.tif".format(folder, prefix, vi)
+                files["%02d_detail" % vi] = path
 
-            if "acidity" in self._inputarray:
-                veg_arguments["acidity"] = self._inputarray["acidity"]
-            else:
-                veg_arguments["acidity"] = self._abiotic["acidity"]
+        for key in files:
+            if os.path.exists(files[key]):
+                if overwrite_files:
+                    self._log.info("Warning: file {} already exists".format(files[key]))
+                else:
+                    raise NicheException("File {} already exists".format(files[key]))
 
-        (
-            self._vegetation,
-            self.occurrence,
-            self._vegetation_detail,
-        ) = vegetation.calculate(full_model=full_model, **veg_arguments)
+        return files
 
-        if deviation:
-            self._deviation = vegetation.calculate_deviation(
-                self._inputarray["soil_code"],
-                self._inputarray["mhw"],
-                self._inputarray["mlw"],
-            )
+    def _output_grids(self, files, vegetation, abiotic, deviation, detail,
+                      output_profile=None, tiled=False):
+        """Grids written to the output files
 
-    def write(self, folder, overwrite_files=False, detailed_files=False):
+        Returns a list of (key, path, bands, params, tags), with key the key
+        in files_written, bands a list of (description, grid) and tags the
+        metadata of the file. By default the output_profile option of the run
+        is used.
+        """
+        if output_profile is None:
+            output_profile = self._options.get("output_profile")
+        layout = (output_profile or {}).get("layout", "files")
+
+        params = self._output_params("uint8", 255, output_profile, tiled)
+        deviation_dtype = (output_profile or {}).get("deviation_dtype", "float32")
+        deviation_params = self._output_params(
+            deviation_dtype, DEVIATION_NODATA[deviation_dtype], output_profile,
+            tiled)
+
+        grids = []
+        if layout == "files":
+            for vi in vegetation:
+                grids.append((vi, files[vi], [(None, vegetation[vi])], params, {}))
+        elif layout == "bands" and len(vegetation) > 0:
+            bands = [(str(vi), vegetation[vi]) for vi in vegetation]
+            grids.append(("vegetation", files["vegetation"], bands, params, {}))
+        elif len(vegetation) > 0:
+            bitmask_params = self._output_params(
+                "uint32", BITMASK_NODATA, output_profile, tiled)
+            tags = {"veg_codes": ",".join(str(vi) for vi in vegetation),
+                    "bitmask": "bit veg_code - 1 is set if present"}
+            grids.append(("vegetation", files["vegetation"],
+                          [(None, vegetation_bitmask(vegetation))],
+                          bitmask_params, tags))
+
+        for vi in abiotic:
+            grids.append((vi, files[vi], [(None, abiotic[vi])], params, {}))
+
+        if layout == "files":
+            for vi in detail:
+                key = "%02d_detail" % vi
+                grids.append((key, files[key], [(None, detail[vi])], params, {}))
+        elif len(detail) > 0:
+            bands = [(str(vi), detail[vi]) for vi in detail]
+            grids.append(("vegetation_detail", files["vegetation_detail"], bands,
+                          params, {}))
+
+        if layout == "files":
+            for i in deviation:
+                grids.append((i, files[i], [(None, deviation[i])],
+                              deviation_params, {}))
+        elif len(deviation) > 0:
+            bands = [(i, deviation[i]) for i in deviation]
+            grids.append(("deviation", files["deviation"], bands,
+                          deviation_params, {}))
+
+        return grids
+
+    def write(self, folder, overwrite_files=False, detailed_files=False,
+              workers=None, output_profile=None):
         """Saves the model results to a folder
 
         Saves the model results to a folder. Files will be written as geotiff.
@@ -649,95 +1160,85 @@ class Niche(object):
             exists.
         detailed_files : bool
             Save detailed information on factor affecting vegetation possibility
+        workers: int | None
+            Number of threads writing (and compressing) the grids in parallel.
+            Defaults to the workers option of the model run. The files written
+            and the log do not depend on the number of workers.
+        output_profile: dict | None
+            Options of the output grids (see run). Defaults to the
+            output_profile option of the model run.
 
         """
 
         if not self.vegetation_calculated:
             raise NicheException("A valid run must be done before writing the output.")
 
+        if len(self._vegetation) == 0:
+            raise NicheException(
+                "The results of a tiled run are written to the output_dir "
+                "during the run.")
+
         folder = str(folder)
         self._options["output_dir"] = folder
 
         Path(self._options["output_dir"]).mkdir(parents=True, exist_ok=True)
 
-        params = dict(
-            driver="GTiff",
-            height=self._context.height,
-            width=self._context.width,
-            crs=self._context.crs,
-            transform=self._context.transform,
-            count=1,
-            dtype="uint8",
-            nodata=255,
-            compress="DEFLATE",
-        )
+        if output_profile is None:
+            output_profile = self._options.get("output_profile")
+        check_output_profile(output_profile)
+        layout = (output_profile or {}).get("layout", "files")
+        output_format = (output_profile or {}).get("format", "gtiff")
 
         prefix = ""
         if self.name != "":
             prefix = self.name + "_"
 
-        files = {
-            "summary": folder + "/" + prefix + "summary.csv",
-            "log": "{}/{}log.txt".format(folder, prefix),
-        }
-
-        for vi in self._vegetation:
-            path = "{}/{}V{:02d}.tif".format(folder, prefix, vi)
-            files[vi] = path
-
-        for vi in self._abiotic:
-            path = "{}/{}{}.tif".format(folder, prefix, vi)
-            files[vi] = path
-
-        for i in self._deviation:
-            path = "{}/{}{}.tif".format(folder, prefix, i)
-            files[i] = path
-
-        if detailed_files:
-            for vi in self._vegetation_detail:
-                path = "{}/{}V{:02d}_detail.tif".format(folder, prefix, vi)
-                files["%02d_detail" % vi] = path
+        files = self._output_files(folder, self._vegetation, self._abiotic,
+                                   self._deviation, detailed_files,
+                                   overwrite_files, layout, output_format)
 
-        for key in files:
-            if os.path.exists(files[key]):
-                if overwrite_files:
-                    self._log.info("Warning: file {} already exists".format(files[key]))
-                else:
-                    raise NicheException("File {} already exists".format(files[key]))
+        if workers is None:
+            workers = self._options.get("workers")
+        if workers is not None and workers < 1:
+            raise NicheException("workers must be a positive number")
 
         # write a summary file containing the table of the model
         self.table.to_csv(files["summary"], index=False)
 
-        for vi in self._vegetation:
-            with rasterio.open(files[vi], "w", **params) as dst:
-                dst.write(self._vegetation[vi], 1)
-                self._files_written[vi] = os.path.normpath(files[vi])
-
-        # also save the abiotic grids
-        for vi in self._abiotic:
-            with rasterio.open(files[vi], "w", **params) as dst:
-                dst.write(self._abiotic[vi], 1)
-                self._files_written[vi] = os.path.normpath(files[vi])
-
+        detail = dict()
         if detailed_files:
             # write legend file
             legend = VegSuitable.legend()
             pd.DataFrame({"legend": pd.Series(legend)}).to_csv(folder + "/" + prefix + "legend_detail.csv")
             # and the actual grids
-            for vi in self._vegetation_detail:
-                filename = files["%02d_detail" % vi]
-                with rasterio.open(filename, "w", **params) as dst:
-                    dst.write(self._vegetation_detail[vi], 1)
-                    self._files_written["%02d_detail" % vi] = os.path.normpath(filename)
-
-        # deviation
-        params.update(dtype="float64", nodata=-99999)
-        for i in self._deviation:
-            with rasterio.open(files[i], "w", **params) as dst:
-                band = self._deviation[i]
-                band[band == np.nan] = -99999
-                dst.write(band, 1)
-                self._files_written[i] = os.path.normpath(files[i])
+            detail = self._vegetation_detail
+
+        if output_format == "zarr":
+            store = ZarrOutput(
+                files["zarr"], self._context, self._vegetation, self._abiotic,
+                len(self._deviation) > 0, detailed_files, output_profile,
+                attributes=dict(name=self.name))
+            store.write_grids(self._vegetation, self._abiotic, self._deviation,
+                              detail)
+            self._files_written["zarr"] = os.path.normpath(files["zarr"])
+            grids = []
+        else:
+            # vegetation, abiotic, detail and deviation grids
+            grids = self._output_grids(files, self._vegetation, self._abiotic,
+                                       self._deviation, detail, output_profile)
+
+        def write_grid(grid):
+            key, path, bands, grid_params, tags = grid
+            with rasterio.open(path, "w", **_open_params(grid_params, bands)) as dst:
+                _describe_bands(dst, bands, tags)
+                for i, (_, band) in enumerate(bands, start=1):
+                    dst.write(output_band(band, dst.dtypes[0], dst.nodata), i)
+            return key, os.path.normpath(path)
+
+        # the grids are compressed and written by a pool of threads (rasterio
+        # releases the GIL), but the written files are registered in order
+        for key, path in _ordered_map(write_grid, grids, workers):
+            self._files_written[key] = path
 
         with open(files["log"], "w") as f:
             f.write(self.__repr__())
@@ -942,21 +1443,28 @@ class Niche(object):
 
         td = list()
         if detail is False:
-            presence = dict({0: "not present", 1: "present", 255: "no data"})
-
-            for i in self._vegetation:
-                vi = pd.Series(self._vegetation[i].flatten())
-                rec = vi.value_counts() * self._context.cell_area / 10000
-                for a in rec.index:
-                    td.append((i, presence[a], rec[a]))
+            labels = dict({0: "not present", 1: "present", 255: "no data"})
+            grids = self._vegetation
+            counts = self._vegetation_counts
         else:
-            legend = VegSuitable.legend()
-            legend[Vegetation.nodata] = "no data"
-            for i in self._vegetation_detail:
-                vi = pd.Series(self._vegetation_detail[i].flatten())
-                rec = vi.value_counts() * self._context.cell_area / 10000
-                for a in rec.index:
-                    td.append((i, legend[a], rec[a]))
+            labels = VegSuitable.legend()
+            labels[Vegetation.nodata] = "no data"
+            grids = self._vegetation_detail
+            counts = self._vegetation_detail_counts
+
+        for i in grids:
+            vi = pd.Series(grids[i].flatten())
+            rec = vi.value_counts() * self._context.cell_area / 10000
+            for a in rec.index:
+                td.append((i, labels[a], rec[a]))
+
+        # result of a tiled run: only the counts per value are known
+        for i in counts:
+            rec = pd.Series(counts[i])
+            rec = rec[rec > 0].sort_values(ascending=False, kind="stable")
+            rec = rec * self._context.cell_area / 10000
+            for a in rec.index:
+                td.append((i, labels[a], rec[a]))
 
         df = pd.DataFrame(td, columns=["vegetation", "presence", "area_ha"])
 
@@ -964,7 +1472,8 @@ class Niche(object):
 
     def zonal_stats(
             self, vectors, outside=True, attribute=None,
-            vegetation_types=None, upscale=1
+            vegetation_types=None, upscale=1, coverage=False,
+            filter_extent=True
     ):
         """Calculates zonal statistics using vectors
 
@@ -985,22 +1494,26 @@ class Niche(object):
         vegetation_types : List | None
             optional list of vegetation types (as integer number) for which the
             statistics must be calculated. Calculation will happen for all
-            niche vegetation types by default.
+            calculated niche vegetation types by default.
         upscale : int
             upscaling factor: decrease the cell size by this factor to increase
             the resolution
+        coverage : bool (default: False)
+            use the exact fraction of every cell covered by a shape instead of
+            counting the cells with their center inside the shape. The area of
+            a cell partially covered by a shape is weighted by the covered
+            fraction. This is more accurate than upscaling and upscale is
+            ignored.
+        filter_extent : bool (default: True)
+            when vectors is a path, only read the shapes intersecting the
+            extent of the model. The shape_id is the row number in the file,
+            shapes outside the extent are not part of the table. Geo-like
+            python objects are always used completely.
 
         Returns
         -------
         table : pandas.DataFrame
         """
-        td = dict()
-
-        # Ignore the warnings from rasterstats - code must be adjusted
-        # in that package - not in our code.
-        # warnings.simplefilter(action="ignore", category=FutureWarning)
-        # warnings.simplefilter(action="ignore", category=DeprecationWarning)
-
         presence = dict({0: "not present", 1: "present", 255: "no data"})
 
         if vegetation_types is None:
@@ -1010,56 +1523,84 @@ class Niche(object):
             raise NicheException("Can not calculate zonal statistics for "
                                  "empty vegetation list")
 
+        missing = [vi for vi in vegetation_types if vi not in self._vegetation]
+        if missing:
+            raise NicheException(
+                "Vegetation types %s were not calculated, can not calculate "
+                "zonal statistics" % [int(vi) for vi in missing])
+
         logger.debug(f"vegetation_types: {vegetation_types}")
         logger.debug(f"upscaling to {upscale}")
 
-        for i in tqdm(vegetation_types):
-            # Note we use -99 as nodata value to make sure the true nodata
-            # value (255) is part of the result table.
-
-            if upscale == 1:
-                raster = self._vegetation[i]
-                affine = self._context.transform
-            else:
-                # based on
-                # https://rasterio.readthedocs.io/en/latest/topics/resampling.html
-                raster = (
-                    self._vegetation[i].repeat(upscale, axis=0).repeat(upscale, axis=1)
-                )
-                affine = self._context.transform * self._context.transform.scale(
-                    self._context.width / raster.shape[1],
-                    self._context.height / raster.shape[0],
-                )
-
-            td[i] = rasterstats.zonal_stats(
-                vectors=vectors,
-                raster=raster,
-                affine=affine,
-                categorical=True,
-                nodata=Vegetation.nodata,
-                geojson_out=attribute is not None,
+        if isinstance(vectors, (str, Path)):
+            # only the shapes intersecting the model extent are read (bounding
+            # box filter and spatial index query)
+            extent = self._context.extent if filter_extent else None
+            shapes = _read_map(vectors, extent=extent)
+            geometries = list(shapes.geometry)
+            shape_index = list(shapes.index)
+            if attribute is not None:
+                attributes = list(shapes[attribute])
+        else:
+            features = list(rasterstats.io.read_features(vectors))
+            geometries = [feature["geometry"] for feature in features]
+            shape_index = list(range(len(features)))
+            if attribute is not None:
+                attributes = [feature["properties"][attribute]
+                              for feature in features]
+
+        if coverage:
+            # the covered fraction of every cell is computed once per shape
+            shape_ids, cells, weights = _zonal_coverage(
+                geometries, (self._context.height, self._context.width),
+                self._context.transform)
+            scale = 1
+        else:
+            # the vectors are rasterized only once, on the (upscaled) grid
+            shape = (self._context.height * upscale, self._context.width * upscale)
+            affine = self._context.transform * self._context.transform.scale(
+                self._context.width / shape[1],
+                self._context.height / shape[0],
             )
-        warnings.simplefilter("default")
+            shape_ids, cells = _zonal_cells(geometries, shape, affine)
+            if upscale != 1:
+                # cell of the vegetation grid containing the upscaled cell
+                rows, cols = np.divmod(cells, shape[1])
+                cells = rows // upscale * self._context.width + cols // upscale
+            weights = None
+            scale = upscale ** 2
+
+        # the number of cells per shape and presence value is counted for all
+        # shapes at once. Nodata cells are not counted (as in rasterstats).
+        pixels = dict()
+        for vi in tqdm(vegetation_types):
+            values = self._vegetation[vi].ravel()[cells]
+            valid = values != Vegetation.nodata
+            counts = np.bincount(
+                shape_ids[valid] * 2 + values[valid],
+                weights=None if weights is None else weights[valid],
+                minlength=2 * len(geometries))
+            pixels[vi] = counts.reshape(len(geometries), 2)
 
         ti = []
         attribute_list = []
 
-        for vi in td:
-            for shape_i, rec in enumerate(td[vi]):
-                if attribute is not None:
-                    rec = rec["properties"]
+        for vi in pixels:
+            for shape_i, shape_id in enumerate(shape_index):
                 for a in presence:
-                    pixels = rec.get(a) if rec.get(a) is not None else 0
+                    count = pixels[vi][shape_i, a] if a != Vegetation.nodata else 0
+                    if weights is None:
+                        count = int(count)
                     ti.append(
                         (
                             int(vi),
-                            shape_i,
+                            int(shape_id),
                             presence[a],
-                            pixels * self._context.cell_area / 10000 / (upscale ** 2),
+                            count * self._context.cell_area / 10000 / scale,
                         )
                     )
                     if attribute is not None:
-                        attribute_list.append(rec[attribute])
+                        attribute_list.append(attributes[shape_i])
 
         df = pd.DataFrame(ti, columns=["vegetation", "shape_id", "presence", "area_ha"])
 
@@ -1105,12 +1646,325 @@ class Niche(object):
 
     @property
     def vegetation_calculated(self):
-        return len(self._vegetation) > 0
+        return len(self._vegetation) > 0 or len(self._vegetation_counts) > 0
 
     def _clear_result(self):
-        """Clears calculated vegetation"""
-        self._vegetation.clear()
-        self._deviation.clear()
+        """Clears calculated vegetation, abiotic and deviation grids"""
+        self._abiotic = dict()
+        self._vegetation = dict()
+        self._vegetation_detail = dict()
+        self._deviation = dict()
+        self.occurrence = None
+        self._vegetation_counts.clear()
+        self._vegetation_detail_counts.clear()
+
+    def _copy_input(self):
+        """New model with the same input, code tables and options, but no results
+
+        The input grids and intermediate results which are kept for the next
+        run (see set_input) are shared with the new model.
+        """
+        new = copy.copy(self)
+        new._inputfiles = dict(self._inputfiles)
+        new._inputvalues = dict(self._inputvalues)
+        new._inputarray = dict(self._inputarray)
+        new._stages = dict(self._stages)
+        new._code_tables = dict(self._code_tables)
+        new._options = dict(self._options)
+        new._context = copy.copy(self._context)
+        new._abiotic = dict()
+        new._vegetation = dict()
+        new._vegetation_detail = dict()
+        new._deviation = dict()
+        new._vegetation_counts = dict()
+        new._vegetation_detail_counts = dict()
+        new._files_written = dict()
+        new.occurrence = None
+        return new
+
+    @classmethod
+    def from_zarr(cls, path, window=None):
+        """Niche object containing the results stored in a Zarr store
+
+        Reads the grids written using the zarr output format (see the
+        output_profile option of run). The object has no input layers, but
+        the results can be used as those of a model run, eg to create a table,
+        plot, write the grids or compare models using NicheDelta.
+
+        Parameters
+        ----------
+        path: str
+            Path of the store (niche.zarr in the output folder).
+        window: tuple | None
+            ((row_start, row_stop), (col_start, col_stop)), only read this
+            block of the grids. By default the whole grid is read.
+
+        Returns
+        -------
+        Niche
+        """
+        content = read_zarr(path, window)
+        niche = cls()
+        niche.name = content["attributes"].get("name", "")
+        niche._context = content["context"]
+        niche._vegetation = content["vegetation"]
+        niche._vegetation_detail = content["vegetation_detail"]
+        niche._deviation = content["deviation"]
+        niche._abiotic = content["abiotic"]
+
+        niche.occurrence = dict()
+        for vi, grid in niche._vegetation.items():
+            valid = np.count_nonzero(grid != Vegetation.nodata)
+            present = np.count_nonzero(grid == 1)
+            niche.occurrence[vi] = present / valid if valid > 0 else np.nan
+        return niche
+
+    def run_scenarios(self, scenarios, workers=None, **options):
+        """Run a set of scenarios using the input of this model as common input
+
+        Parameters
+        ----------
+        scenarios: dict
+            Input layers per scenario name, see NicheScenarioSet.
+        workers: int | None
+            Number of scenarios calculated in parallel.
+        options:
+            Options of the model run, see run.
+
+        Returns
+        -------
+        NicheScenarioSet
+            The scenarios, including their results.
+        """
+        scenario_set = NicheScenarioSet(self, scenarios)
+        scenario_set.run(workers=workers, **options)
+        return scenario_set
+
+
+def _open_params(params, bands):
+    """Rasterio profile of a file with a band per grid in bands"""
+    if len(bands) == 1:
+        return params
+    return dict(params, count=len(bands))
+
+
+def _describe_bands(dataset, bands, tags):
+    """Sets the band descriptions and the tags of an output file"""
+    for i, (description, _) in enumerate(bands, start=1):
+        if description is not None:
+            dataset.set_band_description(i, description)
+    if len(tags) > 0:
+        dataset.update_tags(**tags)
+
+
+def _ordered_map(function, items, workers=None):
+    """Apply function to all items, yielding the results in order
+
+    With more than one worker the items are processed by a thread pool
+    (numpy releases the GIL for the heavy work). At most two items per
+    worker are in flight, so memory use does not depend on the number of
+    items.
+    """
+    if workers is None or workers <= 1:
+        yield from map(function, items)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _zonal_cells(geometries, shape, transform):
+    """Cells of a grid inside each of the geometries
+
+    The geometries are burned at once into a grid with the number of the
+    geometry. Only geometries overlapping other geometries are rasterized
+    separately (within their bounding box) for the cells they share. A cell is
+    inside a geometry if its center is (as in rasterstats).
+
+    Returns
+    -------
+    shape_ids, cells: numpy.ndarray
+        Number of the geometry and flat index in the grid of every cell
+        inside a geometry.
+    """
+    if len(geometries) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    labels = rasterio.features.rasterize(
+        ((geometry, i + 1) for i, geometry in enumerate(geometries)),
+        out_shape=shape, transform=transform, fill=0, dtype="int32")
+    overlaps = rasterio.features.rasterize(
+        ((geometry, 1) for geometry in geometries),
+        out_shape=shape, transform=transform, fill=0, dtype="int32",
+        merge_alg=MergeAlg.add)
+
+    cells = np.flatnonzero(overlaps.ravel() == 1)
+    shape_ids = [labels.ravel()[cells] - 1]
+    cells = [cells]
+
+    shared = overlaps > 1
+    if np.any(shared):
+        for i, geometry in enumerate(geometries):
+            window = _geometry_window(geometry, shape, transform)
+            if window is None or not np.any(shared[window]):
+                continue
+            row_start, col_start = window[0].start, window[1].start
+            inside = rasterio.features.rasterize(
+                [(geometry, 1)], out_shape=shared[window].shape,
+                transform=transform * transform.translation(col_start, row_start),
+                fill=0, dtype="uint8").astype(bool)
+            rows, cols = np.nonzero(inside & shared[window])
+            cells.append((rows + row_start) * shape[1] + cols + col_start)
+            shape_ids.append(np.full(len(rows), i))
+
+    return np.concatenate(shape_ids).astype(np.int64), np.concatenate(cells)
+
+
+def _zonal_coverage(geometries, shape, transform):
+    """Fraction of the cells of a grid covered by each of the geometries
+
+    Only the cells crossed by the boundary of a geometry are intersected with
+    the geometry, the other cells in its bounding box are either completely
+    inside or completely outside the geometry, which is determined by their
+    center.
+
+    Returns
+    -------
+    shape_ids, cells, fractions: numpy.ndarray
+        Number of the geometry, flat index in the grid and covered fraction of
+        every cell (partially) covered by a geometry.
+    """
+    shape_ids = [np.zeros(0, dtype=np.int64)]
+    cells = [np.zeros(0, dtype=np.int64)]
+    fractions = [np.zeros(0, dtype=np.float64)]
+    cell_area = abs(transform.a * transform.e - transform.b * transform.d)
+
+    for i, geometry in enumerate(geometries):
+        window = _geometry_window(geometry, shape, transform)
+        if window is None:
+            continue
+        row_start, col_start = window[0].start, window[1].start
+        out_shape = (window[0].stop - row_start, window[1].stop - col_start)
+        window_transform = transform * transform.translation(col_start, row_start)
+        geometry = shapely.geometry.shape(geometry)
+
+        inside = rasterio.features.rasterize(
+            [(geometry, 1)], out_shape=out_shape, transform=window_transform,
+            fill=0, dtype="uint8").astype(bool)
+        boundary = rasterio.features.rasterize(
+            [(geometry.boundary, 1)], out_shape=out_shape,
+            transform=window_transform, fill=0, dtype="uint8",
+            all_touched=True).astype(bool)
+        # the neighbours of the cells touched by the boundary are intersected
+        # as well, as the rasterization is not exact at the cell borders
+        padded = np.pad(boundary, 1)
+        boundary = (padded[1:-1, 1:-1] | padded[:-2, 1:-1] | padded[2:, 1:-1]
+                    | padded[1:-1, :-2] | padded[1:-1, 2:])
+
+        rows, cols = np.nonzero(inside & ~boundary)
+        partial_rows, partial_cols = np.nonzero(boundary)
+        corners = [
+            np.column_stack(window_transform * (partial_cols + dc, partial_rows + dr))
+            for dc, dr in [(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]
+        ]
+        boxes = shapely.polygons(np.stack(corners, axis=1))
+        shapely.prepare(geometry)
+        partial = shapely.area(shapely.intersection(boxes, geometry)) / cell_area
+        partial = np.minimum(partial, 1)
+        covered = partial > 0
+
+        rows = np.concatenate([rows, partial_rows[covered]])
+        cols = np.concatenate([cols, partial_cols[covered]])
+        cells.append((rows + row_start) * shape[1] + cols + col_start)
+        shape_ids.append(np.full(len(rows), i, dtype=np.int64))
+        fractions.append(np.concatenate([
+            np.ones(len(rows) - np.count_nonzero(covered)), partial[covered]]))
+
+    return np.concatenate(shape_ids), np.concatenate(cells), np.concatenate(fractions)
+
+
+def _geometry_window(geometry, shape, transform):
+    """Window of a grid containing the bounding box of a geometry
+
+    Returns None if the geometry is outside the grid.
+    """
+    inverse = ~transform
+    west, south, east, north = rasterio.features.bounds(geometry)
+    col_start, row_start = inverse * (west, north)
+    col_stop, row_stop = inverse * (east, south)
+    row_start, col_start = max(int(np.floor(row_start)), 0), max(
+        int(np.floor(col_start)), 0)
+    row_stop = min(int(np.ceil(row_stop)), shape[0])
+    col_stop = min(int(np.ceil(col_stop)), shape[1])
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    return slice(row_start, row_stop), slice(col_start, col_stop)
+
+
+def _read_map(map, extent=None, use_arrow=False):
+    """Read a vegetation map (or other vector file)
+
+    Parameters:
+        map: Path
+            Path to a vector file.
+        extent: tuple | None
+            optional extent ((west, north), (east, south)), only the polygons
+            intersecting this extent are returned.
+        use_arrow: bool
+            read the file using the Arrow interface of pyogrio.
+
+    Returns:
+        geopandas.GeoDataFrame with the row number of the polygons in the file
+        as index, also if only a part of the polygons is read.
+    """
+    try:
+        import pyogrio
+    except ImportError:  # pragma: no cover
+        if use_arrow:
+            msg = "Could not import pyogrio\n"
+            msg += "pyogrio and pyarrow required for reading using arrow"
+            raise ImportError(msg)
+        pyogrio = None
+
+    if extent is None:
+        if pyogrio is None:  # pragma: no cover
+            import geopandas as gpd
+            return gpd.read_file(map)
+        return pyogrio.read_dataframe(map, use_arrow=use_arrow)
+
+    (west, north), (east, south) = extent
+    if pyogrio is None:  # pragma: no cover
+        import geopandas as gpd
+        map = gpd.read_file(map, bbox=(west, south, east, north))
+    else:
+        # only the features with a bounding box intersecting the extent are
+        # read. The row numbers are derived from the feature ids, which are
+        # read without geometries and attributes.
+        fids = pyogrio.read_dataframe(
+            map, read_geometry=False, columns=[], fid_as_index=True
+        ).index
+        map = pyogrio.read_dataframe(
+            map, bbox=(west, south, east, north), fid_as_index=True,
+            use_arrow=use_arrow
+        )
+        map.index = pd.Index(fids.get_indexer(map.index))
+
+    # exact test using the spatial index, so only polygons intersecting the
+    # extent are part of the overlay
+    hits = map.sindex.query(
+        shapely.box(west, south, east, north), predicate="intersects"
+    )
+    return map.iloc[np.sort(hits)]
 
 
 def indent(s, pre):
@@ -1160,14 +2014,19 @@ class NicheDelta(object):
                 "to calculating a delta."
             )
 
+        if len(n1._vegetation) != len(n2._vegetation):
+            raise NicheException("Niche vegetation objects have different length.")
+
+        if list(n1._vegetation) != list(n2._vegetation):
+            raise NicheException(
+                "Niche vegetation objects have different vegetation types.")
+
         # the error below should not occur as we check the context, but
         # better safe than sorry
-        if n1._vegetation[1].size != n2._vegetation[1].size:  # pragma: no cover
+        vi = next(iter(n1._vegetation))
+        if n1._vegetation[vi].size != n2._vegetation[vi].size:  # pragma: no cover
             raise NicheException("Arrays have different size.")
 
-        if len(n1._vegetation) != len(n2._vegetation):
-            raise NicheException("Niche vegetation objects have different length.")
-
         for vi in n1._vegetation:
             n1v = n1._vegetation[vi].flatten()
             n2v = n2._vegetation[vi].flatten()
@@ -1182,7 +2041,7 @@ class NicheDelta(object):
 
         self._n1 = n1
 
-    def write(self, folder, overwrite_files=False):
+    def write(self, folder, overwrite_files=False, output_profile=None):
         """Writes the difference grids to grid files.
 
         The differences are coded using these values:
@@ -1200,22 +2059,15 @@ class NicheDelta(object):
             Path to which the output files will be written.
         overwrite_files: bool
             Whether files should be overwritten on save.
+        output_profile: dict | None
+            Options of the output grids (tiling, compression, Cloud Optimized
+            GeoTIFF), see niche_vlaanderen.output.output_params.
         """
 
         if not os.path.exists(folder):
             os.makedirs(folder)
 
-        params = dict(
-            driver="GTiff",
-            height=self._context.height,
-            width=self._context.width,
-            crs=self._context.crs,
-            transform=self._context.transform,
-            count=1,
-            dtype="uint8",
-            nodata=255,
-            compress="DEFLATE",
-        )
+        params = output_params(self._context, output_profile=output_profile)
 
         prefix = ""
         if self.name != "":
@@ -1318,6 +2170,143 @@ class NicheDelta(object):
         return df
 
 
+class NicheScenarioSet(object):
+    """Set of niche models which only differ in some of their input layers
+
+    Scenario studies often run the model for a number of (eg hydrological)
+    scenarios which share most of the input layers. A NicheScenarioSet reads
+    the common input files only once and calculates the intermediate results
+    (eg the nutrient level) that do not depend on the varying input layers
+    only once. Every scenario is a Niche model with its own results.
+
+    Parameters
+    ----------
+    niche: Niche
+        Model with the input layers and code tables common to all scenarios.
+    scenarios: dict
+        Input layers per scenario name, which are set on top of the input of
+        niche, eg ``{"wet": {"mhw": "wet_mhw.tif", "mlw": "wet_mlw.tif"}}``.
+        The scenario name is used as name of its model.
+    """
+
+    def __init__(self, niche, scenarios):
+        if len(scenarios) == 0:
+            raise NicheException("No scenarios given")
+        for name, inputs in scenarios.items():
+            if str(name) == "":
+                raise NicheException("Scenarios must have a name")
+            for key in inputs:
+                if key not in _allowed_input:
+                    raise NicheException("Unrecognized type %s" % key)
+
+        self._niche = niche
+        self._scenarios = {
+            str(name): dict(inputs) for name, inputs in scenarios.items()}
+        self.scenarios = dict()
+        self._files_written = dict()
+
+    def run(self, workers=None, **options):
+        """Run the model for all scenarios
+
+        Parameters
+        ----------
+        workers: int | None
+            Number of scenarios calculated in parallel.
+        options:
+            Options of the model run (eg full_model, deviation), see Niche.run.
+        """
+        if workers is not None and workers < 1:
+            raise NicheException("workers must be a positive number")
+
+        varying = set()
+        for inputs in self._scenarios.values():
+            varying |= set(inputs)
+
+        # the common input files are read only once
+        common = self._niche._copy_input()
+        for key, path in common._inputfiles.items():
+            if key not in varying and key not in common._inputarray:
+                common._inputarray[key] = common.read_rasterio_to_grid(path, key)
+
+        def run(name):
+            niche = common._copy_input()
+            niche.name = name
+            for key, value in self._scenarios[name].items():
+                niche.set_input(key, value)
+            niche.run(**options)
+            return niche
+
+        names = list(self._scenarios)
+        first = run(names[0])
+        # the intermediate results which do not depend on the varying input
+        # are the same for all scenarios, unless the input of the first
+        # scenario reduced the extent of the model
+        if common._context is not None and first._context == common._context:
+            common._stages = {
+                stage: result for stage, result in first._stages.items()
+                if not _stage_input[stage] & varying
+            }
+            common._inputarray.update({
+                key: grid for key, grid in first._inputarray.items()
+                if key not in varying and grid is not None
+            })
+
+        self.scenarios = {names[0]: first}
+        for name, niche in zip(names[1:],
+                               _ordered_map(run, names[1:], workers)):
+            self.scenarios[name] = niche
+
+    def __getitem__(self, name):
+        return self.scenarios[name]
+
+    @property
+    def table(self):
+        """Dataframe containing the potential area (ha) per scenario and
+        vegetation type"""
+        if len(self.scenarios) == 0:
+            raise NicheException(
+                "Error: You must run the scenarios prior to requesting the "
+                "result table")
+
+        tables = list()
+        for name, niche in self.scenarios.items():
+            table = niche.table
+            table.insert(0, "scenario", name)
+            tables.append(table)
+        return pd.concat(tables, ignore_index=True)
+
+    def write(self, folder, overwrite_files=False, detailed_files=False,
+              workers=None):
+        """Saves the results of all scenarios to a folder
+
+        The files of every scenario are prefixed with the scenario name (see
+        Niche.write). A summary.csv file contains the table of all scenarios.
+
+        Parameters
+        ----------
+        folder: string
+            Output folder to which files will be written.
+        overwrite_files: bool
+            Overwrite files when saving.
+        detailed_files : bool
+            Save detailed information on factor affecting vegetation possibility
+        workers: int | None
+            Number of threads writing the grids of a scenario in parallel.
+        """
+        summary = "{}/summary.csv".format(folder)
+        if os.path.exists(summary) and not overwrite_files:
+            raise NicheException("File {} already exists".format(summary))
+        table = self.table
+
+        for name, niche in self.scenarios.items():
+            niche.write(folder, overwrite_files=overwrite_files,
+                        detailed_files=detailed_files, workers=workers)
+            self._files_written[name] = niche._files_written
+
+        table.to_csv(summary, index=False)
+        self._files_written["summary"] = os.path.normpath(summary)
+
+
 def conductivity2minerality(conductivity, minerality):
     """Convert a grid with conductivity to a grid of minerality
 
@@ -2,7 +2,9 @@ import numpy as np
 import pandas as pd
 
 from niche_vlaanderen.codetables import (validate_tables_nutrient_level,
-                                         check_codes_used, package_resource)
+                                         check_codes_used, package_resource,
+                                         code_table_cache, code_index,
+                                         breakpoint_intervals)
 
 
 class NutrientLevel(object):
@@ -54,6 +56,23 @@ class NutrientLevel(object):
             ct_nutrient_level = package_resource(
                 ["system_tables"], "nutrient_level.csv")
 
+        code_table_cache.load(self, self._read_code_tables, dict(
+            ct_lnk_soil_nutrient_level=ct_lnk_soil_nutrient_level,
+            ct_management=ct_management,
+            ct_mineralisation=ct_mineralisation,
+            ct_soil_code=ct_soil_code,
+            ct_nutrient_level=ct_nutrient_level,
+        ))
+
+    def _read_code_tables(
+        self,
+        ct_lnk_soil_nutrient_level,
+        ct_management,
+        ct_mineralisation,
+        ct_soil_code,
+        ct_nutrient_level,
+    ):
+        """Read, validate and compile the code tables"""
         self.ct_lnk_soil_nutrient_level = pd.read_csv(ct_lnk_soil_nutrient_level)
         self._ct_management = pd.read_csv(ct_management)
         self._ct_mineralisation = pd.read_csv(ct_mineralisation)
@@ -88,6 +107,51 @@ class NutrientLevel(object):
             .soil_code
         )
 
+        # The classifications are compiled into arrays indexed by the
+        # position of the soil code (and influence) and the interval between
+        # the breakpoints of all soil codes, so every cell is classified once.
+        self._soil_codes = np.unique(self._ct_soil_code.soil_code)
+
+        self._msw_breaks, inside = breakpoint_intervals(
+            self._ct_mineralisation["msw_max"], right=False)
+        table = np.full((len(self._soil_codes) + 1, len(inside)), np.nan,
+                        dtype="float32")
+        for code, subtable in self._ct_mineralisation.groupby("soil_code"):
+            values = np.append(
+                subtable["nitrogen_mineralisation"].values, np.nan)
+            table[code_index(code, self._soil_codes)] = values[
+                np.digitize(inside, subtable["msw_max"].values, right=False)]
+        table.flags.writeable = False
+        self._mineralisation_table = table
+
+        management = self._ct_management.drop_duplicates("management")
+        self._management_codes = np.unique(management["management"])
+        self._influence = np.append(
+            management.set_index("management")["influence"][
+                self._management_codes].values,
+            self.nodata).astype(self.dtype)
+        self._influence.flags.writeable = False
+        self._influence_codes = np.unique(self._ct_management["influence"])
+
+        lnk = self.ct_lnk_soil_nutrient_level
+        self._nitrogen_breaks, inside = breakpoint_intervals(
+            lnk["total_nitrogen_max"], right=True)
+        # combinations of soil code and influence which are not in the table
+        # keep the influence value, as the original per group classification
+        table = np.empty((len(self._soil_codes) + 1,
+                          len(self._influence_codes) + 1, len(inside)),
+                         dtype=self.dtype)
+        table[:, :-1] = self._influence_codes[np.newaxis, :, np.newaxis]
+        table[:, -1] = self.nodata
+        for (code, influence), subtable in lnk.groupby(["soil_code", "influence"]):
+            levels = np.append(subtable["nutrient_level"].values, self.nodata)
+            table[code_index(code, self._soil_codes),
+                  code_index(influence, self._influence_codes)] = levels[
+                np.digitize(inside, subtable["total_nitrogen_max"].values,
+                            right=True)]
+        table.flags.writeable = False
+        self._nutrient_level_table = table
+
     def _calculate_mineralisation(self, soil_code, msw):
         """Calculate nitrogen mineralisation based on soil and water arrays
 
@@ -107,23 +171,11 @@ class NutrientLevel(object):
         """
         nodata = (soil_code == 255) | np.isnan(msw)
 
-        orig_shape = soil_code.shape
-        soil_code_array = soil_code.flatten()
-        msw_array = msw.flatten()
-        result = np.ones(soil_code_array.shape, dtype="float32") * np.nan
-
-        for code in self._ct_mineralisation.soil_code.unique():
-            # We must reset the index because digitize will give indexes
-            # compared to the new table.
-            select = self._ct_mineralisation.soil_code == code
-            table_sel = self._ct_mineralisation[select].copy()
-            table_sel = table_sel.reset_index(drop=True)
-            soil_sel = soil_code_array == code
-            ix = np.digitize(msw_array[soil_sel], table_sel.msw_max, right=False)
-            result[soil_sel] = table_sel["nitrogen_mineralisation"].reindex(ix).values
+        interval = np.searchsorted(self._msw_breaks, msw, side="right")
+        result = self._mineralisation_table[
+            code_index(soil_code, self._soil_codes), interval]
 
         # The intermediate mineralisation array is a float32 array with np.nan as nodata
-        result = result.reshape(orig_shape).astype(np.float32)
         result[nodata] = np.nan # Apply the nodata mask
         return result
 
@@ -155,42 +207,20 @@ class NutrientLevel(object):
                   np.isnan(nitrogen) | (inundation == 255))
 
         # calculate management influence
-        influence = np.ones(management.shape, dtype=self.dtype) * self.nodata
-        for i in self._ct_management.management.unique():
-            sel_grid = management == i
-            sel_ct = self._ct_management.management == i
-            influence[sel_grid] = self._ct_management[sel_ct].influence.values[0]
+        influence = self._influence[code_index(management, self._management_codes)]
 
-        # flatten all input layers
-        orig_shape = soil_code.shape
-        soil_code = soil_code.flatten()
-        nitrogen = nitrogen.flatten()
-
-        inundation = inundation.flatten()
-        influence = influence.flatten()
-
-        result = influence
         # search for classification values in nutrient level codetable
-        for name, subtable in self.ct_lnk_soil_nutrient_level.groupby(
-            ["soil_code", "influence"]
-        ):
-
-            soil_selected, influence_selected = name
-            table_sel = subtable.copy(deep=True).reset_index(drop=True)
-
-            index = np.digitize(nitrogen, table_sel.total_nitrogen_max, right=True)
-            index[nodata.flatten()] = self.nodata
-            selection = (soil_code == soil_selected) & (influence == influence_selected)
-            # Add the no-data value to the mapping
-            table_sel.loc[self.nodata, "nutrient_level"] = self.nodata
-            result[selection] = table_sel.nutrient_level[index].iloc[selection].values
+        interval = np.searchsorted(self._nitrogen_breaks, nitrogen, side="left")
+        result = self._nutrient_level_table[
+            code_index(soil_code, self._soil_codes),
+            code_index(influence, self._influence_codes),
+            interval]
 
         # Note that niche_vlaanderen is different from the original (Dutch)
         # model here:
         # only if nutrient_level < 4 the inundation rule is applied.
         result[result < 4] = (result + (inundation > 0))[result < 4]
 
-        result = result.reshape(orig_shape).astype(self.dtype)
         result[nodata] = self.nodata  # Apply the nodata mask
         return result
 
@@ -0,0 +1,496 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from affine import Affine
+
+from niche_vlaanderen.exception import NicheException
+from niche_vlaanderen.spatial_context import SpatialContext
+from niche_vlaanderen.vegetation import VegetationPresence
+from niche_vlaanderen.version import __version__
+
+_profile_keys = ["tiled", "blocksize", "compress", "level", "predictor", "bigtiff",
+                 "cog", "layout", "format", "deviation_dtype"]
+
+_layouts = ["files", "bands", "bitmask"]
+
+_formats = ["gtiff", "zarr"]
+
+# nodata value of a vegetation bitmask grid (bit 31 is never used)
+BITMASK_NODATA = 2 ** 32 - 1
+
+# nodata value of the deviation grids per output data type
+DEVIATION_NODATA = {"float32": -99999, "int16": -32768}
+
+# zarr codec and default level per compression codec
+_zarr_codecs = {"DEFLATE": ("GzipCodec", 6), "ZSTD": ("ZstdCodec", 0),
+                "NONE": (None, None)}
+
+# creation option of the compression level per codec (GTiff driver)
+_level_options = {"DEFLATE": "zlevel", "ZSTD": "zstd_level", "LZMA": "lzma_preset"}
+
+_cog_predictors = {1: "NO", 2: "STANDARD", 3: "FLOATING_POINT"}
+
+
+def check_output_profile(output_profile):
+    """Checks the keys and values of an output profile
+
+    Parameters
+    ----------
+    output_profile: dict | None
+        Output profile, see output_params.
+    """
+    if output_profile is None:
+        return
+    if not isinstance(output_profile, dict):
+        raise NicheException("output_profile must be a dictionary")
+
+    unknown = set(output_profile) - set(_profile_keys)
+    if len(unknown) > 0:
+        raise NicheException(
+            "Unknown output_profile option(s) {}, possible options: {}".format(
+                sorted(unknown), _profile_keys))
+
+    blocksize = output_profile.get("blocksize", 256)
+    if not isinstance(blocksize, int) or blocksize <= 0 or blocksize % 16 != 0:
+        raise NicheException("output_profile blocksize must be a multiple of 16")
+
+    compress = str(output_profile.get("compress", "DEFLATE")).upper()
+    if "level" in output_profile and compress not in _level_options:
+        raise NicheException(
+            "output_profile level can only be used with compress {}".format(
+                ", ".join(_level_options)))
+
+    if output_profile.get("predictor", 1) not in _cog_predictors:
+        raise NicheException("output_profile predictor must be 1, 2 or 3")
+
+    if output_profile.get("layout", "files") not in _layouts:
+        raise NicheException(
+            "output_profile layout must be one of {}".format(", ".join(_layouts)))
+
+    if output_profile.get("format", "gtiff") not in _formats:
+        raise NicheException(
+            "output_profile format must be one of {}".format(", ".join(_formats)))
+
+    if output_profile.get("deviation_dtype", "float32") not in DEVIATION_NODATA:
+        raise NicheException(
+            "output_profile deviation_dtype must be one of {}".format(
+                ", ".join(DEVIATION_NODATA)))
+
+    if output_profile.get("format") == "zarr" and compress not in _zarr_codecs:
+        raise NicheException(
+            "Zarr output supports compress {}".format(", ".join(_zarr_codecs)))
+
+
+def output_params(context, dtype="uint8", nodata=255, output_profile=None,
+                  tiled=False):
+    """Rasterio profile of an output grid
+
+    Parameters
+    ----------
+    context: SpatialContext
+        Spatial context of the grid.
+    dtype: str
+        Data type of the grid.
+    nodata: int | float
+        Nodata value of the grid.
+    output_profile: dict | None
+        Options of the output files. By default striped GeoTIFF files with
+        DEFLATE compression are written. Possible keys:
+
+        * tiled: write tiled GeoTIFF files (default False)
+        * blocksize: size of the tiles (default 256, multiple of 16)
+        * compress: compression codec, eg DEFLATE (default), ZSTD, LZW or NONE
+        * level: compression level (DEFLATE, ZSTD and LZMA only)
+        * predictor: 1 (none), 2 (horizontal differencing) or 3 (floating
+          point). Integer grids use 2 instead of 3.
+        * bigtiff: YES, NO, IF_NEEDED or IF_SAFER
+        * cog: write Cloud Optimized GeoTIFF files with internal overviews
+          (default False). COG files are always tiled.
+        * layout: files (default) writes a file per grid. bands writes the
+          vegetation, detail and deviation grids as bands of one file per
+          group, with the veg_code (or deviation name) as band description.
+          bitmask writes the vegetation grids as one uint32 grid (see
+          vegetation_bitmask), the other grids as with bands. The layout is
+          used by Niche.write, not by this function.
+        * deviation_dtype: float32 (default, nodata -99999) or int16, which
+          writes the deviation grids rounded to whole cm (nodata -32768).
+        * format: gtiff (default) or zarr, which writes all grids to a single
+          chunked Zarr store (see ZarrOutput). Zarr stores use blocksize,
+          compress (DEFLATE, ZSTD or NONE) and level, the other options are
+          ignored.
+    tiled: bool
+        Write tiled files, unless the output profile sets tiled to False.
+
+    Returns
+    -------
+    dict
+    """
+    check_output_profile(output_profile)
+    output_profile = dict(output_profile or {})
+
+    params = dict(
+        driver="GTiff",
+        height=context.height,
+        width=context.width,
+        crs=context.crs,
+        transform=context.transform,
+        count=1,
+        dtype=dtype,
+        nodata=nodata,
+        compress=str(output_profile.get("compress", "DEFLATE")).upper(),
+    )
+    blocksize = output_profile.get("blocksize", 256)
+    cog = output_profile.get("cog", False)
+
+    predictor = output_profile.get("predictor")
+    if predictor == 3 and not np.issubdtype(np.dtype(dtype), np.floating):
+        predictor = 2
+
+    if cog:
+        params.update(driver="COG", blocksize=blocksize, overviews="AUTO",
+                      overview_resampling="nearest")
+        if "level" in output_profile:
+            params["level"] = output_profile["level"]
+        if predictor is not None:
+            params["predictor"] = _cog_predictors[predictor]
+    else:
+        if output_profile.get("tiled", tiled):
+            params.update(tiled=True, blockxsize=blocksize, blockysize=blocksize)
+        if "level" in output_profile:
+            params[_level_options[params["compress"]]] = output_profile["level"]
+        if predictor is not None:
+            params["predictor"] = predictor
+
+    if "bigtiff" in output_profile:
+        params["bigtiff"] = str(output_profile["bigtiff"]).upper()
+
+    return params
+
+
+def output_band(band, dtype, nodata):
+    """Grid converted to the data type of an output file
+
+    Floating point grids get the nodata value where they are NaN and are
+    rounded (and clipped) when written as integers. Other grids are returned
+    unchanged.
+    """
+    if not np.issubdtype(band.dtype, np.floating):
+        return band
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        band = np.clip(np.rint(band), info.min + 1, info.max)
+    return np.where(np.isnan(band), nodata, band).astype(dtype)
+
+
+def gtiff_params(params):
+    """Profile of a tiled GeoTIFF which can be converted to a COG
+
+    COG files can only be created from a complete grid. Grids which are
+    written block by block are first written to a tiled GeoTIFF using these
+    parameters, and converted afterwards (see convert_cog).
+    """
+    params = dict(params)
+    blocksize = params.pop("blocksize")
+    for key in ["overviews", "overview_resampling", "level", "predictor"]:
+        params.pop(key, None)
+    params.update(driver="GTiff", tiled=True, blockxsize=blocksize,
+                  blockysize=blocksize)
+    return params
+
+
+def convert_cog(source, destination, params):
+    """Converts a GeoTIFF file to a COG file and removes the source file"""
+    options = {
+        key: params[key]
+        for key in ["compress", "blocksize", "overviews", "overview_resampling",
+                    "level", "predictor", "bigtiff"]
+        if key in params
+    }
+    rasterio.shutil.copy(source, destination, driver="COG", **options)
+    os.remove(source)
+
+
+def vegetation_bitmask(vegetation):
+    """Packs the vegetation presence grids into a single uint32 grid
+
+    Bit veg_code - 1 is set where vegetation type veg_code is present. Cells
+    which are nodata get BITMASK_NODATA.
+
+    Parameters
+    ----------
+    vegetation: VegetationPresence | dict
+        Presence grid (0: not present, 1: present, 255: nodata) per veg_code.
+        All grids share the same nodata cells.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if any(not 1 <= vi <= 31 for vi in vegetation):
+        raise NicheException(
+            "A vegetation bitmask can only contain veg_codes 1 to 31")
+
+    if isinstance(vegetation, VegetationPresence):
+        nodata = vegetation.nodata
+        if vegetation.veg_codes == list(range(1, len(vegetation) + 1)):
+            # the first bit plane already has the bitmask layout
+            bitmask = vegetation.bits[0].copy()
+        else:
+            bitmask = np.zeros(nodata.shape, dtype=np.uint32)
+            for vi in vegetation:
+                bitmask |= (vegetation.present(vi).astype(np.uint32)
+                            << np.uint32(vi - 1))
+    else:
+        bitmask = None
+        for vi in vegetation:
+            band = vegetation[vi]
+            if bitmask is None:
+                bitmask = np.zeros(band.shape, dtype=np.uint32)
+                nodata = band == 255
+            bitmask |= (band == 1).astype(np.uint32) << np.uint32(vi - 1)
+    bitmask[nodata] = BITMASK_NODATA
+    return bitmask
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError:  # pragma: no cover
+        msg = "Could not import zarr\n"
+        msg += "zarr (version 3 or later) required for Zarr output"
+        raise ImportError(msg)
+    return zarr
+
+
+def _take_rows(grids, rows):
+    """Grids (dict or VegetationPresence) limited to a slice of rows"""
+    if isinstance(grids, VegetationPresence):
+        return grids.take(rows)
+    return {key: grids[key][rows] for key in grids}
+
+
+class ZarrOutput(object):
+    """Chunked Zarr store containing the grids of a model run
+
+    The store contains the arrays vegetation, vegetation_detail (optional),
+    deviation_mhw and deviation_mlw with dimensions (veg_code, y, x), and an
+    array with dimensions (y, x) per abiotic grid. The coordinates veg_code,
+    y and x (cell centers) are stored as arrays as well, the crs and the
+    transform as attributes of the store. The dimension names are stored in
+    the array metadata, so the store can also be opened using xarray.
+
+    The deviation arrays have the deviation_dtype of the output profile, with
+    NaN (float32) or -32768 (int16) as fill value for nodata.
+
+    A chunk covers all vegetation types of a block of blocksize by blocksize
+    cells, so a region can be read for all vegetation types at once.
+
+    Parameters
+    ----------
+    path: str
+        Path of the store. An existing store is replaced.
+    context: SpatialContext
+        Spatial context of the grids.
+    veg_codes: list
+        Vegetation types.
+    abiotic: list
+        Names of the abiotic grids.
+    deviation: bool
+        Store the mhw and mlw deviation grids.
+    detail: bool
+        Store the detailed vegetation grids.
+    output_profile: dict | None
+        Output profile, the blocksize, compress and level are used.
+    attributes: dict | None
+        Additional attributes of the store.
+    """
+
+    def __init__(self, path, context, veg_codes, abiotic, deviation=False,
+                 detail=False, output_profile=None, attributes=None):
+        zarr = _import_zarr()
+        check_output_profile(output_profile)
+        output_profile = dict(output_profile or {})
+
+        self.veg_codes = list(veg_codes)
+        self.abiotic = list(abiotic)
+        # the zarr fill value (NaN for float32) is the nodata value
+        deviation_dtype = output_profile.get("deviation_dtype", "float32")
+        deviation_nodata = np.nan
+        if deviation_dtype != "float32":
+            deviation_nodata = DEVIATION_NODATA[deviation_dtype]
+        self.deviation = deviation
+        self.detail = detail
+
+        blocksize = output_profile.get("blocksize", 256)
+        codec, level = _zarr_codecs[
+            str(output_profile.get("compress", "DEFLATE")).upper()]
+        compressors = None
+        if codec is not None:
+            level = output_profile.get("level", level)
+            compressors = getattr(zarr.codecs, codec)(level=level)
+
+        self._group = zarr.open_group(str(path), mode="w")
+        self._group.attrs.update(
+            crs=context.crs,
+            transform=list(context.transform)[:6],
+            niche_version=__version__,
+            abiotic=self.abiotic,
+            **(attributes or {}),
+        )
+
+        transform = context.transform
+        coordinates = {
+            "veg_code": np.array(self.veg_codes, dtype=np.int16),
+            "y": transform.f + (np.arange(context.height) + 0.5) * transform.e,
+            "x": transform.c + (np.arange(context.width) + 0.5) * transform.a,
+        }
+        for name, values in coordinates.items():
+            self._group.create_array(name, data=values, dimension_names=[name])
+
+        shape = (context.height, context.width)
+        chunks = (min(blocksize, context.height), min(blocksize, context.width))
+        stacked = ["vegetation"]
+        if detail:
+            stacked.append("vegetation_detail")
+        for name in stacked:
+            self._group.create_array(
+                name, shape=(len(self.veg_codes),) + shape,
+                chunks=(max(1, len(self.veg_codes)),) + chunks, dtype="uint8",
+                fill_value=255, compressors=compressors,
+                dimension_names=["veg_code", "y", "x"])
+        if deviation:
+            for name in ["deviation_mhw", "deviation_mlw"]:
+                self._group.create_array(
+                    name, shape=(len(self.veg_codes),) + shape,
+                    chunks=(max(1, len(self.veg_codes)),) + chunks,
+                    dtype=deviation_dtype, fill_value=deviation_nodata,
+                    compressors=compressors,
+                    dimension_names=["veg_code", "y", "x"])
+        for name in self.abiotic:
+            self._group.create_array(
+                name, shape=shape, chunks=chunks, dtype="uint8", fill_value=255,
+                compressors=compressors, dimension_names=["y", "x"])
+
+    def write(self, vegetation, abiotic, deviation=None, detail=None,
+              window=None):
+        """Writes the grids of a block of the store
+
+        Parameters
+        ----------
+        vegetation: VegetationPresence | dict
+            Presence grid per veg_code.
+        abiotic: dict
+            Abiotic grids.
+        deviation: dict | None
+            Deviation grids, with keys mhw_XX and mlw_XX.
+        detail: dict | None
+            Detailed vegetation grid per veg_code.
+        window: tuple | None
+            ((row_start, row_stop), (col_start, col_stop)) of the block,
+            by default the whole grid.
+        """
+        if window is None:
+            height, width = self._group["vegetation"].shape[1:]
+            window = ((0, height), (0, width))
+        (row_start, row_stop), (col_start, col_stop) = window
+        block = (slice(row_start, row_stop), slice(col_start, col_stop))
+        shape = (row_stop - row_start, col_stop - col_start)
+
+        stacked = {"vegetation": vegetation}
+        if self.detail:
+            stacked["vegetation_detail"] = detail
+        if self.deviation:
+            for kind in ["mhw", "mlw"]:
+                grids = {vi: deviation["%s_%02d" % (kind, vi)]
+                         for vi in self.veg_codes
+                         if "%s_%02d" % (kind, vi) in deviation}
+                stacked["deviation_" + kind] = grids
+
+        for name, grids in stacked.items():
+            array = self._group[name]
+            data = np.full((len(self.veg_codes),) + shape, array.fill_value,
+                           dtype=array.dtype)
+            for i, vi in enumerate(self.veg_codes):
+                if vi in grids:
+                    data[i] = output_band(grids[vi], array.dtype, array.fill_value)
+            array[(slice(None),) + block] = data
+
+        for name in self.abiotic:
+            self._group[name][block] = abiotic[name]
+
+    def write_grids(self, vegetation, abiotic, deviation=None, detail=None):
+        """Writes complete grids to the store, one row of chunks at a time"""
+        height, width = self._group["vegetation"].shape[1:]
+        step = self._group["vegetation"].chunks[1]
+        for row in range(0, height, step):
+            rows = slice(row, min(row + step, height))
+            self.write(
+                _take_rows(vegetation, rows),
+                _take_rows(abiotic, rows),
+                None if deviation is None else _take_rows(deviation, rows),
+                None if detail is None else _take_rows(detail, rows),
+                window=((rows.start, rows.stop), (0, width)))
+
+
+def read_zarr(path, window=None):
+    """Reads the grids of a Zarr store written by ZarrOutput
+
+    Parameters
+    ----------
+    path: str
+        Path of the store.
+    window: tuple | None
+        ((row_start, row_stop), (col_start, col_stop)), only read this block
+        of the grids. By default the whole grid is read.
+
+    Returns
+    -------
+    dict
+        With keys context (SpatialContext), attributes, vegetation,
+        vegetation_detail, deviation (keys mhw_XX and mlw_XX) and abiotic.
+    """
+    zarr = _import_zarr()
+    group = zarr.open_group(str(path), mode="r")
+    attributes = dict(group.attrs)
+
+    height, width = group["vegetation"].shape[1:]
+    dst = SimpleNamespace(transform=Affine(*attributes["transform"]),
+                          width=width, height=height, crs=attributes["crs"])
+    context = SpatialContext(dst)
+    if window is None:
+        window = ((0, height), (0, width))
+    context = context.subset(window)
+    (row_start, row_stop), (col_start, col_stop) = window
+    block = (slice(None), slice(row_start, row_stop), slice(col_start, col_stop))
+
+    veg_codes = [int(vi) for vi in group["veg_code"][:]]
+    arrays = set(group.array_keys())
+
+    def read_stacked(name):
+        if name not in arrays:
+            return dict()
+        data = group[name][block]
+        if name.startswith("deviation") and data.dtype != np.float32:
+            # deviation grids are float32 with NaN as nodata in memory
+            nodata = data == group[name].fill_value
+            data = data.astype(np.float32)
+            data[nodata] = np.nan
+        return {vi: data[i] for i, vi in enumerate(veg_codes)}
+
+    deviation_mhw = read_stacked("deviation_mhw")
+    deviation_mlw = read_stacked("deviation_mlw")
+    deviation = dict()
+    for vi in deviation_mhw:
+        deviation["mhw_%02d" % vi] = deviation_mhw[vi]
+        deviation["mlw_%02d" % vi] = deviation_mlw[vi]
+
+    abiotic = {name: group[name][block[1:]] for name in attributes["abiotic"]}
+
+    return dict(context=context, attributes=attributes,
+                vegetation=read_stacked("vegetation"),
+                vegetation_detail=read_stacked("vegetation_detail"),
+                deviation=deviation, abiotic=abiotic)
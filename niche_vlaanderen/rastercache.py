@@ -0,0 +1,119 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class InputRasterCache(object):
+    """Process-wide cache of input grids
+
+    Reading an input grid (especially an ascii grid) and casting it to the
+    type used by niche takes time. When many models use the same input files
+    (eg the soil_code, mhw and mlw of a set of scenarios), the cast grids can
+    be kept in this cache, so every file is only read once.
+
+    The grids are keyed by the path, modification time and size of the file
+    and by the read window, so a changed file is always read again. The cached
+    grids are shared by all models and therefore read-only.
+
+    The cache is disabled by default, it is enabled by setting a memory
+    budget (maxbytes). When the cached grids use more memory than the budget,
+    the least recently used grids are removed.
+
+    Parameters
+    ----------
+    maxbytes : int
+        Maximal memory used by the cached grids in bytes. Use 0 (default) to
+        disable caching.
+    """
+
+    def __init__(self, maxbytes=0):
+        self.maxbytes = maxbytes
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        """Memory used by the cached grids in bytes"""
+        with self._lock:
+            return sum(array.nbytes for array in self._entries.values())
+
+    @staticmethod
+    def _stat(path):
+        """Path, modification time and size of a file
+
+        For a directory (eg an ArcGIS grid) the most recent modification time
+        and the total size of the files in it are used.
+        """
+        path = os.path.abspath(os.fspath(path))
+        if os.path.isdir(path):
+            stats = [entry.stat() for entry in os.scandir(path) if entry.is_file()]
+            return (path, max([s.st_mtime_ns for s in stats], default=0),
+                    sum(s.st_size for s in stats))
+        stat = os.stat(path)
+        return path, stat.st_mtime_ns, stat.st_size
+
+    def load(self, path, window, read):
+        """Grid of a file, read using read if it is not in the cache
+
+        Parameters
+        ----------
+        path : str | pathlib.Path
+            Path of the grid file.
+        window : hashable
+            Read window, and any other option which changes the result of
+            read (eg the type the grid is cast to).
+        read : callable
+            Function without arguments returning the grid as numpy array.
+
+        Returns
+        -------
+        numpy.ndarray
+            The grid, which is read-only if caching is enabled.
+        """
+        if self.maxbytes <= 0:
+            return read()
+
+        key = self._stat(path) + (window,)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        # reading is done outside the lock, so other files can be read in
+        # parallel
+        array = read()
+        if array.nbytes > self.maxbytes:
+            return array
+        array.flags.writeable = False
+
+        with self._lock:
+            self._entries[key] = array
+            nbytes = sum(a.nbytes for a in self._entries.values())
+            while nbytes > self.maxbytes:
+                _, removed = self._entries.popitem(last=False)
+                nbytes -= removed.nbytes
+        return array
+
+    def invalidate(self, path=None):
+        """Remove grids from the cache
+
+        Parameters
+        ----------
+        path : str, optional
+            Only remove the grids read from this file. By default all grids
+            are removed.
+        """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                return
+            path = os.path.abspath(os.fspath(path))
+            for key in list(self._entries):
+                if key[0] == path:
+                    del self._entries[key]
+
+
+input_raster_cache = InputRasterCache()
@@ -1,4 +1,5 @@
 from textwrap import dedent
+import copy
 import warnings
 
 from affine import Affine
@@ -236,7 +237,7 @@ class SpatialContext(object):
             window[0][0] < 0
             or window[1][0] < 0
             or window[1][1] > new_sc.width
-            or window[1][0] > new_sc.height
+            or window[0][1] > new_sc.height
         ):
 
             raise SpatialContextError(
@@ -246,6 +247,53 @@ class SpatialContext(object):
 
         return window
 
+    def windows(self, tile_size):
+        """Iterates over the blocks of the grid
+
+        Parameters
+        ----------
+        tile_size : int
+            Maximal width and height (number of cells) of a block.
+
+        Yields
+        ------
+        window : tuple
+            ((row_start, row_stop), (col_start, col_stop)) of every block,
+            row by row. This is the same format as get_read_window.
+        """
+        if tile_size < 1:
+            raise SpatialContextError("tile_size must be a positive number")
+
+        for row in range(0, self.height, tile_size):
+            for col in range(0, self.width, tile_size):
+                yield (
+                    (row, min(row + tile_size, self.height)),
+                    (col, min(col + tile_size, self.width)),
+                )
+
+    def subset(self, window):
+        """SpatialContext of a window of the current grid
+
+        Parameters
+        ----------
+        window : tuple
+            ((row_start, row_stop), (col_start, col_stop)) inside the grid.
+
+        Returns
+        -------
+        SpatialContext
+            Spatial context covering only the window. Read windows for
+            input files can be determined using get_read_window.
+        """
+        (row_start, row_stop), (col_start, col_stop) = window
+        sc = copy.copy(self)
+        sc.transform = self.transform * self.transform.translation(
+            col_start, row_start
+        )
+        sc.width = int(col_stop - col_start)
+        sc.height = int(row_stop - row_start)
+        return sc
+
     @property
     def cell_area(self):
         return abs(self.transform[0] * self.transform[4])
@@ -1,17 +1,11 @@
 import logging
 import warnings
-from collections import defaultdict
 from pathlib import Path
 
-with warnings.catch_warnings():
-    warnings.filterwarnings("ignore", category=DeprecationWarning)
-    warnings.filterwarnings("ignore", category=UserWarning)
-    import geopandas as gpd
-
 import numpy as np
 import pandas as pd
 
-from niche_vlaanderen.niche import Niche
+from niche_vlaanderen.niche import Niche, _read_map
 from niche_vlaanderen.codetables import package_resource
 
 logger = logging.getLogger(__name__)
@@ -59,15 +53,33 @@ class NicheValidation(object):
             More details in
             https://inbo.github.io/niche_vlaanderen/validation.html
 
+        coverage: bool
+            optional, use the exact fraction of every niche cell covered by a
+            polygon of the vegetation map instead of upscaling the niche rasters.
+            This is more accurate and faster than upscaling, upscale is ignored.
+            Defaults to False.
+
         id: str
             (optional) field to use as id for the provided map file. This id will
             be used in the overlay. If no id is supplied, the shape_index (row number)
             of the vector file will be used, starting from 0.
 
+        filter_extent: bool
+            optional, only read the polygons of the map intersecting the extent of
+            the niche model. Polygons outside the extent are not part of the
+            tables. Defaults to True.
+
+        use_arrow: bool
+            optional, read the map using the Arrow interface of pyogrio, which
+            is faster for large maps. Requires pyogrio and pyarrow
+            (pip install niche_vlaanderen[arrow]).
+            Defaults to False.
+
 
     """
 
-    def __init__(self, niche, map, mapping_file=None, upscale=5, id=None):
+    def __init__(self, niche, map, mapping_file=None, upscale=5, id=None,
+                 coverage=False, filter_extent=True, use_arrow=False):
         if type(niche) is Niche:
             self.niche = niche
         else:
@@ -76,7 +88,10 @@ class NicheValidation(object):
             )
 
         self.filename_map = map
-        self.map = gpd.read_file(map)
+        extent = None
+        if filter_extent and self.niche._context is not None:
+            extent = self.niche._context.extent
+        self.map = _read_map(map, extent=extent, use_arrow=use_arrow)
 
         # Prevent wrong mapping of HAB strings to floats
         self.map[[col for col in self.map.columns if col.startswith("HAB")]] = self.map[
@@ -115,6 +130,8 @@ class NicheValidation(object):
         self.map = self.map.drop(columns=niche_columns)
         self.map["area_shape"] = self.map.area / 10000
 
+        # the merges renumber the rows, the index is the row number in the file
+        index = self.map.index
         for hab_column in vegetation_columns:
             for nich_column in self.mapping.columns[
                 self.mapping.columns.str.startswith("NICHE_C")
@@ -129,10 +146,11 @@ class NicheValidation(object):
 
                 self.map = pd.merge(self.map, source, on=hab_column, how="left")
 
+        self.map.index = index
         self._niche_columns = self.map.columns[self.map.columns.str.startswith("NICH")]
 
         self.id = id
-        self.overlay(upscale=upscale)
+        self.overlay(upscale=upscale, coverage=coverage)
 
     def __repr__(self):
 
@@ -141,7 +159,7 @@ class NicheValidation(object):
         o += f"niche object: {self.niche.name}"
         return o
 
-    def overlay(self, upscale=5):
+    def overlay(self, upscale=5, coverage=False):
         """Overlays the map and the niche object"""
 
         # Remove any existing "NICH" columns
@@ -151,6 +169,11 @@ class NicheValidation(object):
         present_vegetation_types = present_vegetation_types[
             ~np.isnan(present_vegetation_types)
         ]
+        # only the vegetation types calculated by the niche model can be
+        # validated (eg when running a subset using vegetation_types)
+        present_vegetation_types = [
+            vi for vi in present_vegetation_types if vi in self.niche._vegetation
+        ]
         logger.debug(f"present niche types: {present_vegetation_types}")
 
         if len(present_vegetation_types) == 0:
@@ -164,8 +187,16 @@ class NicheValidation(object):
             outside=False,
             vegetation_types=present_vegetation_types,
             upscale=upscale,
+            coverage=coverage,
         )
 
+        # shape_id of the zonal statistics is the position in the map
+        self.potential_presence["shape_id"] = self.map.index[
+            self.potential_presence["shape_id"]
+        ]
+        areas = self.potential_presence.set_index(
+            ["shape_id", "vegetation", "presence"])["area_ha"].unstack("presence")
+
         self.potential_presence = self.potential_presence.pivot(
             columns=["vegetation"], index=["presence", "shape_id"]
         )
@@ -180,55 +211,58 @@ class NicheValidation(object):
             "veg_present",
         ]
 
-        self.area_pot = self.potential_presence.loc["no data"]["area_ha"] * np.nan
-        self.area_nonpot = self.potential_presence.loc["no data"]["area_ha"] * np.nan
-        self.area_effective = self.potential_presence.loc["no data"]["area_ha"] * np.nan
-        self.area_pot_perc = self.potential_presence.loc["no data"]["area_ha"] * np.nan
-        self.area_pot_perc_phab = self.area_pot_perc * np.nan
-        self.area_nonpot_phab = self.area_pot_perc * np.nan
-        self.veg_present = self.area_pot_perc * 0
+        # different mappings can exist which lead to the same vegetation
+        # type. First we aggregate them in shape_veg which contains the pHAB
+        # of every niche vegetation per shape (long format)
+        shape_veg = pd.concat(
+            [
+                pd.DataFrame(
+                    {
+                        "shape_id": self.map.index,
+                        "vegetation": self.map[veg],
+                        "pHab": self.map[self.proportion_columns[veg[5]]],
+                    }
+                )
+                for veg in self._niche_columns
+            ],
+            ignore_index=True,
+        )
+        shape_veg = shape_veg[
+            np.isfinite(shape_veg["vegetation"]) & (shape_veg["vegetation"] != 0)
+        ]
+        shape_veg = shape_veg.astype({"vegetation": int})
+        groups = shape_veg.groupby(["shape_id", "vegetation"])
+        # pHab is summed in the order of the niche columns (as a missing
+        # pHab makes the sum missing)
+        pHab = np.zeros(groups.ngroups)
+        np.add.at(pHab, groups.ngroup().to_numpy(), shape_veg["pHab"].to_numpy())
 
         # Only if actual present: (pHAB * present) / (present + not present)
-        for i, row in self.map.iterrows():
-            logger.debug(f"row: {row.area_shape}")
-            # different mappings can exist which lead to the same vegetation
-            # type. First we aggregate them in shape_veg which contains
-            # the niche vegetation and the sum of its pHAB
-            shape_veg = defaultdict(lambda: 0)
-
-            for veg in self._niche_columns:
-                if np.isfinite(row[veg]) and row[veg] != 0:
-                    pHab = row[self.proportion_columns[veg[5]]]
-                    shape_veg[int(row[veg])] += pHab
-
-            for veg in shape_veg:
-                pHab = shape_veg[veg]
-
-                area_pot = (
-                    self.potential_presence.loc["present"].loc[i].loc["area_ha"][veg]
-                )
+        shape_veg = pd.DataFrame({"pHab": pHab}, index=groups.size().index).join(
+            areas
+        )
+        area_pot = shape_veg["present"]
+        area_nonpot = shape_veg["not present"]
+        area_effective = shape_veg["pHab"] * (area_pot + area_nonpot) / 100
+        # vegetation type is present (actual presence) used in polygon count
+        overlap = (area_pot + area_nonpot) != 0
+        for i, veg in shape_veg.index[~overlap]:
+            warnings.warn(
+                f"No overlap between potential vegetation map and "
+                f"shape_id {i}"
+            )
 
-                self.area_pot.loc[i, veg] = area_pot
+        # convert to wide format, with a row for every shape and a column for
+        # every niche vegetation type present on the map
+        template = self.potential_presence.loc["no data"]["area_ha"] * np.nan
 
-                area_nonpot = (
-                    self.potential_presence.loc["not present"]
-                    .loc[i]
-                    .loc["area_ha"][veg]
-                )
+        def wide(values):
+            return values.unstack("vegetation").reindex_like(template)
 
-                self.area_nonpot.loc[i, veg] = area_nonpot
-                area_effective = pHab * (area_pot + area_nonpot) / 100
-                self.area_effective.loc[i, veg] = area_effective
-
-                if (area_pot + area_nonpot) == 0:
-                    warnings.warn(
-                        f"No overlap between potential vegetation map and "
-                        f"shape_id {i}"
-                    )
-                else:
-                    # vegetation type is present (actual presence)
-                    # used in polygon count
-                    self.veg_present.loc[i, veg] = 1
+        self.area_pot = wide(area_pot)
+        self.area_nonpot = wide(area_nonpot)
+        self.area_effective = wide(area_effective)
+        self.veg_present = wide(overlap[overlap].astype(float))
 
         # aggregate statistics
         self.area_pot_perc = 100 * self.area_pot / (self.area_pot + self.area_nonpot)
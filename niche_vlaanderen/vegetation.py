@@ -1,12 +1,14 @@
 from __future__ import division
+from collections.abc import Mapping
 from enum import IntEnum
-import warnings
 
 import numpy as np
 import pandas as pd
 
 from niche_vlaanderen.codetables import (validate_tables_vegetation,
-                                         check_codes_used, package_resource)
+                                         check_codes_used, package_resource,
+                                         code_table_cache, code_index,
+                                         broadcast_base, CodeTableException)
 from niche_vlaanderen.exception import NicheException
 
 
@@ -46,6 +48,264 @@ class VegSuitable(IntEnum):
         return {i: legend[i] for i in sel}
 
 
+_accept_suitable = {
+    "nutrient_level": VegSuitable.NUTRIENT,
+    "acidity": VegSuitable.ACIDITY,
+    "management": VegSuitable.MANAGEMENT,
+    "inundation": VegSuitable.FLOODING,
+}
+
+
+class VegetationPresence(Mapping):
+    """Presence grids of all vegetation types packed into bit planes
+
+    The presence of every vegetation type is stored as a single bit of a
+    uint32 plane (32 vegetation types per plane), together with one nodata
+    mask shared by all vegetation types: 5 bytes per cell instead of the 28 of
+    a uint8 grid per vegetation type.
+
+    The object behaves as a read-only dict with the veg_code as key: the
+    uint8 grid of a vegetation type (0: not present, 1: present, 255: nodata)
+    is unpacked when it is requested.
+
+    Parameters
+    ----------
+    veg_codes : list
+        Vegetation types, in the order of their bits.
+    bits : numpy.ndarray, numpy.uint32
+        Bit planes, with shape (number of planes, ) + grid shape.
+    nodata : numpy.ndarray, bool
+        Nodata mask with the grid shape.
+    """
+
+    dtype = "uint8"
+    nodata_value = 255
+
+    def __init__(self, veg_codes, bits, nodata):
+        self.veg_codes = list(veg_codes)
+        self._bit = {veg_code: i for i, veg_code in enumerate(self.veg_codes)}
+        self.bits = bits
+        self.nodata = nodata
+
+    @classmethod
+    def empty(cls, veg_codes, nodata, capacity=None):
+        """Presence grids without any vegetation present
+
+        Bits are allocated for capacity vegetation types (by default the
+        number of veg_codes), so vegetation types can be added later on.
+        """
+        if capacity is None:
+            capacity = len(veg_codes)
+        planes = max(1, -(-capacity // 32))
+        return cls(veg_codes, np.zeros((planes,) + nodata.shape, dtype=np.uint32),
+                   nodata)
+
+    @classmethod
+    def concatenate(cls, blocks):
+        """Join presence grids of blocks of rows into a single grid"""
+        veg_codes = blocks[0].veg_codes
+        for block in blocks:
+            if block.veg_codes != veg_codes:
+                # vegetation types missing in a block are not present there
+                veg_codes = sorted(set(veg_codes) | set(block.veg_codes))
+        if any(block.veg_codes != veg_codes for block in blocks):
+            blocks = [block.reorder(veg_codes) for block in blocks]
+        return cls(veg_codes,
+                   np.concatenate([block.bits for block in blocks], axis=1),
+                   np.concatenate([block.nodata for block in blocks]))
+
+    def reorder(self, veg_codes):
+        """Presence grids with the bits in the order of veg_codes"""
+        result = VegetationPresence.empty(veg_codes, self.nodata)
+        for veg_code in self.veg_codes:
+            result.set(veg_code, self.present(veg_code))
+        return result
+
+    def take(self, index):
+        """Presence grids of the cells index (eg to scatter unique values)"""
+        return VegetationPresence(self.veg_codes, self.bits[:, index],
+                                  self.nodata[index])
+
+    def add(self, veg_code, present):
+        """Add a vegetation type using the next free bit"""
+        i = len(self.veg_codes)
+        if i // 32 >= len(self.bits):
+            raise ValueError("No free bit for vegetation type %s" % veg_code)
+        self.veg_codes.append(veg_code)
+        self._bit[veg_code] = i
+        self.set(veg_code, present)
+
+    def set(self, veg_code, present):
+        """Set the presence (bool grid) of a vegetation type"""
+        i = self._bit[veg_code]
+        self.bits[i // 32] |= present.astype(np.uint32) << np.uint32(i % 32)
+
+    def present(self, veg_code):
+        """Bool grid, True where the vegetation type is present"""
+        i = self._bit[veg_code]
+        return (self.bits[i // 32] & np.uint32(1 << (i % 32))) != 0
+
+    def count(self, veg_code):
+        """Number of cells where the vegetation type is present"""
+        return int(np.count_nonzero(self.present(veg_code)))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes + self.nodata.nbytes
+
+    def __getitem__(self, veg_code):
+        grid = self.present(veg_code).astype(self.dtype)
+        grid[self.nodata] = self.nodata_value
+        return grid
+
+    def __iter__(self):
+        return iter(self.veg_codes)
+
+    def __len__(self):
+        return len(self.veg_codes)
+
+
+def _unique_combinations(arrays):
+    """Unique combinations of the values of a number of grids
+
+    The values of every grid are converted to a dense integer code, which are
+    packed into a single int64 key per cell.
+
+    Parameters
+    ----------
+    arrays : dict
+        Grids with the same (or a broadcastable) shape.
+
+    Returns
+    -------
+    unique : dict
+        1d arrays with the values of every unique combination.
+    inverse : numpy.ndarray
+        Index of the unique combination of every cell, with the grid shape.
+    """
+    shape = np.broadcast_shapes(*(np.shape(a) for a in arrays.values()))
+    key = np.zeros(shape, dtype=np.int64)
+    radix = 1
+    for values in arrays.values():
+        if broadcast_base(values).size == 1:
+            continue  # constant values do not change the key
+        if values.dtype == np.uint8:
+            codes, n = values, 256
+        else:
+            unique, codes = np.unique(values, return_inverse=True)
+            codes, n = codes.reshape(np.shape(values)), len(unique)
+        if radix * n >= 2 ** 62:
+            # renumber the combinations found so far to make room
+            unique, key = np.unique(key, return_inverse=True)
+            key, radix = key.reshape(shape), len(unique)
+        key = key * n + codes
+        radix *= n
+
+    _, index, inverse = np.unique(key, return_index=True, return_inverse=True)
+    index = np.unravel_index(index, shape)
+    unique = {
+        name: np.broadcast_to(values, shape)[index]
+        for name, values in arrays.items()
+    }
+    return unique, inverse.reshape(shape)
+
+
+class VegetationLookup(object):
+    """Vegetation code table compiled into lookup arrays
+
+    The code table is reduced to one entry per vegetation type and soil code,
+    containing the mhw/mlw interval and the accepted nutrient_level, acidity,
+    management and inundation codes. Classifying a grid then is a gather by
+    soil code for every vegetation type, independent of the number of rows in
+    the code table.
+
+    Parameters
+    ----------
+    ct_vegetation: pandas.DataFrame
+        Vegetation code table, with soil_name already joined to soil_code.
+    """
+
+    def __init__(self, ct_vegetation):
+        self.veg_codes = np.unique(ct_vegetation["veg_code"])
+        self.soil_codes = np.unique(ct_vegetation["soil_code"])
+        veg_i = np.searchsorted(self.veg_codes, ct_vegetation["veg_code"])
+        soil_i = np.searchsorted(self.soil_codes, ct_vegetation["soil_code"])
+
+        # the last soil column is used for soil codes not in the code table
+        shape = (len(self.veg_codes), len(self.soil_codes) + 1)
+
+        self.soil = np.zeros(shape, dtype=bool)
+        self.soil[veg_i, soil_i] = True
+
+        self.interval = dict()
+        for col in ["mhw_min", "mhw_max", "mlw_min", "mlw_max"]:
+            values = np.full(shape, np.nan)
+            values[veg_i, soil_i] = ct_vegetation[col]
+            # only one mhw/mlw interval is allowed per veg_code and soil_code
+            if not np.array_equal(values[veg_i, soil_i], ct_vegetation[col]):
+                raise CodeTableException("Non unique mhw/mlw combinations")
+            self.interval[col] = values
+
+        self.accept = dict()
+        for col in _accept_suitable:
+            codes = np.unique(ct_vegetation[col])
+            code_i = np.searchsorted(codes, ct_vegetation[col])
+            table = np.zeros((shape[0], shape[1] * (len(codes) + 1)), dtype=bool)
+            table[veg_i, soil_i * (len(codes) + 1) + code_i] = True
+            self.accept[col] = codes, table
+
+    def soil_index(self, soil_code):
+        """Position of the soil codes in the lookup arrays"""
+        return code_index(soil_code, self.soil_codes)
+
+    def key(self, name, soil_index, values):
+        """Lookup key in the accept table of name for a soil/code combination"""
+        codes, _ = self.accept[name]
+        return soil_index * (len(codes) + 1) + code_index(values, codes)
+
+    def mxw(self, i, soil_index, mhw, mlw):
+        """Boolean array whether mhw and mlw are within the interval
+
+        Parameters
+        ----------
+        i: int
+            position of the vegetation type in veg_codes
+        soil_index: numpy.ndarray
+            soil index as returned by soil_index
+        mhw, mlw: numpy.ndarray
+            mean high and low water level
+        """
+        bound = self.bound
+        with np.errstate(invalid="ignore"):
+            return (
+                (bound("mhw_min", i, soil_index, mhw) <= mhw)
+                & (bound("mhw_max", i, soil_index, mhw) >= mhw)
+                & (bound("mlw_min", i, soil_index, mlw) <= mlw)
+                & (bound("mlw_max", i, soil_index, mlw) >= mlw)
+            )
+
+    def bound(self, col, i, soil_index, values):
+        """Interval bound col per cell, in the precision of values"""
+        dtype = np.asarray(values).dtype
+        dtype = dtype if dtype.kind == "f" else np.float64
+        return self.interval[col][i].astype(dtype)[soil_index]
+
+    def deviation(self, name, i, soil_index, values):
+        """Distance of values (mhw or mlw) to the interval of a vegetation type
+
+        Positive values are too dry (above the maximum), negative values too
+        wet (below the minimum), zero is inside the interval. Cells with a soil
+        code not allowed for the vegetation type are nan.
+        """
+        minimum = self.bound(name + "_min", i, soil_index, values)
+        maximum = self.bound(name + "_max", i, soil_index, values)
+        # the minimum takes precedence, as in the row based calculation
+        nearest = np.minimum(values, maximum)
+        np.maximum(nearest, minimum, out=nearest)
+        nearest -= values
+        return nearest
+
+
 class Vegetation(object):
     """Calculate vegetation based on input arrays
 
@@ -119,6 +379,25 @@ class Vegetation(object):
             ct_inundation = package_resource(["system_tables"],
                                              "inundation.csv")
 
+        code_table_cache.load(self, self._read_code_tables, dict(
+            ct_vegetation=ct_vegetation,
+            ct_soil_code=ct_soil_code,
+            ct_acidity=ct_acidity,
+            ct_management=ct_management,
+            ct_nutrient_level=ct_nutrient_level,
+            ct_inundation=ct_inundation,
+        ))
+
+    def _read_code_tables(
+        self,
+        ct_vegetation,
+        ct_soil_code,
+        ct_acidity,
+        ct_management,
+        ct_nutrient_level,
+        ct_inundation,
+    ):
+        """Read, validate and compile the code tables"""
         self._ct_vegetation = pd.read_csv(ct_vegetation)
         self._ct_soil_code = pd.read_csv(ct_soil_code)
         self._ct_acidity = pd.read_csv(ct_acidity)
@@ -148,6 +427,37 @@ class Vegetation(object):
             .soil_code
         )
 
+        self._lookup = VegetationLookup(self._ct_vegetation)
+
+    def nodata_mask(
+        self,
+        soil_code,
+        mhw,
+        mlw,
+        nutrient_level=None,
+        acidity=None,
+        management=None,
+        inundation=None,
+        full_model=True,
+    ):
+        """Combined nodata mask of the input arrays used by calculate
+
+        Parameters are the same as for calculate.
+
+        Returns
+        -------
+        numpy.ndarray, bool
+            True where no vegetation can be predicted.
+        """
+        nodata = (soil_code == 255) | np.isnan(mhw) | np.isnan(mhw)
+        if full_model:
+            nodata |= (nutrient_level == 255) | (acidity == 255)
+        if inundation is not None:
+            nodata |= (inundation == 255)
+        if management is not None:
+            nodata |= (management == 255)
+        return nodata
+
     def calculate(
         self,
         soil_code,
@@ -159,6 +469,8 @@ class Vegetation(object):
         inundation=None,
         return_all=True,
         full_model=True,
+        deduplicate=False,
+        vegetation_types=None,
     ):
         """Calculate vegetation types based on input arrays
 
@@ -187,25 +499,37 @@ class Vegetation(object):
             only grids containing data.
         full_model : bool
             If True, the full niche model is applied
+        deduplicate : bool
+            Determine the unique combinations of the input values first and
+            only apply the vegetation rules to these. This is faster if large
+            areas have the same input values. The result is the same.
+        vegetation_types : list | None
+            Only calculate these vegetation types (veg_code). By default all
+            vegetation types of the code table are calculated.
 
         Returns
         -------
-        veg: dict
-            A dictionary containing the different output arrays per veg_code value.
+        veg: VegetationPresence
+            A read-only dictionary containing the different output arrays per
+            veg_code value. The arrays are stored as packed bits and unpacked
+            when they are requested.
         expected: int
             Expected code in veg arrays if all conditions are met
         veg_occurrence: dict
             A dictionary containing the percentage of the area where the
             vegetation can occur.
         """
-        # Create combined mask from all input arrays
-        nodata = (soil_code == 255) | np.isnan(mhw) | np.isnan(mhw)
-        if full_model:
-            nodata |= (nutrient_level == 255) | (acidity == 255)
-        if inundation is not None:
-            nodata |= (inundation == 255)
-        if management is not None:
-            nodata |= (management == 255)
+        selected = self._select(vegetation_types)
+        if deduplicate:
+            return self._calculate_unique(
+                return_all=return_all, full_model=full_model,
+                vegetation_types=vegetation_types,
+                soil_code=soil_code, mhw=mhw, mlw=mlw,
+                nutrient_level=nutrient_level, acidity=acidity,
+                management=management, inundation=inundation)
+
+        nodata = self.nodata_mask(soil_code, mhw, mlw, nutrient_level, acidity,
+                                  management, inundation, full_model)
 
         if np.all(nodata):
             raise NicheException("Only nodata values in prediction")
@@ -224,77 +548,106 @@ class Vegetation(object):
             check_codes_used("management", management,
                              self._ct_management["management"])
 
-        veg_bands = dict()
         veg_detail = dict()
         occurrence = dict()
 
-        for veg_code, subtable in self._ct_vegetation.groupby("veg_code"):
-            subtable = subtable.reset_index()
-            # vegi is the prediction for the current veg_code
-            # it is a logical or of the result of every row:
-            # if a row is 0 for a pixel, that vegetation can occur
-
-            vegi = np.zeros(soil_code.shape, dtype="int64")
-
-            # expected code if all conditions are met
-            expected = VegSuitable.SOIL + VegSuitable.MXW
-            if full_model:
-                expected += (
-                    VegSuitable.NUTRIENT
-                    + VegSuitable.ACIDITY
-                    + (inundation is not None) * VegSuitable.FLOODING
-                    + (management is not None) * VegSuitable.MANAGEMENT
-                )
-
-            # filter for GxG
-            for row in subtable.itertuples():
-                warnings.simplefilter(action="ignore", category=RuntimeWarning)
-                row_soil = row.soil_code == soil_code
-                vegi |= row_soil * VegSuitable.SOIL
-
-                current_row = (
-                        row_soil
-                        & (row.mhw_min <= mhw)
-                        & (row.mhw_max >= mhw)
-                        & (row.mlw_min <= mlw)
-                        & (row.mlw_max >= mlw)
-                )
-
-                vegi |= current_row * VegSuitable.MXW
-                warnings.simplefilter("default")
-                if full_model:
-                    vegi |= (
-                        current_row & (nutrient_level == row.nutrient_level)
-                    ) * VegSuitable.NUTRIENT
-                    vegi |= (
-                        current_row & (acidity == row.acidity)
-                    ) * VegSuitable.ACIDITY
-
-                if inundation is not None:
-                    vegi |= (
-                        current_row & (row.inundation == inundation)
-                    ) * VegSuitable.FLOODING
-                if management is not None:
-                    vegi |= (
-                        current_row & (row.management == management)
-                    ) * VegSuitable.MANAGEMENT
+        # expected code if all conditions are met
+        expected = VegSuitable.SOIL + VegSuitable.MXW
+        if full_model:
+            expected += (
+                VegSuitable.NUTRIENT
+                + VegSuitable.ACIDITY
+                + (inundation is not None) * VegSuitable.FLOODING
+                + (management is not None) * VegSuitable.MANAGEMENT
+            )
+
+        # the code arrays are converted to lookup keys only once, they are
+        # shared by all vegetation types
+        lookup = self._lookup
+        soil_index = lookup.soil_index(soil_code)
+        keys = dict()
+        if full_model:
+            keys["nutrient_level"] = lookup.key(
+                "nutrient_level", soil_index, nutrient_level)
+            keys["acidity"] = lookup.key("acidity", soil_index, acidity)
+        if inundation is not None:
+            keys["inundation"] = lookup.key("inundation", soil_index, inundation)
+        if management is not None:
+            keys["management"] = lookup.key("management", soil_index, management)
+
+        # the presence is packed into the bit planes per vegetation type, so
+        # at most one bool grid is unpacked at a time
+        veg_bands = VegetationPresence.empty([], nodata, capacity=len(selected))
+        nodata_count = np.sum(nodata)
+        for i, veg_code in selected:
+            # vegi is the prediction for the current veg_code, every bit is
+            # set if the condition is met for any row of the code table
+            row_soil = lookup.soil[i][soil_index]
+            current_row = row_soil & lookup.mxw(i, soil_index, mhw, mlw)
+
+            vegi = row_soil * np.uint8(VegSuitable.SOIL)
+            vegi |= current_row * np.uint8(VegSuitable.MXW)
+            for name, key in keys.items():
+                vegi |= (
+                    current_row & lookup.accept[name][1][i][key]
+                ) * np.uint8(_accept_suitable[name])
 
             vegi = vegi.astype("uint8")
             vegi[nodata] = self.nodata
 
+            # nodata cells never have the expected value
             vegi_summary = vegi == expected
-            vegi_summary = vegi_summary.astype("uint8")
-            vegi_summary[nodata] = self.nodata
-
             if return_all or np.any(vegi):
-                veg_bands[veg_code] = vegi_summary
+                veg_bands.add(veg_code, vegi_summary)
             veg_detail[veg_code] = vegi
 
-            occi = np.sum(vegi_summary == 1) / (vegi_summary.size - np.sum(nodata))
+            occi = np.sum(vegi_summary) / (vegi_summary.size - nodata_count)
             occurrence[veg_code] = occi.item()
+
         return veg_bands, occurrence, veg_detail
 
-    def calculate_deviation(self, soil_code, mhw, mlw):
+    def _select(self, vegetation_types):
+        """Position in the lookup arrays and veg_code of the vegetation types"""
+        veg_codes = self._lookup.veg_codes.tolist()
+        if vegetation_types is None:
+            return list(enumerate(veg_codes))
+
+        unknown = set(vegetation_types) - set(veg_codes)
+        if len(unknown) > 0:
+            raise NicheException(
+                "Unknown vegetation types %s, possible values are %s"
+                % (sorted(unknown), veg_codes))
+        if len(vegetation_types) == 0:
+            raise NicheException("No vegetation types selected")
+        return [(i, veg_code) for i, veg_code in enumerate(veg_codes)
+                if veg_code in vegetation_types]
+
+    def _calculate_unique(self, return_all, full_model, vegetation_types,
+                          **arrays):
+        """Calculate for the unique combinations of the input arrays"""
+        if not full_model:
+            arrays["nutrient_level"] = arrays["acidity"] = None
+        arrays = {k: np.asarray(v) for k, v in arrays.items() if v is not None}
+        unique, inverse = _unique_combinations(arrays)
+
+        veg_bands, _, veg_detail = self.calculate(
+            return_all=return_all, full_model=full_model,
+            vegetation_types=vegetation_types, **unique)
+        veg_bands = veg_bands.take(inverse)
+        veg_detail = {k: v[inverse] for k, v in veg_detail.items()}
+
+        # occurrence is calculated on the grid, the same way as calculate does
+        nodata = np.sum(veg_bands.nodata)
+        occurrence = dict()
+        for veg_code in veg_detail:
+            if veg_code in veg_bands:
+                occi = veg_bands.count(veg_code) / (veg_bands.nodata.size - nodata)
+                occurrence[veg_code] = float(occi)
+            else:
+                occurrence[veg_code] = 0.0
+        return veg_bands, occurrence, veg_detail
+
+    def calculate_deviation(self, soil_code, mhw, mlw, vegetation_types=None):
         """Calculates the deviation between the mhw/mlw and the reference
 
         This function calculates the difference between the mhw and mlw and
@@ -315,6 +668,9 @@ class Vegetation(object):
             Array containing the mean high waterlevel.
         mlw : numpy.ndarray, numpy.float32
             Array containing the mean low waterlevel.
+        vegetation_types : list | None
+            Only calculate the deviation for these vegetation types (veg_code).
+            By default all vegetation types of the code table are used.
 
         Returns
         -------
@@ -325,59 +681,19 @@ class Vegetation(object):
         """
         nodata = (soil_code == 255) | np.isnan(mhw) | np.isnan(mhw)
 
+        # the soil codes are converted to lookup positions only once, the
+        # deviation is then a single pass per vegetation type and variable
+        selected = self._select(vegetation_types)
+        lookup = self._lookup
+        soil_index = lookup.soil_index(soil_code)
+
         difference = dict()
-        veg = self._ct_vegetation[
-            ["veg_code", "soil_code", "mhw_min", "mhw_max", "mlw_min", "mlw_max"]
-        ]
-
-        veg = veg.drop_duplicates()
-
-        warnings.simplefilter(action="ignore", category=RuntimeWarning)
-        for veg_code, subtable in veg.groupby("veg_code"):
-            subtable = subtable.reset_index()
-
-            mhw_diff = np.full(soil_code.shape, np.nan, dtype="float32")
-            mlw_diff = np.full(soil_code.shape, np.nan, dtype="float32")
-
-            for row in subtable.itertuples():
-                # mhw smaller than maximum
-                selection = (row.soil_code == soil_code) & (row.mhw_max < mhw)
-                mhw_diff[selection] = -(mhw - row.mhw_max)[selection]
-
-                # mhw larger than minimum
-                selection = (row.soil_code == soil_code) & (row.mhw_min > mhw)
-                mhw_diff[selection] = -(mhw - row.mhw_min)[selection]
-
-                # mhw in range
-                selection = (
-                    (row.soil_code == soil_code)
-                    & (row.mhw_min <= mhw)
-                    & (row.mhw_max >= mhw)
-                )
-                zero_arr = np.zeros(soil_code.shape)
-                mhw_diff[selection] = zero_arr[selection]
-
-                # mlw smaller than maximum
-                selection = (row.soil_code == soil_code) & (row.mlw_max < mlw)
-                mlw_diff[selection] = -(mlw - row.mlw_max)[selection]
-
-                # mlw larger than minimum
-                selection = (row.soil_code == soil_code) & (row.mlw_min > mlw)
-                mlw_diff[selection] = -(mlw - row.mlw_min)[selection]
-
-                # mlw in range
-                selection = (
-                    (row.soil_code == soil_code)
-                    & (row.mlw_min <= mlw)
-                    & (row.mlw_max >= mlw)
-                )
-                mlw_diff[selection] = zero_arr[selection]
-
-            mhw_diff[nodata] = np.nan
-            mlw_diff[nodata] = np.nan
-
-            difference["mhw_%02d" % veg_code] = mhw_diff.astype("float32")
-            difference["mlw_%02d" % veg_code] = mlw_diff.astype("float32")
-
-        warnings.simplefilter("default")  # Reset to default warning level
+        with np.errstate(invalid="ignore"):
+            for i, veg_code in selected:
+                for name, values in [("mhw", mhw), ("mlw", mlw)]:
+                    diff = lookup.deviation(name, i, soil_index, values)
+                    diff = diff.astype("float32", copy=False)
+                    diff[nodata] = np.nan
+                    difference["%s_%02d" % (name, veg_code)] = diff
+
         return difference
@@ -22,6 +22,7 @@ requirements = [
         'rasterio',
         'pyyaml',
         'rasterstats>=0.17',
+        'shapely>=2',
         'tqdm',
         'geopandas'
         ]
@@ -34,6 +35,10 @@ setup(name='niche_vlaanderen',
     author_email='johan.vandewauw@inbo.be',
     license='MIT',
     install_requires=requirements,
+    extras_require={
+        'zarr': ['zarr>=3'],
+        'arrow': ['pyarrow'],
+    },
     packages=["niche_vlaanderen", "niche_vlaanderen.system_tables",
               "niche_vlaanderen.system_tables.flooding"],
     classifiers=[
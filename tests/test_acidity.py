@@ -1,4 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import pandas as pd
 import pytest
 
 import niche_vlaanderen
@@ -121,6 +124,46 @@ class TestAcidity:
         np.testing.assert_equal(np.array([3, 3, 255]), result)
         assert result.dtype == np.uint8
 
+    def test_acidity_lookup(self):
+        """Every row of lnk_acidity is found, other combinations give nodata"""
+        a = niche_vlaanderen.Acidity()
+        lnk = a._lnk_acidity.drop_duplicates(
+            ["rainwater", "mineral_richness", "inundation", "seepage",
+             "soil_mlw_class"])
+        columns = [lnk[k].values.astype("uint8") for k in [
+            "rainwater", "mineral_richness", "inundation", "seepage",
+            "soil_mlw_class"]]
+
+        result = a._get_acidity(*columns)
+        np.testing.assert_equal(lnk["acidity"].values, result)
+
+        # a soil_mlw_class which is not in the table
+        columns[-1] = np.full(columns[-1].shape, 200, dtype="uint8")
+        result = a._get_acidity(*columns)
+        assert np.all(result == 255)
+
+    def test_acidity_threads(self, zwarte_beek_data):
+        """One Acidity object can be used from several threads"""
+        n, (soil_code, _, _, mlw, inundation, rainwater, seepage, minerality,
+            _, _, _, management) = zwarte_beek_data
+        a = niche_vlaanderen.Acidity()
+        ct_seepage = a._ct_seepage.copy()
+        ct_soil_codes = a._ct_soil_codes.copy()
+        expected = a.calculate(soil_code, mlw, inundation, seepage, minerality,
+                               rainwater)
+
+        def calculate(i):
+            return a.calculate(soil_code, mlw, inundation, seepage, minerality,
+                               rainwater)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for result in executor.map(calculate, range(8)):
+                np.testing.assert_equal(expected, result)
+
+        # the code tables are not modified by calculate
+        pd.testing.assert_frame_equal(ct_seepage, a._ct_seepage)
+        pd.testing.assert_frame_equal(ct_soil_codes, a._ct_soil_codes)
+
     def test_acidity_testcase(self, path_testcase, zwarte_beek_data):
         """Correct acidity calculated for test case of the zwarte beek"""
 
@@ -46,3 +46,20 @@ def test_get_version():
     runner = CliRunner()
     result = runner.invoke(nv_cli.cli, ["--version"])
     assert "niche_vlaanderen version: " in result.output
+
+
+def test_cli_tile_size():
+    runner = CliRunner()
+    result = runner.invoke(nv_cli.cli, ["--tile-size", "4", "tests/small.yaml"])
+    assert result.exit_code == 0
+    assert "tile_size: 4" in result.output
+
+    with rasterio.open("_output/V01.tif") as f:
+        assert f.read(1).shape == (6, 7)
+
+
+def test_cli_workers():
+    runner = CliRunner()
+    result = runner.invoke(nv_cli.cli, ["--workers", "2", "tests/small.yaml"])
+    assert result.exit_code == 0
+    assert "workers: 2" in result.output
@@ -1,3 +1,6 @@
+import shutil
+
+import numpy as np
 import pandas as pd
 import pytest
 from unittest import TestCase
@@ -76,3 +79,49 @@ class TestCodeTables:
         badveg = path_testdata / "bad_ct" / "differentmlw.csv"
         with pytest.raises(CodeTableException):
             niche_vlaanderen.Vegetation(ct_vegetation=badveg)
+
+
+def test_code_table_cache(tmp_path, path_system_tables, path_testdata, monkeypatch):
+    cache = niche_vlaanderen.code_table_cache
+    monkeypatch.setattr(cache, "maxsize", 2)
+    cache.invalidate()
+
+    ct_seepage = tmp_path / "seepage.csv"
+    shutil.copy(path_system_tables / "seepage.csv", ct_seepage)
+
+    first = niche_vlaanderen.Acidity(ct_seepage=ct_seepage)
+    second = niche_vlaanderen.Acidity(ct_seepage=ct_seepage)
+    assert len(cache) == 1
+    pd.testing.assert_frame_equal(first._ct_seepage, second._ct_seepage)
+    # every object has its own copy of the tables
+    assert first._ct_seepage is not second._ct_seepage
+
+    # a changed table is read again
+    seepage = pd.read_csv(ct_seepage)
+    seepage.loc[0, "seepage_min"] = -100
+    seepage.to_csv(ct_seepage, index=False)
+    changed = niche_vlaanderen.Acidity(ct_seepage=ct_seepage)
+    assert changed._ct_seepage.loc[0, "seepage_min"] == -100
+    assert len(cache) == 2
+
+    # least recently used entries are removed
+    niche_vlaanderen.Acidity()
+    assert len(cache) == 2
+
+    cache.invalidate(ct_seepage)
+    assert len(cache) == 1
+    cache.invalidate()
+    assert len(cache) == 0
+
+    # validation errors are not cached, warnings are repeated
+    with pytest.raises(CodeTableException):
+        niche_vlaanderen.Vegetation(
+            ct_vegetation=path_testdata / "bad_ct" / "differentmlw.csv")
+    assert len(cache) == 0
+    for i in range(2):
+        with pytest.warns(UserWarning):
+            veg = niche_vlaanderen.Vegetation(
+                ct_vegetation=path_testdata / "bad_ct" / "vegetation_noinnerjoin.csv")
+    np.testing.assert_equal(
+        veg._lookup.veg_codes,
+        np.unique(veg._ct_vegetation.veg_code))
@@ -3,7 +3,9 @@ import niche_vlaanderen as nv
 import numpy as np
 import rasterio
 from niche_vlaanderen.flooding import FloodingException
+from niche_vlaanderen.exception import NicheException
 import pytest
+import yaml
 import os
 import tempfile
 import shutil
@@ -64,6 +66,34 @@ class TestFlooding:
         expected = np.array([-99, 0, 1, 2, 3, 4])
         np.testing.assert_equal(set(expected), set(unique))
 
+    def test_calculate_many(self, path_testcase, path_testdata):
+        depth_files = [path_testcase / "flooding" / "ff_bt_t10_h.asc",
+                       path_testdata / "depths_with_nodata.asc"]
+        scenarios = [
+            dict(depth_file_path=depth_files[0], frequency="T10",
+                 period="winter", duration=1),
+            dict(depth_file_path=depth_files[1], frequency="T2",
+                 period="summer", duration=2),
+            dict(depth_file_path=depth_files[0], frequency="T50",
+                 period="summer", duration=1),
+        ]
+        fp = nv.Flooding()
+        results = fp.calculate_many(scenarios)
+        assert len(results) == 3
+
+        for scenario, result in zip(scenarios, results):
+            expected = nv.Flooding()
+            expected.calculate(**scenario)
+            assert result.options == expected.options
+            assert result._context == expected._context
+            assert list(result._veg) == list(expected._veg)
+            for vi in expected._veg:
+                np.testing.assert_equal(expected._veg[vi], result._veg[vi])
+                assert result._veg[vi].dtype == np.int8
+
+        with pytest.raises(NicheException):
+            fp.calculate_many([dict(scenarios[0], frequency="T3")])
+
     def test_table(self, path_testcase):
         fp = nv.Flooding()
         with pytest.raises(FloodingException):
@@ -183,3 +213,30 @@ class TestFlooding:
         unique = np.unique(np.hstack(unique))
         expected = np.array([-1, 1, 2, 3, -99])
         np.testing.assert_equal(set(expected), set(unique))
+
+        # a model run for a subset of the vegetation types
+        myniche.run(vegetation_types=[7, 16])
+        subset = fp.combine(myniche)
+        assert list(subset._veg) == [7, 16]
+        np.testing.assert_equal(subset._veg[16], result._veg[16])
+
+    def test_combine_config_vegetation_types(self, tmp_path, path_tests):
+        """A config file combining flooding with selected vegetation types"""
+        with open(path_tests / "floodplain.yml") as f:
+            config = yaml.safe_load(f)
+        for key in config["input_layers"]:
+            value = config["input_layers"][key]
+            if isinstance(value, str):
+                config["input_layers"][key] = str(path_tests / value)
+        for scenario in config["flooding"]:
+            scenario["depth"] = str(path_tests / scenario["depth"])
+        config["model_options"].update(
+            vegetation_types=[7, 16], output_dir=str(tmp_path))
+        with open(tmp_path / "config.yml", "w") as f:
+            yaml.dump(config, f)
+
+        myniche = nv.Niche()
+        myniche.run_config_file(tmp_path / "config.yml")
+        assert list(myniche.fp._veg) == [7, 16]
+        assert (tmp_path / "T10-winter-F07-T10-P1-winter.tif").exists()
+        assert not (tmp_path / "T10-winter-F01-T10-P1-winter.tif").exists()
@@ -1,6 +1,7 @@
 from __future__ import division
 from collections import Counter
 import distutils.spawn
+import json
 import os
 import shutil
 import subprocess
@@ -12,6 +13,8 @@ from matplotlib.testing.decorators import image_comparison
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import rasterio
+import rasterstats
 from rasterio.errors import RasterioIOError
 
 import niche_vlaanderen
@@ -142,6 +145,16 @@ class TestNiche:
         myniche2.run()
         assert myniche.occurrence == myniche2.occurrence
 
+        # constant values are not expanded to a full grid
+        rainwater = myniche._inputarray["rainwater"]
+        assert rainwater.shape == myniche2._inputarray["rainwater"].shape
+        assert rainwater.strides == (0, 0)
+
+        # codes of constant values are still checked
+        myniche.set_input("management", 9)
+        with pytest.raises(NicheException):
+            myniche.run()
+
     def test_testcase_simple(self, tmp_path, path_testcase):
         """Check if the simple model runs succesfully with data from the
         testcase/zwarte_beek.
@@ -242,6 +255,275 @@ class TestNiche:
         assert 37 == myniche._context.width
         assert 37 == myniche._context.height
 
+    def test_tiled(self, tmp_path, zwarte_beek_niche):
+        """A tiled run writes the same grids and table as a normal run"""
+        myniche = zwarte_beek_niche()
+        myniche.run(deviation=True)
+        myniche.write(tmp_path / "full")
+
+        tiled = zwarte_beek_niche()
+        with pytest.raises(NicheException):
+            # an output folder is required
+            tiled.run(tile_size=50)
+        tiled.run(deviation=True, tile_size=50, output_dir=tmp_path / "tiled")
+
+        assert set(os.listdir(tmp_path / "full")) == set(
+            os.listdir(tmp_path / "tiled"))
+        for key in myniche._files_written:
+            if key in ("log", "summary"):
+                continue
+            with rasterio.open(myniche._files_written[key]) as full, \
+                    rasterio.open(tiled._files_written[key]) as block:
+                np.testing.assert_equal(full.read(1), block.read(1))
+
+        assert myniche.occurrence == tiled.occurrence
+        table = myniche.table.set_index(["vegetation", "presence"]).sort_index()
+        tiled_table = tiled.table.set_index(["vegetation", "presence"]).sort_index()
+        pd.testing.assert_frame_equal(table, tiled_table)
+
+        # results are not kept in memory
+        with pytest.raises(NicheException):
+            tiled.write(tmp_path / "again")
+
+    def test_tiled_after_run(self, tmp_path, zwarte_beek_niche):
+        """A tiled run discards the grids of a previous run in memory"""
+        myniche = zwarte_beek_niche()
+        myniche.run()
+        expected = myniche._table(detail=True)
+
+        myniche.run(tile_size=50, output_dir=tmp_path)
+        assert len(myniche._abiotic) == 0
+        assert len(myniche._vegetation_detail) == 0
+        detail = myniche._table(detail=True)
+        assert len(detail) == len(expected)
+        pd.testing.assert_frame_equal(
+            detail.set_index(["vegetation", "presence"]).sort_index(),
+            expected.set_index(["vegetation", "presence"]).sort_index())
+
+    def test_workers(self, tmp_path, zwarte_beek_niche):
+        """Running with several workers does not change the result"""
+        myniche = zwarte_beek_niche()
+        myniche.run(deviation=True)
+
+        parallel = zwarte_beek_niche()
+        parallel.run(deviation=True, workers=3)
+        assert myniche.occurrence == parallel.occurrence
+        for grids in ["_vegetation", "_vegetation_detail", "_abiotic", "_deviation"]:
+            expected = getattr(myniche, grids)
+            result = getattr(parallel, grids)
+            assert list(expected) == list(result)
+            for key in expected:
+                np.testing.assert_equal(expected[key], result[key])
+        pd.testing.assert_frame_equal(myniche.table, parallel.table)
+
+        tiled = zwarte_beek_niche()
+        tiled.run(tile_size=50, output_dir=tmp_path, workers=3)
+        with rasterio.open(tiled._files_written[1]) as f:
+            np.testing.assert_equal(myniche._vegetation[1], f.read(1))
+        assert myniche.occurrence == tiled.occurrence
+
+        with pytest.raises(NicheException):
+            parallel.run(workers=0)
+
+    def test_workers_calculators(self, tmp_path, zwarte_beek_niche, monkeypatch):
+        """All threads share the calculators created for the run"""
+        calls = []
+        calculators = niche_vlaanderen.Niche._calculators
+
+        def counted_calculators(self, full_model):
+            calls.append(full_model)
+            return calculators(self, full_model)
+
+        monkeypatch.setattr(niche_vlaanderen.Niche, "_calculators",
+                            counted_calculators)
+        myniche = zwarte_beek_niche()
+        myniche.run(workers=3)
+        assert calls == [True]
+
+        myniche.run(tile_size=50, output_dir=tmp_path, workers=3)
+        assert calls == [True, True]
+
+    def test_vegetation_types(self, tmp_path, zwarte_beek_niche):
+        """Only the selected vegetation types are calculated and written"""
+        myniche = zwarte_beek_niche()
+        myniche.run(deviation=True)
+
+        selected = zwarte_beek_niche()
+        selected.run(deviation=True, vegetation_types=[16, 4])
+        assert list(selected._vegetation) == list(selected.occurrence) == [4, 16]
+        assert list(selected._deviation) == ["mhw_04", "mlw_04", "mhw_16", "mlw_16"]
+        for vi in [4, 16]:
+            assert myniche.occurrence[vi] == selected.occurrence[vi]
+            np.testing.assert_equal(myniche._vegetation[vi], selected._vegetation[vi])
+        assert set(selected.table.vegetation) == {4, 16}
+        assert "vegetation_types:\n  - 4\n  - 16" in repr(selected)
+
+        selected.write(tmp_path / "selected")
+        assert 4 in selected._files_written
+        assert 1 not in selected._files_written
+        assert "mhw_16" in selected._files_written
+
+        with pytest.raises(NicheException):
+            selected.run(vegetation_types=[4, 29])
+
+    def test_incremental_run(self, path_testcase, zwarte_beek_niche, monkeypatch):
+        """A run after set_input only recalculates the results depending on it"""
+        input_dir = path_testcase / "zwarte_beek" / "input"
+        calls = []
+
+        def count(cls):
+            calculate = cls.calculate
+
+            def counted(self, *args, **kwargs):
+                calls.append(cls.__name__)
+                return calculate(self, *args, **kwargs)
+            monkeypatch.setattr(cls, "calculate", counted)
+
+        for cls in [niche_vlaanderen.NutrientLevel, niche_vlaanderen.Acidity]:
+            count(cls)
+        read = niche_vlaanderen.Niche.read_rasterio_to_grid
+
+        def counted_read(self, file_name, variable_name=None, context=None):
+            calls.append(variable_name)
+            return read(self, file_name, variable_name, context)
+        monkeypatch.setattr(niche_vlaanderen.Niche, "read_rasterio_to_grid",
+                            counted_read)
+
+        myniche = zwarte_beek_niche()
+        myniche.run(deviation=True)
+        assert calls.count("NutrientLevel") == calls.count("Acidity") == 1
+        deviation = myniche._deviation["mhw_04"]
+
+        calls.clear()
+        myniche.set_input("management_vegetation", input_dir / "management.asc")
+        assert not myniche.vegetation_calculated
+        myniche.run(deviation=True)
+        assert calls == ["management_vegetation"]
+        assert myniche._deviation["mhw_04"] is deviation
+
+        calls.clear()
+        myniche.set_input("seepage", 0)
+        myniche.run(deviation=True)
+        assert calls == ["Acidity"]
+
+        expected = zwarte_beek_niche()
+        expected.set_input("management_vegetation", input_dir / "management.asc")
+        expected.set_input("seepage", 0)
+        expected.run(deviation=True)
+        assert myniche.occurrence == expected.occurrence
+        for grids in ["_vegetation", "_abiotic", "_deviation"]:
+            for key in getattr(expected, grids):
+                np.testing.assert_equal(getattr(expected, grids)[key],
+                                        getattr(myniche, grids)[key])
+
+        calls.clear()
+        myniche.set_input("mlw", input_dir / "mlw.asc")
+        myniche.run(deviation=True, workers=2)
+        assert calls.count("mlw") == 1
+        assert "NutrientLevel" not in calls
+        assert calls.count("Acidity") == 2  # once per block
+        assert myniche.occurrence == expected.occurrence
+
+    def test_scenario_set(self, tmp_path, path_testcase, zwarte_beek_niche,
+                          monkeypatch):
+        """Scenarios share the common input and intermediate results"""
+        input_dir = path_testcase / "zwarte_beek" / "input"
+        scenarios = {
+            "current": {"seepage": input_dir / "seepage.asc"},
+            "dry": {"seepage": 0},
+            "managed": {"seepage": 0,
+                        "management_vegetation": input_dir / "management.asc"},
+        }
+
+        calls = []
+        calculate = niche_vlaanderen.NutrientLevel.calculate
+        read = niche_vlaanderen.Niche.read_rasterio_to_grid
+
+        def counted_calculate(self, *args, **kwargs):
+            calls.append("NutrientLevel")
+            return calculate(self, *args, **kwargs)
+
+        def counted_read(self, file_name, variable_name=None, context=None):
+            calls.append(variable_name)
+            return read(self, file_name, variable_name, context)
+
+        monkeypatch.setattr(niche_vlaanderen.NutrientLevel, "calculate",
+                            counted_calculate)
+        monkeypatch.setattr(niche_vlaanderen.Niche, "read_rasterio_to_grid",
+                            counted_read)
+
+        common = zwarte_beek_niche()
+        scenario_set = common.run_scenarios(scenarios, workers=2, deviation=True)
+        assert isinstance(scenario_set, niche_vlaanderen.NicheScenarioSet)
+        assert calls.count("NutrientLevel") == 1
+        assert calls.count("soil_code") == 1
+        assert calls.count("seepage") == 1
+        assert not common.vegetation_calculated
+
+        for name, inputs in scenarios.items():
+            expected = zwarte_beek_niche()
+            for key, value in inputs.items():
+                expected.set_input(key, value)
+            expected.run(deviation=True)
+            result = scenario_set[name]
+            assert result.name == name
+            assert result.occurrence == expected.occurrence
+            for grids in ["_vegetation", "_abiotic", "_deviation"]:
+                for key in getattr(expected, grids):
+                    np.testing.assert_equal(getattr(expected, grids)[key],
+                                            getattr(result, grids)[key])
+
+        table = scenario_set.table
+        assert list(table.columns) == ["scenario", "vegetation", "presence", "area_ha"]
+        assert list(table.scenario.unique()) == list(scenarios)
+        pd.testing.assert_frame_equal(
+            table[table.scenario == "dry"].drop(columns="scenario")
+            .reset_index(drop=True),
+            scenario_set["dry"].table)
+
+        scenario_set.write(tmp_path)
+        assert (tmp_path / "summary.csv").exists()
+        assert (tmp_path / "managed_V01.tif").exists()
+        pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "summary.csv"), table)
+        with pytest.raises(NicheException):
+            scenario_set.write(tmp_path)
+
+        with pytest.raises(NicheException):
+            niche_vlaanderen.NicheScenarioSet(common, {"wrong": {"mhx": 1}})
+
+    def test_scenario_set_extent(self, tmp_path, path_tests, path_testdata):
+        """Scenarios with a smaller extent do not share the intermediate results"""
+        # mhw without the last row and column
+        with rasterio.open(path_testdata / "small" / "mhw.asc") as src:
+            window = rasterio.windows.Window(0, 0, src.width - 1, src.height - 1)
+            profile = dict(src.profile, driver="GTiff", width=window.width,
+                           height=window.height,
+                           transform=src.window_transform(window))
+            with rasterio.open(tmp_path / "mhw.tif", "w", **profile) as dst:
+                dst.write(src.read(1, window=window), 1)
+
+        scenarios = {
+            "crop": {"mhw": tmp_path / "mhw.tif"},
+            "full": {"mhw": path_testdata / "small" / "mhw.asc"},
+        }
+        common = niche_vlaanderen.Niche()
+        common.read_config_file(path_tests / "small.yaml")
+        scenario_set = common.run_scenarios(scenarios)
+
+        for name, inputs in scenarios.items():
+            expected = niche_vlaanderen.Niche()
+            expected.read_config_file(path_tests / "small.yaml")
+            expected.set_input("mhw", inputs["mhw"])
+            expected.run()
+            result = scenario_set[name]
+            assert result._context == expected._context
+            assert result.occurrence == expected.occurrence
+            for key in expected._vegetation:
+                np.testing.assert_equal(expected._vegetation[key],
+                                        result._vegetation[key])
+        assert scenario_set["crop"]._context.width == 6
+        assert scenario_set["full"]._context.width == 7
+
     def test_deviation(self, zwarte_beek_niche):
         myniche = zwarte_beek_niche()
         myniche.run(deviation=True)
@@ -267,6 +549,30 @@ class TestNiche:
         assert "STATISTICS_MAXIMUM=9" in info
         assert "STATISTICS_MINIMUM=0" in info
 
+    def test_write_workers(self, tmp_path, small_niche):
+        myniche = small_niche
+        myniche.run(deviation=True)
+        myniche.write(tmp_path / "single", detailed_files=True)
+        expected = dict(myniche._files_written)
+
+        myniche._files_written = dict()
+        myniche.write(tmp_path / "threads", detailed_files=True, workers=3)
+        assert list(myniche._files_written) == list(expected)
+        for key in expected:
+            with rasterio.open(expected[key]) as single, \
+                    rasterio.open(myniche._files_written[key]) as threads:
+                np.testing.assert_equal(single.read(1), threads.read(1))
+
+        # a failing file raises, only the files before it are registered
+        (tmp_path / "fail" / "V05.tif").mkdir(parents=True)
+        myniche._files_written = dict()
+        with pytest.raises(RasterioIOError):
+            myniche.write(tmp_path / "fail", overwrite_files=True, workers=3)
+        assert list(myniche._files_written) == list(expected)[:4]
+
+        with pytest.raises(NicheException):
+            myniche.write(tmp_path / "threads", overwrite_files=True, workers=0)
+
     def test_read_configuration(self, path_tests):
         config = path_tests / "small_simple.yaml"
         myniche = niche_vlaanderen.Niche()
@@ -481,6 +787,18 @@ class TestNiche:
         result = np.round(result, 2)
         assert 15.16 == result
 
+    def test_zonal_not_calculated(self, path_testcase, zwarte_beek_niche):
+        myniche = zwarte_beek_niche()
+        myniche.run(full_model=False, vegetation_types=[14, 18])
+        vector = path_testcase / "zwarte_beek" / "input" / "study_area_l72.geojson"
+
+        stats = myniche.zonal_stats(
+            str(vector), outside=False, vegetation_types=[14])
+        assert list(stats.vegetation.unique()) == [14]
+
+        with pytest.raises(NicheException, match=r"\[2, 7\]"):
+            myniche.zonal_stats(str(vector), vegetation_types=[2, 7, 14])
+
     def test_zonal_attribute(self, path_testcase, zwarte_beek_niche):
         myniche = zwarte_beek_niche()
         myniche.run(full_model=False)
@@ -500,6 +818,100 @@ class TestNiche:
         print(stats.OID.unique())
         np.testing.assert_equal([0, -1], stats.OID.unique())
 
+    def test_zonal_overlap(self, zwarte_beek_niche):
+        """Overlapping shapes are counted for every shape, as in rasterstats"""
+        myniche = zwarte_beek_niche()
+        myniche.run(full_model=False)
+        (west, north), (east, south) = myniche._context.extent
+        width = (east - west) / 4
+        features = [
+            {"type": "Feature", "properties": {"OID": i},
+             "geometry": {"type": "Polygon", "coordinates": [[
+                 (west + i * width, south), (west + (i + 2) * width, south),
+                 (west + (i + 2) * width, north), (west + i * width, north),
+                 (west + i * width, south)]]}}
+            for i in range(3)
+        ]
+        vectors = {"type": "FeatureCollection", "features": features}
+
+        stats = myniche.zonal_stats(vectors, outside=False, attribute="OID")
+        assert list(stats.OID) == list(stats.shape_id)
+        assert "present" not in features[0]["properties"]
+        for vi in [1, 7]:
+            expected = rasterstats.zonal_stats(
+                vectors, myniche._vegetation[vi], affine=myniche._context.transform,
+                categorical=True, nodata=255)
+            for shape_id, counts in enumerate(expected):
+                rows = stats[(stats.vegetation == vi) & (stats.shape_id == shape_id)]
+                area = rows.set_index("presence")["area_ha"]
+                assert area["not present"] == counts.get(0, 0) * 25 / 10000
+                assert area["present"] == counts.get(1, 0) * 25 / 10000
+                assert area["no data"] == 0
+
+    def test_zonal_filter_extent(self, tmp_path, zwarte_beek_niche):
+        """Only the shapes of a file intersecting the model extent are read"""
+        myniche = zwarte_beek_niche()
+        myniche.run(full_model=False)
+        (west, north), (east, south) = myniche._context.extent
+        offsets = [0, 10000, 500]
+        features = [
+            {"type": "Feature", "properties": {"OID": 10 + i},
+             "geometry": {"type": "Polygon", "coordinates": [[
+                 (west + dx, south), (west + dx + 200, south),
+                 (west + dx + 200, north), (west + dx, north),
+                 (west + dx, south)]]}}
+            for i, dx in enumerate(offsets)
+        ]
+        path = tmp_path / "shapes.geojson"
+        with open(path, "w") as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+
+        stats = myniche.zonal_stats(path, outside=False, attribute="OID")
+        assert sorted(stats.shape_id.unique()) == [0, 2]
+        assert sorted(stats.OID.unique()) == [10, 12]
+
+        expected = myniche.zonal_stats(
+            {"type": "FeatureCollection", "features": features}, outside=False)
+        assert sorted(expected.shape_id.unique()) == [0, 1, 2]
+        pd.testing.assert_frame_equal(
+            stats.drop(columns="OID").reset_index(drop=True),
+            expected[expected.shape_id != 1].reset_index(drop=True))
+
+        everything = myniche.zonal_stats(path, outside=False, filter_extent=False)
+        pd.testing.assert_frame_equal(everything, expected)
+
+    def test_zonal_coverage(self, zwarte_beek_niche):
+        """Partially covered cells are weighted by the covered fraction"""
+        myniche = zwarte_beek_niche()
+        myniche.run(full_model=False)
+        (west, north), (east, south) = myniche._context.extent
+        # shapes with borders halfway the cells (cell size 5 m), which are
+        # covered by 2 of the 2 x 2 cells of an upscale of 2
+        features = [
+            {"type": "Feature", "properties": {},
+             "geometry": {"type": "Polygon", "coordinates": [[
+                 (west + x0, south + 2.5), (west + x1, south + 2.5),
+                 (west + x1, north - 12.5), (west + x0, north - 12.5),
+                 (west + x0, south + 2.5)]]}}
+            for x0, x1 in [(2.5, 1002.5), (502.5, 1507.5)]
+        ]
+        vectors = {"type": "FeatureCollection", "features": features}
+
+        stats = myniche.zonal_stats(vectors, outside=False, coverage=True)
+        expected = myniche.zonal_stats(vectors, outside=False, upscale=2)
+        np.testing.assert_allclose(stats.area_ha, expected.area_ha, atol=1e-9)
+        assert list(stats.presence) == list(expected.presence)
+
+        # a shape covering the whole grid equals the table
+        box = [(west - 100, south - 100), (east + 100, south - 100),
+               (east + 100, north + 100), (west - 100, north + 100)]
+        vectors = [{"type": "Polygon", "coordinates": [box + box[:1]]}]
+        stats = myniche.zonal_stats(vectors, outside=False, coverage=True)
+        table = myniche.table
+        for presence in ["present", "not present"]:
+            assert np.isclose(stats[stats.presence == presence].area_ha.sum(),
+                              table[table.presence == presence].area_ha.sum())
+
     def test_uint(self, path_testdata):
         myniche = niche_vlaanderen.Niche()
 
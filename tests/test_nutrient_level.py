@@ -55,6 +55,21 @@ class TestNutrientLevel:
         np.testing.assert_equal(expected, result)
         assert result.dtype == np.uint8
 
+    def test_lookup_rows(self):
+        """Every row of lnk_soil_nutrient_level classifies its upper border"""
+        nl = niche_vlaanderen.NutrientLevel()
+        lnk = nl.ct_lnk_soil_nutrient_level
+        lnk = lnk[lnk.nutrient_level >= 4]  # no inundation rule
+        management = nl._ct_management.drop_duplicates("influence")
+        management = management.set_index("influence").management
+
+        result = nl._calculate(
+            management=management[lnk.influence].values.astype("uint8"),
+            soil_code=lnk.soil_code.values.astype("uint8"),
+            nitrogen=lnk.total_nitrogen_max.values.astype("float32"),
+            inundation=np.ones(len(lnk), dtype="uint8"))
+        np.testing.assert_equal(lnk.nutrient_level.values, result)
+
     def test_support_calculate(self):
         """Correct nutrient level based on nitrogen mineralisation calculated
         from single-value grids with empty mask"""
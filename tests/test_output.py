@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+
+from niche_vlaanderen import Niche
+from niche_vlaanderen.exception import NicheException
+from niche_vlaanderen.output import (output_params, output_band,
+                                     vegetation_bitmask, BITMASK_NODATA,
+                                     DEVIATION_NODATA)
+from niche_vlaanderen.vegetation import VegetationPresence
+
+
+class Context:
+    height = 10
+    width = 20
+    crs = None
+    transform = rasterio.Affine(25, 0, 0, 0, -25, 0)
+
+
+def test_output_params():
+    params = output_params(Context())
+    assert params["driver"] == "GTiff"
+    assert params["compress"] == "DEFLATE"
+    assert "tiled" not in params
+
+    params = output_params(
+        Context(), output_profile=dict(compress="zstd", level=15, predictor=3,
+                                       tiled=True, blocksize=512, bigtiff="if_safer"))
+    assert params["compress"] == "ZSTD"
+    assert params["zstd_level"] == 15
+    # integer grids can not use the floating point predictor
+    assert params["predictor"] == 2
+    assert params["blockxsize"] == params["blockysize"] == 512
+    assert params["bigtiff"] == "IF_SAFER"
+
+    params = output_params(Context(), "float32", np.nan,
+                           output_profile=dict(cog=True, predictor=3, level=6))
+    assert params["driver"] == "COG"
+    assert params["predictor"] == "FLOATING_POINT"
+    assert params["level"] == 6
+
+    for profile in [dict(compres="ZSTD"), dict(blocksize=100),
+                    dict(compress="LZW", level=9), dict(predictor=4),
+                    dict(layout="stack"), dict(format="netcdf"),
+                    dict(deviation_dtype="float64"), ["cog"]]:
+        with pytest.raises(NicheException):
+            output_params(Context(), output_profile=profile)
+
+
+def test_write_cog(tmp_path, small_niche):
+    profile = dict(cog=True, compress="ZSTD", predictor=2, blocksize=128)
+    small_niche.run(deviation=True, full_model=False, output_profile=profile)
+    small_niche.write(tmp_path / "cog")
+    deviation = small_niche._deviation["mhw_04"]
+    expected = {4: small_niche._vegetation[4],
+                "mhw_04": np.where(np.isnan(deviation), -99999, deviation)}
+    for key in expected:
+        with rasterio.open(small_niche._files_written[key]) as src:
+            assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+            assert src.compression.name == "zstd"
+            np.testing.assert_equal(src.read(1), expected[key])
+
+    # a tiled run converts the files to COG after the run
+    small_niche.run(full_model=False, tile_size=50, output_dir=tmp_path / "tiled",
+                    output_profile=profile)
+    assert not list((tmp_path / "tiled").glob("*.tmp.tif"))
+    with rasterio.open(small_niche._files_written[4]) as src:
+        assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+        assert src.block_shapes == [(128, 128)]
+
+
+def test_vegetation_bitmask():
+    nodata = np.array([False, False, True])
+    presence = VegetationPresence.empty([1, 2, 5], nodata)
+    presence.set(1, np.array([True, False, False]))
+    presence.set(5, np.array([True, True, False]))
+    expected = np.array([0b10001, 0b10000, BITMASK_NODATA], dtype=np.uint32)
+    np.testing.assert_equal(vegetation_bitmask(presence), expected)
+    np.testing.assert_equal(vegetation_bitmask(dict(presence)), expected)
+    np.testing.assert_equal(vegetation_bitmask(presence.reorder([5, 2, 1])), expected)
+
+    with pytest.raises(NicheException):
+        vegetation_bitmask(VegetationPresence.empty([1, 32], nodata))
+
+
+@pytest.mark.parametrize("layout", ["bands", "bitmask"])
+def test_write_layout(tmp_path, small_niche, layout):
+    small_niche.run(deviation=True, full_model=False,
+                    output_profile=dict(layout=layout))
+    small_niche.write(tmp_path / layout, detailed_files=True)
+    vegetation = small_niche._vegetation
+    assert not list((tmp_path / layout).glob("V*.tif"))
+
+    with rasterio.open(small_niche._files_written["vegetation"]) as src:
+        if layout == "bands":
+            assert src.descriptions == tuple(str(vi) for vi in vegetation)
+            np.testing.assert_equal(src.read(), np.stack(list(vegetation.values())))
+        else:
+            bitmask = src.read(1)
+            assert src.nodata == BITMASK_NODATA
+            for vi in vegetation:
+                present = np.where(bitmask == BITMASK_NODATA, 255,
+                                   (bitmask >> (vi - 1)) & 1)
+                np.testing.assert_equal(present, vegetation[vi])
+
+    with rasterio.open(small_niche._files_written["deviation"]) as src:
+        assert src.descriptions == tuple(small_niche._deviation)
+        np.testing.assert_equal(src.read(2, masked=True).filled(np.nan),
+                                small_niche._deviation["mlw_01"])
+
+    with rasterio.open(small_niche._files_written["vegetation_detail"]) as src:
+        assert src.count == len(vegetation)
+        np.testing.assert_equal(src.read(1), small_niche._vegetation_detail[1])
+
+    # the tiled run writes the same files
+    small_niche.run(full_model=False, tile_size=50, output_dir=tmp_path / "tiled",
+                    output_profile=dict(layout=layout))
+    with rasterio.open(small_niche._files_written["vegetation"]) as src, \
+            rasterio.open(tmp_path / layout / "vegetation.tif") as expected:
+        np.testing.assert_equal(src.read(), expected.read())
+
+
+def test_output_band():
+    deviation = np.array([-2.4, 0.5, 1.6, np.nan, 1e6], dtype=np.float32)
+    np.testing.assert_equal(
+        output_band(deviation, "float32", -99999),
+        np.array([-2.4, 0.5, 1.6, -99999, 1e6], dtype=np.float32))
+    band = output_band(deviation, "int16", -32768)
+    assert band.dtype == np.int16
+    np.testing.assert_equal(band, [-2, 0, 2, -32768, 32767])
+
+    presence = np.array([0, 1, 255], dtype=np.uint8)
+    assert output_band(presence, "uint8", 255) is presence
+
+
+@pytest.mark.parametrize("deviation_dtype", ["float32", "int16"])
+def test_write_deviation_dtype(tmp_path, small_niche, deviation_dtype):
+    small_niche.run(deviation=True, full_model=False,
+                    output_profile=dict(deviation_dtype=deviation_dtype))
+    small_niche.write(tmp_path)
+    deviation = small_niche._deviation["mhw_04"]
+    with rasterio.open(small_niche._files_written["mhw_04"]) as src:
+        assert src.dtypes[0] == deviation_dtype
+        assert src.nodata == DEVIATION_NODATA[deviation_dtype]
+        band = src.read(1, masked=True)
+    np.testing.assert_equal(band.mask, np.isnan(deviation))
+    np.testing.assert_equal(band.compressed(),
+                            np.rint(deviation[~np.isnan(deviation)]))
+
+
+def test_write_zarr(tmp_path, small_niche):
+    pytest.importorskip("zarr")
+    profile = dict(format="zarr", blocksize=32, compress="ZSTD", level=3)
+    small_niche.run(deviation=True, full_model=False, output_profile=profile)
+    small_niche.write(tmp_path / "zarr", detailed_files=True)
+    assert not list((tmp_path / "zarr").glob("*.tif"))
+
+    result = Niche.from_zarr(small_niche._files_written["zarr"])
+    assert list(result._vegetation) == list(small_niche._vegetation)
+    for vi in small_niche._vegetation:
+        np.testing.assert_equal(result._vegetation[vi], small_niche._vegetation[vi])
+        np.testing.assert_equal(result._vegetation_detail[vi],
+                                small_niche._vegetation_detail[vi])
+    assert list(result._deviation) == list(small_niche._deviation)
+    np.testing.assert_equal(result._deviation["mlw_04"],
+                            small_niche._deviation["mlw_04"])
+    assert result.occurrence == small_niche.occurrence
+    pd.testing.assert_frame_equal(result.table, small_niche.table)
+
+    # a tiled run writes the store block by block
+    small_niche.run(full_model=False, tile_size=50, output_dir=tmp_path / "tiled",
+                    output_profile=profile)
+    window = ((10, 60), (20, 90))
+    part = Niche.from_zarr(small_niche._files_written["zarr"], window=window)
+    np.testing.assert_equal(part._vegetation[4],
+                            result._vegetation[4][10:60, 20:90])
+    assert part._context.width == 70
+    assert part._context.transform.c == result._context.transform.c + 20 * 25
+
+    with pytest.raises(NicheException):
+        small_niche.run(full_model=False,
+                        output_profile=dict(format="zarr", compress="LZW"))
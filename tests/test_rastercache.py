@@ -0,0 +1,71 @@
+import os
+import shutil
+
+import numpy as np
+
+import niche_vlaanderen
+
+
+def test_input_raster_cache(tmp_path, path_testcase, monkeypatch):
+    cache = niche_vlaanderen.input_raster_cache
+    input_dir = path_testcase / "zwarte_beek" / "input"
+    mhw = tmp_path / "mhw.asc"
+    shutil.copy(input_dir / "mhw.asc", mhw)
+
+    def read(path, key="mhw"):
+        n = niche_vlaanderen.Niche()
+        n.set_input(key, path)
+        return n.read_rasterio_to_grid(path, key)
+
+    # disabled by default
+    assert cache.maxbytes == 0
+    assert read(mhw).flags.writeable
+    assert len(cache) == 0
+
+    monkeypatch.setattr(cache, "maxbytes", 2 ** 20)
+    cache.invalidate()
+    first = read(mhw)
+    second = read(mhw)
+    assert first is second
+    assert not first.flags.writeable
+    assert first.dtype == np.float32
+    assert len(cache) == 1
+    assert cache.nbytes == first.nbytes
+
+    # the type the grid is cast to is part of the key
+    assert read(mhw, "soil_code").dtype == np.uint8
+    assert len(cache) == 2
+
+    # a changed file is read again
+    stat = os.stat(mhw)
+    os.utime(mhw, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    changed = read(mhw)
+    assert changed is not first
+    np.testing.assert_equal(changed, first)
+
+    # least recently used grids are removed when the budget is exceeded
+    monkeypatch.setattr(cache, "maxbytes", 2 * first.nbytes)
+    read(input_dir / "mlw.asc", "mlw")
+    assert len(cache) == 2
+    assert read(mhw) is changed
+
+    cache.invalidate(mhw)
+    assert len(cache) == 1
+    cache.invalidate()
+    assert len(cache) == 0
+
+    # model runs use the cached grids
+    monkeypatch.setattr(cache, "maxbytes", 2 ** 24)
+    myniche = niche_vlaanderen.Niche()
+    myniche.set_input("soil_code", input_dir / "soil_code.asc")
+    myniche.set_input("mhw", mhw)
+    myniche.set_input("mlw", input_dir / "mlw.asc")
+    myniche.run(full_model=False)
+    other = niche_vlaanderen.Niche()
+    other.set_input("soil_code", input_dir / "soil_code.asc")
+    other.set_input("mhw", mhw)
+    other.set_input("mlw", input_dir / "mlw.asc")
+    other.run(full_model=False)
+    assert myniche._inputarray["mhw"] is other._inputarray["mhw"]
+    assert myniche.occurrence == other.occurrence
+    cache.invalidate()
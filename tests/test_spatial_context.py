@@ -116,6 +116,24 @@ class TestSpatialContext:
         with pytest.raises(SpatialContextError):
             soil_code_sc.get_read_window(glg_sc)
 
+    def test_windows(self, path_testcase):
+        soil_code = rasterio.open(
+            path_testcase / "zwarte_beek" / "input" / "soil_code.asc")
+        soil_code_sc = niche_vlaanderen.niche.SpatialContext(soil_code)
+
+        windows = list(soil_code_sc.windows(50))
+        assert len(windows) == 2 * 4
+        assert windows[0] == ((0, 50), (0, 50))
+        assert windows[-1] == ((50, 84), (150, 188))
+
+        # every block can be read from the original grid
+        for window in windows:
+            block_sc = soil_code_sc.subset(window)
+            assert block_sc.get_read_window(soil_code_sc) == window
+
+        with pytest.raises(SpatialContextError):
+            list(soil_code_sc.windows(0))
+
     def test_different_crs(self, path_testdata):
         test_l72 = rasterio.open(path_testdata / "small" / "msw.asc")
         test_wgs84 = rasterio.open(path_testdata / "msw_small_wgs84.asc")
@@ -37,6 +37,107 @@ def test_validation(zwarte_beek_niche, path_testdata):
     assert "niche object: zwarte beek" in str(no)
 
 
+def test_validation_tables(zwarte_beek_niche, path_testdata):
+    myniche = zwarte_beek_niche()
+    myniche.run()
+    no = NicheValidation(
+        niche=myniche,
+        map=path_testdata / "bwk" / "BWK_2020_clip_ZwarteBeek_simplified.shp",
+    )
+
+    # shape 4 is mapped three times (HAB1, HAB2 and HAB3) to niche types 14
+    # and 18, the pHAB of type 14 is summed
+    item = no.map.iloc[4]
+    pHab = {14: item["pHAB1"] + item["pHAB2"], 18: item["pHAB3"]}
+    presence = no.potential_presence["area_ha"]
+    for veg in pHab:
+        pot = presence.loc[("present", 4), veg]
+        nonpot = presence.loc[("not present", 4), veg]
+        assert no.area_pot.loc[4, veg] == pot
+        assert no.area_nonpot.loc[4, veg] == nonpot
+        assert no.area_effective.loc[4, veg] == pHab[veg] * (pot + nonpot) / 100
+        assert no.veg_present.loc[4, veg] == 1
+
+    # vegetation types not on the map of a shape are missing
+    assert no.area_pot.loc[4].count() == 2
+    assert no.summary["polygon_count"].sum() == no.veg_present.count().sum()
+
+
+def test_validation_coverage(zwarte_beek_niche, path_testdata):
+    myniche = zwarte_beek_niche()
+    myniche.run()
+
+    no = NicheValidation(
+        niche=myniche,
+        map=path_testdata / "bwk" / "BWK_2020_clip_ZwarteBeek_simplified.shp",
+        coverage=True,
+    )
+    # the exact overlay is close to the overlay with a high upscale
+    fine = NicheValidation(
+        niche=myniche,
+        map=path_testdata / "bwk" / "BWK_2020_clip_ZwarteBeek_simplified.shp",
+        upscale=20,
+    )
+    np.testing.assert_allclose(no.summary["score"], fine.summary["score"], atol=0.1)
+    np.testing.assert_allclose(
+        no.area_pot.sum(), fine.area_pot.sum(), rtol=0.01
+    )
+
+
+def test_validation_filter_extent(tmp_path, zwarte_beek_niche, path_testdata):
+    myniche = zwarte_beek_niche()
+    myniche.run(full_model=False)
+
+    # move some polygons outside the extent of the model
+    map = gpd.read_file(path_testdata / "bwk" / "BWK_2020_clip_ZwarteBeek.shp")
+    outside = [2, 3, 49]
+    map.loc[outside, "geometry"] = map.loc[outside, "geometry"].translate(5000, 0)
+    map.to_file(tmp_path / "moved.gpkg")
+
+    no = NicheValidation(niche=myniche, map=tmp_path / "moved.gpkg", upscale=1)
+    # the row number in the file is kept as shape_id
+    inside = [i for i in range(50) if i not in outside]
+    assert list(no.map.index) == inside
+    assert list(no.area_pot.index) == inside
+
+    full = NicheValidation(
+        niche=myniche, map=tmp_path / "moved.gpkg", upscale=1, filter_extent=False
+    )
+    assert len(full.map) == 50
+    pd.testing.assert_frame_equal(
+        no.area_pot, full.area_pot.loc[inside], check_index_type=False
+    )
+    pd.testing.assert_frame_equal(no.summary, full.summary)
+
+
+def test_validation_arrow(zwarte_beek_niche, path_testdata):
+    pytest.importorskip("pyarrow")
+    myniche = zwarte_beek_niche()
+    myniche.run(full_model=False)
+    map = path_testdata / "bwk" / "BWK_2020_clip_ZwarteBeek_simplified.shp"
+    no = NicheValidation(niche=myniche, map=map, use_arrow=True)
+    expected = NicheValidation(niche=myniche, map=map)
+    pd.testing.assert_frame_equal(no.summary, expected.summary)
+
+
+def test_validation_vegetation_types(zwarte_beek_niche, path_testdata):
+    """Only the vegetation types calculated by niche are validated"""
+    bwk = path_testdata / "bwk" / "BWK_2020_clip_ZwarteBeek_simplified.shp"
+    myniche = zwarte_beek_niche()
+    myniche.run()
+    expected = NicheValidation(niche=myniche, map=bwk)
+
+    subset = zwarte_beek_niche()
+    subset.run(vegetation_types=[14, 18])
+    no = NicheValidation(niche=subset, map=bwk)
+
+    assert list(no.summary.index) == [14, 18]
+    pd.testing.assert_frame_equal(no.summary, expected.summary.loc[[14, 18]])
+    for table in no._tables:
+        pd.testing.assert_frame_equal(
+            getattr(no, table), getattr(expected, table)[[14, 18]])
+
+
 def test_validation_custom_vegetation(zwarte_beek_niche, path_testdata):
     myniche = zwarte_beek_niche()
     myniche.run()
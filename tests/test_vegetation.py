@@ -6,7 +6,7 @@ import rasterio
 
 import niche_vlaanderen
 from niche_vlaanderen.exception import NicheException
-from niche_vlaanderen.vegetation import VegSuitable
+from niche_vlaanderen.vegetation import VegSuitable, VegetationPresence
 
 
 class TestVegetation:
@@ -177,6 +177,124 @@ class TestVegetation:
                 vi = vi.filled(fill_value=255)
             np.testing.assert_allclose(vi - veg_predict[i], 0)
 
+    def test_lookup_rows(self):
+        """Compiled lookup gives the same result as checking every row of the
+        vegetation code table"""
+        rng = np.random.default_rng(0)
+        size = 5000
+        soil_code = rng.choice(
+            np.array([2, 3, 5, 7, 8, 11, 13, 14, 15, 254, 255], dtype="uint8"),
+            size)
+        mhw = np.round(rng.uniform(-150, 10, size)).astype("float32")
+        mlw = mhw - np.round(rng.uniform(0, 80, size)).astype("float32")
+        nutrient_level = rng.integers(1, 6, size).astype("uint8")
+        acidity = rng.integers(1, 4, size).astype("uint8")
+        management = rng.integers(0, 4, size).astype("uint8")
+        inundation = rng.integers(0, 3, size).astype("uint8")
+
+        v = niche_vlaanderen.Vegetation()
+        _, _, veg_detail = v.calculate(soil_code, mhw, mlw, nutrient_level,
+                                       acidity, management, inundation)
+
+        for veg_code, subtable in v._ct_vegetation.groupby("veg_code"):
+            expected = np.zeros(size, dtype="uint8")
+            for row in subtable.itertuples():
+                row_soil = row.soil_code == soil_code
+                current_row = (row_soil
+                               & (row.mhw_min <= mhw) & (row.mhw_max >= mhw)
+                               & (row.mlw_min <= mlw) & (row.mlw_max >= mlw))
+                expected |= row_soil * np.uint8(VegSuitable.SOIL)
+                expected |= current_row * np.uint8(VegSuitable.MXW)
+                expected |= (current_row & (nutrient_level == row.nutrient_level)
+                             ) * np.uint8(VegSuitable.NUTRIENT)
+                expected |= (current_row & (acidity == row.acidity)
+                             ) * np.uint8(VegSuitable.ACIDITY)
+                expected |= (current_row & (management == row.management)
+                             ) * np.uint8(VegSuitable.MANAGEMENT)
+                expected |= (current_row & (inundation == row.inundation)
+                             ) * np.uint8(VegSuitable.FLOODING)
+            expected[soil_code == 255] = 255
+            np.testing.assert_equal(expected, veg_detail[veg_code])
+
+    @pytest.mark.parametrize("full_model", [True, False])
+    def test_deduplicate(self, full_model):
+        """Calculating the unique input combinations gives the same result"""
+        rng = np.random.default_rng(1)
+        shape = (60, 50)
+        soil_code = rng.choice(
+            np.array([2, 3, 5, 7, 8, 11, 13, 14, 15, 255], dtype="uint8"), shape)
+        mhw = rng.choice(np.array([-60, -20, 0, np.nan], dtype="float32"), shape)
+        mlw = mhw - rng.choice(np.array([0, 40], dtype="float32"), shape)
+        arguments = dict(soil_code=soil_code, mhw=mhw, mlw=mlw)
+        if full_model:
+            arguments.update(
+                nutrient_level=rng.integers(1, 6, shape).astype("uint8"),
+                acidity=rng.integers(1, 4, shape).astype("uint8"),
+                management=np.broadcast_to(np.uint8(2), shape),
+            )
+
+        v = niche_vlaanderen.Vegetation()
+        expected = v.calculate(full_model=full_model, return_all=False,
+                               **arguments)
+        result = v.calculate(full_model=full_model, return_all=False,
+                             deduplicate=True, **arguments)
+
+        assert expected[1] == result[1]
+        for grids, result_grids in [(expected[0], result[0]),
+                                    (expected[2], result[2])]:
+            assert list(grids) == list(result_grids)
+            for veg_code in grids:
+                np.testing.assert_equal(grids[veg_code], result_grids[veg_code])
+
+    def test_presence_packed(self):
+        """Presence grids are packed bits which unpack to the uint8 grids"""
+        rng = np.random.default_rng(2)
+        shape = (40, 30)
+        soil_code = rng.choice(
+            np.array([2, 3, 5, 7, 8, 11, 13, 14, 15, 255], dtype="uint8"), shape)
+        mhw = rng.choice(np.array([-60, -20, 0, np.nan], dtype="float32"), shape)
+        mlw = mhw - rng.choice(np.array([0, 40], dtype="float32"), shape)
+
+        v = niche_vlaanderen.Vegetation()
+        veg_bands, occurrence, veg_detail = v.calculate(soil_code, mhw, mlw,
+                                                        full_model=False)
+
+        assert isinstance(veg_bands, VegetationPresence)
+        assert list(veg_bands) == list(veg_detail) == list(range(1, 29))
+        assert len(veg_bands) == 28
+        # 28 uint8 grids are packed into a single uint32 grid and a mask
+        assert veg_bands.bits.shape == (1,) + shape
+        assert veg_bands.nbytes == 5 * soil_code.size
+
+        expected = VegSuitable.SOIL + VegSuitable.MXW
+        for veg_code, detail in veg_detail.items():
+            band = veg_bands[veg_code]
+            assert band.dtype == np.uint8
+            np.testing.assert_equal(
+                band, np.where(detail == 255, 255, detail == expected))
+            assert occurrence[veg_code] == np.sum(band == 1) / np.sum(band != 255)
+        with pytest.raises(KeyError):
+            veg_bands[29]
+
+        # with return_all=False the vegetation types without data are left out
+        soil_code = np.full(shape, 14, dtype="uint8")
+        mhw = np.full(shape, -20, dtype="float32")
+        everything, _, veg_detail = v.calculate(soil_code, mhw, mhw - 40,
+                                                full_model=False)
+        subset, _, _ = v.calculate(soil_code, mhw, mhw - 40, full_model=False,
+                                   return_all=False)
+        assert 0 < len(subset) < len(everything)
+        assert list(subset) == [vi for vi in veg_detail if np.any(veg_detail[vi])]
+        for veg_code in subset:
+            np.testing.assert_equal(subset[veg_code], everything[veg_code])
+
+        # bits are allocated for the capacity of the presence grids
+        presence = VegetationPresence.empty([], veg_bands.nodata, capacity=32)
+        for veg_code in range(1, 33):
+            presence.add(veg_code, veg_bands.present(1))
+        with pytest.raises(ValueError):
+            presence.add(33, veg_bands.present(1))
+
     def test_all_nodata(self, path_testdata):
         """Variable with all no-data values raises error"""
         soil_code = np.array([14, 14, 14], dtype="uint8")
@@ -212,6 +330,31 @@ class TestVegetation:
         expected = np.array([28, 12, 0, 0, -15, np.nan, np.nan])
         np.testing.assert_equal(expected, d["mlw_01"])
 
+    def test_deviation_mxw(self):
+        """Deviation is zero where mhw and mlw are suitable, nan for other soils"""
+        rng = np.random.default_rng(3)
+        shape = (40, 30)
+        soil_code = rng.choice(
+            np.array([2, 3, 5, 7, 8, 11, 13, 14, 15, 255], dtype="uint8"), shape)
+        mhw = rng.choice(np.arange(-100, 20, 5, dtype="float32"), shape)
+        mlw = mhw - rng.choice(np.arange(0, 100, 5, dtype="float32"), shape)
+
+        v = niche_vlaanderen.Vegetation()
+        _, _, veg_detail = v.calculate(soil_code, mhw, mlw, full_model=False)
+        d = v.calculate_deviation(soil_code, mhw, mlw)
+
+        assert len(d) == 2 * len(veg_detail)
+        for veg_code, detail in veg_detail.items():
+            mhw_diff, mlw_diff = d["mhw_%02d" % veg_code], d["mlw_%02d" % veg_code]
+            assert mhw_diff.dtype == mlw_diff.dtype == np.float32
+            data = detail != 255
+            soil = data & ((detail & VegSuitable.SOIL) > 0)
+            np.testing.assert_equal(np.isnan(mhw_diff), ~soil)
+            np.testing.assert_equal(np.isnan(mlw_diff), ~soil)
+            np.testing.assert_equal(
+                (mhw_diff == 0) & (mlw_diff == 0),
+                data & ((detail & VegSuitable.MXW) > 0))
+
     def test_detailed_vegetation(self, single_value_input_arrays):
         """Correct vegetation example in docs"""
         nutrient_level, acidity, mlw, mhw, soil_code, _ = single_value_input_arrays